@@ -2,9 +2,16 @@ import os
 import json
 from datetime import datetime
 import logging
-import chromadb
+import queue
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional
+
+from watchdog.observers import Observer
+from watchdog.events import FileSystemEventHandler
 
 import config
+from src.annotation_store import AnnotationStore
+from src.dirload import DirloadState, dir_main_id, read_annotated_dir
 
 log_dir = os.path.join("logs", "annotate")
 if not os.path.exists(log_dir):
@@ -25,74 +32,144 @@ logger = logging.getLogger(__name__)
 
 logger.info(f"ANNOTATED_DATA_PATH: {config.ANNOTATED_DATA_PATH}")
 logger.info(f"ANN_DIRRIFY_DIR_PATH: {config.ANN_DIRRIFY_DIR_PATH}")
+logger.info(f"ANN_DIRLOAD_MODE: {config.ANN_DIRLOAD_MODE}")
 
-# read annotated data if exists
-annotated_ids = set()
-if os.path.exists(config.ANNOTATED_DATA_PATH):
-    with open(config.ANNOTATED_DATA_PATH) as f:
-        annotated_data = json.load(f)
-        annotated_ids = {pos for ann in annotated_data for pos in ann["pos"]}
-else:
-    with open(config.ANNOTATED_DATA_PATH, "w") as f:
-        json.dump([], f, indent=4)
-
+annotation_store = AnnotationStore(
+    config.ANNOTATED_DATA_PATH,
+    config.ANNOTATED_LOG_PATH,
+    logger,
+    compact_every=config.ANNOTATION_COMPACT_EVERY
+)
+annotated_ids = annotation_store.annotated_ids
 logger.info(f"Number of annotated ids before dirload: {len(annotated_ids)}")
 
 
+state = DirloadState(config.ANN_DIRLOAD_STATE_PATH)
 samples_json_path = os.path.join(config.ANN_DIRRIFY_DIR_PATH, "samples.json")
-with open(samples_json_path) as f:
-    samples_info = json.load(f)
-
-
-new_annotated = []
-for entry in os.scandir(config.ANN_DIRRIFY_DIR_PATH):
-    pos = []
-    neg = []
 
-    dir_path = entry.path
-    dir_name = entry.name.split("_")[-1]
-
-    if dir_name in annotated_ids:
-        logger.warning(f"Meet dir with path {dir_path}, but id {dir_name} already in annotated, skip ...")
-        continue
-
-    if not entry.is_dir():
-        logger.warning(f"Path {dir_path} is not directory, skip ...")
-        continue
-
-    listdir = os.listdir(dir_path)
-    item_names = [
-        name.split(".")[0].split("_")[-1] 
-        for name in listdir
-    ]
-    for sample_item_name in samples_info[dir_name]:
-        if sample_item_name in item_names:
-            pos.append(sample_item_name)
-        else:
-            neg.append(sample_item_name)
 
-    # little extra check
-    for item_name, file_name in zip(item_names, listdir):
-        if item_name not in samples_info[dir_name]:
-            logging.warning(f"Name {item_name} of file {file_name} in directory {dir_name} is not in samples.json by key {dir_name}")
-
-    new_annotated.append({
-        "pos": pos,
-        "neg": neg
-    })
-
-
-annotated_data += new_annotated
-
-with open(config.ANNOTATED_DATA_PATH, "w") as f:
-    json.dump(
-        annotated_data,
-        f,
-        indent=4
-    )
-
-annotated_ids = {pos for ann in annotated_data for pos in ann["pos"]}
+def load_samples() -> dict:
+    if not os.path.exists(samples_json_path):
+        return {}
+    with open(samples_json_path) as f:
+        return json.load(f)
+
+
+samples_info = load_samples()
+
+
+def check_dir(dir_name: str, dir_path: str) -> Optional[str]:
+    """ Main id of directory if it has to be loaded, None otherwise """
+    global samples_info
+    if state.state(dir_name) == "committed":
+        return None
+
+    main_id = dir_main_id(dir_name)
+    if main_id in annotated_ids:
+        logger.warning(f"Meet dir with path {dir_path}, but id {main_id} already in annotated, skip ...")
+        return None
+
+    if main_id not in samples_info:
+        # samples.json is rewritten while ann_dirrify is running
+        samples_info = load_samples()
+        if main_id not in samples_info:
+            logger.warning(f"Dir {dir_path} is not in samples.json, skip ...")
+            return None
+    return main_id
+
+
+def commit_dir(dir_name: str, pos: List[str], neg: List[str]):
+    annotation_store.add(pos, neg)
+    state.mark(dir_name, "committed", len(pos), len(neg))
+
+
+def load_once():
+    """ Loads all directories at once, directories are read in parallel """
+    dirs = []
+    with os.scandir(config.ANN_DIRRIFY_DIR_PATH) as entries:
+        for entry in entries:
+            if not entry.is_dir():
+                if entry.name != "samples.json":
+                    logger.warning(f"Path {entry.path} is not directory, skip ...")
+                continue
+            main_id = check_dir(entry.name, entry.path)
+            if main_id is not None:
+                dirs.append((entry.name, entry.path, main_id))
+
+    with ThreadPoolExecutor(config.ANN_DIRLOAD_WORKERS) as pool:
+        annotations = pool.map(
+            lambda dir: read_annotated_dir(dir[1], samples_info[dir[2]], config.ANN_DIRLOAD_DONE_MARKER, logger),
+            dirs
+        )
+        for (dir_name, dir_path, main_id), (pos, neg) in zip(dirs, annotations):
+            commit_dir(dir_name, pos, neg)
+    logger.info(f"Loaded {len(dirs)} annotated directories")
+
+
+class DoneMarkerHandler(FileSystemEventHandler):
+    """ Queues directories in which done marker appears """
+    def __init__(self, dir_queue: queue.Queue):
+        self.dir_queue = dir_queue
+
+    def _on_path(self, path: str):
+        if os.path.basename(path) == config.ANN_DIRLOAD_DONE_MARKER:
+            self.dir_queue.put(os.path.dirname(path))
+
+    def on_created(self, event):
+        if not event.is_directory:
+            self._on_path(event.src_path)
+
+    def on_moved(self, event):
+        if not event.is_directory:
+            self._on_path(event.dest_path)
+
+
+def watch():
+    """ Loads every directory as soon as annotator creates done marker file in it, until interrupted """
+    dir_queue = queue.Queue()
+    observer = Observer()
+    observer.schedule(DoneMarkerHandler(dir_queue), config.ANN_DIRRIFY_DIR_PATH, recursive=True)
+    observer.start()
+
+    # directories marked before start, observer is started first so no marker is missed
+    with os.scandir(config.ANN_DIRRIFY_DIR_PATH) as entries:
+        for entry in entries:
+            if entry.is_dir() and os.path.exists(os.path.join(entry.path, config.ANN_DIRLOAD_DONE_MARKER)):
+                dir_queue.put(entry.path)
+
+    logger.info(f"Watching {config.ANN_DIRRIFY_DIR_PATH} for {config.ANN_DIRLOAD_DONE_MARKER} markers")
+    n_loaded = 0
+    try:
+        while True:
+            dir_path = os.path.normpath(dir_queue.get())
+            dir_name = os.path.basename(dir_path)
+            # markers deeper than directories of the export are ignored
+            if os.path.dirname(dir_path) != os.path.normpath(config.ANN_DIRRIFY_DIR_PATH):
+                continue
+            main_id = check_dir(dir_name, dir_path)
+            if main_id is None:
+                continue
+            pos, neg = read_annotated_dir(dir_path, samples_info[main_id], config.ANN_DIRLOAD_DONE_MARKER, logger)
+            commit_dir(dir_name, pos, neg)
+            n_loaded += 1
+            logger.info(f"Loaded {dir_name}: {len(pos)} pos, {len(neg)} neg")
+    except KeyboardInterrupt:
+        logger.info(f"Stopped watching, loaded {n_loaded} annotated directories")
+    finally:
+        observer.stop()
+        observer.join()
+
+
+dirload_mode2runner = {
+    "once": load_once,
+    "watch": watch
+}
+
+if config.ANN_DIRLOAD_MODE not in dirload_mode2runner:
+    raise Exception(f"No dirload mode named {config.ANN_DIRLOAD_MODE}")
+try:
+    dirload_mode2runner[config.ANN_DIRLOAD_MODE]()
+finally:
+    annotation_store.close()
+    state.close()
 logger.info(f"Number of annotated ids after dirload: {len(annotated_ids)}")
-
-
-
@@ -1,14 +1,22 @@
 import os
+import shutil
 import json
 from datetime import datetime
 import logging
 from tqdm import tqdm
 import chromadb
-import aiohttp
 import asyncio
+import functools
+from concurrent.futures import ProcessPoolExecutor
 
 import config
 from src.samplers_package import NamedSampler
+from src.image_fetcher import ImageFetcher
+from src.image_cache import ImageCache
+from src.annotation_store import load_annotated_ids
+from src.image_export import reencode, contact_sheet, format2ext
+from src.failure_ledger import FailureLedger
+from src.url_index import UrlIndex
 
 log_dir = os.path.join("logs", "annotate")
 if not os.path.exists(log_dir):
@@ -25,6 +33,8 @@ logging.basicConfig(
     ]
 )
 logging.getLogger('watchdog.observers.inotify_buffer').setLevel(logging.WARNING)
+logging.getLogger("httpcore").setLevel(logging.WARNING)
+logging.getLogger("httpx").setLevel(logging.WARNING)
 logger = logging.getLogger(__name__)
 
 logger.info(f"COLLECTION_NAME: {config.COLLECTION_NAME}")
@@ -32,22 +42,22 @@ logger.info(f"CHROMADB_PATH: {config.CHROMADB_PATH}")
 logger.info(f"ANNOTATED_DATA_PATH: {config.ANNOTATED_DATA_PATH}")
 logger.info(f"ANN_SAMPLER_NAME: {config.ANN_SAMPLER_NAME}")
 logger.info(f"ANN_SAMPLER_CFG: {config.ANN_SAMPLER_CFG}")
+logger.info(f"ANN_SEARCH_NAME: {config.ANN_SEARCH_NAME}")
+logger.info(f"ANN_SEARCH_CFG: {config.ANN_SEARCH_CFG}")
 logger.info(f"ANN_DIRRIFY_DIR_PATH: {config.ANN_DIRRIFY_DIR_PATH}")
 logger.info(f"ANN_DIRRIFY_NDIRS: {config.ANN_DIRRIFY_NDIRS}")
 logger.info(f"ANN_DIRRIFY_NNEAREST: {config.ANN_DIRRIFY_NNEAREST}")
+logger.info(f"ANN_DIRRIFY_DIRS_IN_FLIGHT: {config.ANN_DIRRIFY_DIRS_IN_FLIGHT}")
+logger.info(f"ANN_DIRRIFY_MAX_DOWNLOADS: {config.ANN_DIRRIFY_MAX_DOWNLOADS}")
+logger.info(f"ANN_DIRRIFY_IMAGE_CFG: {config.ANN_DIRRIFY_IMAGE_CFG}")
+logger.info(f"ANN_DIRRIFY_CONTACT_SHEET_CFG: {config.ANN_DIRRIFY_CONTACT_SHEET_CFG}")
+logger.info(f"FAILURE_LEDGER_CFG: {config.FAILURE_LEDGER_CFG}")
 
 os.makedirs(config.ANN_DIRRIFY_DIR_PATH, exist_ok=False)
+if config.ANN_DIRRIFY_CONTACT_SHEET_CFG is not None:
+    os.makedirs(config.ANN_DIRRIFY_CONTACT_SHEET_DIR_PATH, exist_ok=False)
 
-# read annotated data if exists
-annotated_ids = set()
-if os.path.exists(config.ANNOTATED_DATA_PATH):
-    with open(config.ANNOTATED_DATA_PATH) as f:
-        annotated_data = json.load(f)
-        annotated_ids = {pos for ann in annotated_data for pos in ann["pos"]}
-else:
-    with open(config.ANNOTATED_DATA_PATH, "w") as f:
-        json.dump([], f, indent=4)
-
+annotated_ids = load_annotated_ids(config.ANNOTATED_DATA_PATH, config.ANNOTATED_LOG_PATH)
 logger.info(f"Number of annotated ids: {len(annotated_ids)}")
 
 # read collection
@@ -59,76 +69,185 @@ collection = db.get_collection(
     name=config.COLLECTION_NAME,
 )
 logger.info(f"Number of elements in collection: {collection.count()}")
+# changes on every collection write, so cached sampler index is rebuilt after items are updated
+url_index = UrlIndex(config.URL_INDEX_PATH)
+index_version = url_index.version
+url_index.close()
 
 sampler = NamedSampler(
     collection=collection, 
     meta_fields=config.ANN_META_FIELDS,
     name=config.ANN_SAMPLER_NAME,
-    cfg=config.ANN_SAMPLER_CFG
+    cfg=config.ANN_SAMPLER_CFG,
+    index_cache_dir=config.SAMPLER_INDEX_DIR,
+    search_name=config.ANN_SEARCH_NAME,
+    search_cfg=config.ANN_SEARCH_CFG,
+    index_version=index_version
 )
 sampler.exclude_ids(annotated_ids)
 
-samples = {}
+failures = FailureLedger(config.FAILURE_LEDGER_PATH, **config.FAILURE_LEDGER_CFG)
+
+
+class SamplesManifest:
+    """
+    samples.json is rewritten atomically by a background task whenever directories are added,
+    so a crash loses at most directories finished since the last write.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self.samples = {}
+        self.dirty = asyncio.Event()
+
+    def add(self, main_id, item_ids):
+        self.samples[main_id] = item_ids
+        self.dirty.set()
+
+    def _save(self, samples: dict):
+        with open(self.path + ".tmp", "w") as f:
+            json.dump(samples, f, indent=4)
+        os.replace(self.path + ".tmp", self.path)
+
+    async def run(self):
+        while True:
+            await self.dirty.wait()
+            self.dirty.clear()
+            await asyncio.to_thread(self._save, dict(self.samples))
 
+    async def close(self, task):
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        await asyncio.to_thread(self._save, dict(self.samples))
 
-async def download_image(session, item, dir_path, i):
+
+def write_file(path, content):
+    with open(path, 'wb') as f:
+        f.write(content)
+
+
+async def download_image(fetcher, semaphore, pool, item, dir_path, i, blocked):
+    """ Returns (id, written content) of the image, (None, None) if it failed to load or its url is in failure ledger """
+    if item.url in blocked:
+        logger.info(f"Skipping image {item.id} failed recently, URL: {item.url}")
+        return None, None
     try:
-        async with session.get(item.url) as resp:
-            if resp.status == 200:
-                image_path = os.path.join(dir_path, f"{i}_{item.id}.jpg")
-                with open(image_path, 'wb') as f:
-                    f.write(await resp.read())
-                return item.id
-            else:
-                logger.info(f"Error loading image {item.id}, URL: {item.url}, status code: {resp.status}")
-                return None
+        async with semaphore:
+            content = await fetcher.fetch(item.url)
+        if config.ANN_DIRRIFY_IMAGE_CFG is not None:
+            # decoding and encoding are cpu bound, so they run in process pool
+            content = await asyncio.get_running_loop().run_in_executor(
+                pool, functools.partial(reencode, content, **config.ANN_DIRRIFY_IMAGE_CFG)
+            )
     except Exception as e:
         logger.info(f"Error {e} loading image: {item.id}, URL: {item.url}")
+        await asyncio.to_thread(failures.record_failure, item.url, e)
+        return None, None
+
+    ext = format2ext[config.ANN_DIRRIFY_IMAGE_CFG.get("format", "JPEG")] if config.ANN_DIRRIFY_IMAGE_CFG is not None else "jpg"
+    image_path = os.path.join(dir_path, f"{i}_{item.id}.{ext}")
+    await asyncio.to_thread(write_file, image_path, content)
+    return item.id, content
+
+
+async def write_contact_sheet(pool, tiles, dir_name):
+    """ Grid of numbered directory images, saved outside of directories so annotation is not affected """
+    cfg = config.ANN_DIRRIFY_CONTACT_SHEET_CFG
+    content = await asyncio.get_running_loop().run_in_executor(pool, functools.partial(contact_sheet, tiles, **cfg))
+    sheet_path = os.path.join(config.ANN_DIRRIFY_CONTACT_SHEET_DIR_PATH, f"{dir_name}.{format2ext[cfg.get('format', 'JPEG')]}")
+    await asyncio.to_thread(write_file, sheet_path, content)
+
+
+async def process_dir(fetcher, semaphore, pool, main_item, nearest_items, dir_name, dir_path):
+    await asyncio.to_thread(os.mkdir, dir_path)
+    items = [main_item] + nearest_items
+    blocked = await asyncio.to_thread(failures.blocked_many, [item.url for item in items])
+    # all images of the directory are downloaded concurrently, downloads of all directories share the semaphore
+    loaded = await asyncio.gather(*[
+        download_image(fetcher, semaphore, pool, item, dir_path, i, blocked)
+        for i, item in enumerate(items)
+    ])
+    await asyncio.to_thread(failures.record_success, [item.url for item, (item_id, _) in zip(items, loaded) if item_id])
+    if loaded[0][0] is None:
+        # If main_item failed to load, skip the entire directory and its items
+        logger.info(f"Main item {main_item.id} failed to load, skipping directory {dir_name}")
+        await asyncio.to_thread(shutil.rmtree, dir_path)
         return None
 
+    if config.ANN_DIRRIFY_CONTACT_SHEET_CFG is not None:
+        await write_contact_sheet(pool, [(i, content) for i, (item_id, content) in enumerate(loaded) if item_id], dir_name)
+    return [item_id for item_id, _ in loaded if item_id]
+
+
+async def produce(dir_queue, n_workers):
+    """ Samples directories batch by batch and queues them for workers """
+    n_dir = 0
+    while n_dir < config.ANN_DIRRIFY_NDIRS:
+        # samples of one batch have no common items, so they are found by one query
+        batch = await asyncio.to_thread(
+            sampler.sample_batch,
+            min(config.ANN_DIRRIFY_BATCH_SIZE, config.ANN_DIRRIFY_NDIRS - n_dir),
+            config.ANN_DIRRIFY_NNEAREST
+        )
+        if len(batch) == 0:
+            logger.info("No items remaining")
+            break
 
-async def process_dir(n_dir, main_item, nearest_items, dir_name, dir_path):
-    async with aiohttp.ClientSession() as session:
-        successfully_loaded_items = []
-        for i, item in enumerate([main_item] + nearest_items):
-            item_id = await download_image(session, item, dir_path, i)
-            if item_id:
-                successfully_loaded_items.append(item_id)
-            elif i == 0:
-                # If main_item failed to load, skip the entire directory and its items
-                logger.info(f"Main item {main_item.id} failed to load, skipping directory {dir_name}")
-                os.rmdir(dir_path)
-                return None
-        # If all successfully loaded
-        samples[main_item.id] = successfully_loaded_items
-        return successfully_loaded_items
+        # sampled items are excluded at once, so directories in flight never share items
+        sampler.exclude_ids([item.id for main_item, nearest_items in batch for item in [main_item] + nearest_items])
+        for main_item, nearest_items in batch:
+            await dir_queue.put((n_dir, main_item, nearest_items))
+            n_dir += 1
 
+    for _ in range(n_workers):
+        await dir_queue.put(None)
 
-async def main():
-    for n_dir in tqdm(range(config.ANN_DIRRIFY_NDIRS)):
-        sample_res = sampler(config.ANN_DIRRIFY_NNEAREST)
-        if sample_res is None:
-            logger.info("No items remaining")
-            break
 
-        main_item, nearest_items = sample_res
+async def export_dirs(fetcher, semaphore, pool, dir_queue, manifest, pbar):
+    while (item := await dir_queue.get()) is not None:
+        n_dir, main_item, nearest_items = item
         dir_name = f"{n_dir}_{main_item.id}"
         dir_path = os.path.join(config.ANN_DIRRIFY_DIR_PATH, dir_name)
-        os.mkdir(dir_path)
 
         # Process directory and load images
-        successfully_loaded_items = await process_dir(n_dir, main_item, nearest_items, dir_name, dir_path)
-
+        successfully_loaded_items = await process_dir(fetcher, semaphore, pool, main_item, nearest_items, dir_name, dir_path)
         if successfully_loaded_items:
-            # Exclude successfully loaded items from the sampler
-            sampler.exclude_ids(successfully_loaded_items)
+            manifest.add(main_item.id, successfully_loaded_items)
+        pbar.update(1)
 
 
-if __name__ == "__main__":
-    asyncio.run(main())
+async def dirrify(fetcher, pool, manifest):
+    n_workers = config.ANN_DIRRIFY_DIRS_IN_FLIGHT
+    semaphore = asyncio.Semaphore(config.ANN_DIRRIFY_MAX_DOWNLOADS)
+    dir_queue = asyncio.Queue(n_workers)
+    pbar = tqdm(total=config.ANN_DIRRIFY_NDIRS)
+    try:
+        await asyncio.gather(
+            produce(dir_queue, n_workers),
+            *[export_dirs(fetcher, semaphore, pool, dir_queue, manifest, pbar) for _ in range(n_workers)]
+        )
+    finally:
+        pbar.close()
 
-# After the process, save annotated ids and samples to disk
-with open(os.path.join(config.ANN_DIRRIFY_DIR_PATH, "samples.json"), "w") as f:
-    json.dump(samples, f, indent=4)
 
-logger.info(f"Finished processing, saved {len(samples)} directories")
+async def main():
+    manifest = SamplesManifest(os.path.join(config.ANN_DIRRIFY_DIR_PATH, "samples.json"))
+    manifest_task = asyncio.create_task(manifest.run())
+    cache = ImageCache(**config.IMAGE_CACHE_CFG) if config.IMAGE_CACHE_CFG is not None else None
+    # images are re-encoded and contact sheets are drawn in processes, default executor is used if both are disabled
+    pool = ProcessPoolExecutor(config.ANN_DIRRIFY_PROCESS_WORKERS) \
+        if config.ANN_DIRRIFY_IMAGE_CFG is not None or config.ANN_DIRRIFY_CONTACT_SHEET_CFG is not None else None
+    try:
+        async with ImageFetcher(**config.FETCHER_CFG, cache=cache) as fetcher:
+            await dirrify(fetcher, pool, manifest)
+    finally:
+        if pool is not None:
+            pool.shutdown()
+        # After the process, save samples to disk
+        await manifest.close(manifest_task)
+    logger.info(f"Finished processing, saved {len(manifest.samples)} directories")
+    failures.report(logger, config.FAILURE_LEDGER_REPORT_TOP)
+    failures.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,7 +1,6 @@
 import streamlit as st
 
 import os
-import json
 from datetime import datetime
 import logging
 
@@ -9,6 +8,12 @@ import chromadb
 
 import config
 from src.samplers_package import NamedSampler
+from src.image_cache import ImageCache
+from src.sample_prefetcher import SamplePrefetcher
+from src.annotation_store import AnnotationStore
+from src.url_index import UrlIndex
+
+DEFAULT_N_NEAREST = 5
 
 
 if "initialized" not in st.session_state:
@@ -35,23 +40,19 @@ if "initialized" not in st.session_state:
     logger.info(f"ANN_META_FIELDS: {config.ANN_META_FIELDS}")
     logger.info(f"ANN_SAMPLER_NAME: {config.ANN_SAMPLER_NAME}")
     logger.info(f"ANN_SAMPLER_CFG: {config.ANN_SAMPLER_CFG}")
-
-    # read annotated data if exists
-    annotated_ids = set()
-    if os.path.exists(config.ANNOTATED_DATA_PATH):
-        with open(config.ANNOTATED_DATA_PATH) as f:
-            annotated_data = json.load(f)
-            annotated_ids = {pos for ann in annotated_data for pos in ann["pos"]}
-    else:
-        with open(config.ANNOTATED_DATA_PATH, "w") as f:
-            json.dump(
-                [],
-                f,
-                indent=4
-            )
-        
-
-    logger.info(f"Number of annotated ids: {len(annotated_ids)}")
+    logger.info(f"ANN_SEARCH_NAME: {config.ANN_SEARCH_NAME}")
+    logger.info(f"ANN_SEARCH_CFG: {config.ANN_SEARCH_CFG}")
+
+    # annotations are appended to log, annotated ids are updated incrementally
+    annotation_store = AnnotationStore(
+        config.ANNOTATED_DATA_PATH,
+        config.ANNOTATED_LOG_PATH,
+        logger,
+        compact_every=config.ANNOTATION_COMPACT_EVERY
+    )
+    # annotator has no shutdown hook, so log left by previous session is compacted on start
+    annotation_store.compact()
+    logger.info(f"Number of annotated ids: {len(annotation_store.annotated_ids)}")
 
 
     # read collection
@@ -63,58 +64,67 @@ if "initialized" not in st.session_state:
         name=config.COLLECTION_NAME,
     )
     logger.info(f"Number of elements in collection: {collection.count()}")
+    # changes on every collection write, so cached sampler index is rebuilt after items are updated
+    url_index = UrlIndex(config.URL_INDEX_PATH)
+    index_version = url_index.version
+    url_index.close()
 
     # Store variables in session_state to persist across runs
-    st.session_state["annotated_data"] = annotated_data
-    st.session_state["annotated_ids"] = annotated_ids
+    st.session_state["annotation_store"] = annotation_store
     st.session_state["collection"] = collection
-    st.session_state["sampler"] = NamedSampler(
+    sampler = NamedSampler(
         collection=collection, 
         meta_fields=config.ANN_META_FIELDS,
         name=config.ANN_SAMPLER_NAME,
-        cfg=config.ANN_SAMPLER_CFG
+        cfg=config.ANN_SAMPLER_CFG,
+        index_cache_dir=config.SAMPLER_INDEX_DIR,
+        search_name=config.ANN_SEARCH_NAME,
+        search_cfg=config.ANN_SEARCH_CFG,
+        index_version=index_version
+    )
+    sampler.exclude_ids(annotation_store.annotated_ids)
+    # upcoming samples are sampled and their images downloaded in background
+    st.session_state["prefetcher"] = SamplePrefetcher(
+        sampler=sampler,
+        logger=logger,
+        n_nearest=DEFAULT_N_NEAREST,
+        prefetch_size=config.ANNOTATE_PREFETCH_SIZE,
+        fetcher_cfg=config.FETCHER_CFG,
+        cache=ImageCache(**config.IMAGE_CACHE_CFG) if config.IMAGE_CACHE_CFG is not None else None,
+        thumbnail_size=config.ANNOTATE_THUMBNAIL_SIZE
     )
-    st.session_state["sampler"].exclude_ids(annotated_ids)
+    st.session_state["sample"] = None
     st.session_state["initialized"] = True
 
 
-n_nearest = st.slider("Number of nearest elements", 1, 20, 5)
+n_nearest = st.slider("Number of nearest elements", 1, 20, DEFAULT_N_NEAREST)
+st.session_state["prefetcher"].set_n_nearest(n_nearest)
 
 if st.button("Sample"):
-    sample_res = st.session_state["sampler"](n_nearest)
-    if sample_res is None:
+    st.session_state["sample"] = st.session_state["prefetcher"].pop()
+    if st.session_state["sample"] is None:
         st.write("No items remaining")
-    else:
-        main_item, nearest_items = sample_res
-        id2pos_neg = {item.id: False for item in nearest_items}
-        st.header(f"Annotated: {len(st.session_state['annotated_ids'])}/{st.session_state['collection'].count()}")
-        st.subheader("Main Element")
-        st.image(main_item.url, caption=main_item.id)
-        st.write(f"Metadata:", main_item.metadata)
-
-        st.subheader(f"Top {n_nearest} Nearest Elements")
-        for i, item in enumerate(nearest_items):            
-            id2pos_neg[nearest_items[i].id] = st.checkbox(f"Element {i}")
-            st.image(item.url, caption=nearest_items[i].id)
-            st.write("Metadata:", item.metadata)
-
-        
-        if st.button("Save and Proceed"):
-            pos = [id for id, value in id2pos_neg.items() if value] + [main_item.id]
-            neg = [id for id, value in id2pos_neg.items() if not value]
-            st.session_state["annotated_data"].append(
-                {
-                    "pos": pos,
-                    "neg": neg
-                }
-            )
-            st.session_state["annotated_ids"] += pos
-            with open(config.ANNOTATED_DATA_PATH, "w") as f:
-                json.dump(
-                    st.session_state["annotated_data"],
-                    f,
-                    indent=4
-                )
-        
-            st.session_state["sampler"].exclude_ids(pos)
 
+sample = st.session_state["sample"]
+if sample is not None:
+    main_item, nearest_items = sample.main_item, sample.nearest_items
+    id2pos_neg = {item.id: False for item in nearest_items}
+    st.header(f"Annotated: {len(st.session_state['annotation_store'].annotated_ids)}/{st.session_state['collection'].count()}")
+    st.subheader("Main Element")
+    st.image(sample.main_img, caption=main_item.id)
+    st.write(f"Metadata:", main_item.metadata)
+
+    st.subheader(f"Top {len(nearest_items)} Nearest Elements")
+    for i, item in enumerate(nearest_items):
+        id2pos_neg[item.id] = st.checkbox(f"Element {i}", key=f"{main_item.id}_{item.id}")
+        st.image(sample.nearest_imgs[i], caption=item.id)
+        st.write("Metadata:", item.metadata)
+
+    if st.button("Save and Proceed"):
+        pos = [id for id, value in id2pos_neg.items() if value] + [main_item.id]
+        neg = [id for id, value in id2pos_neg.items() if not value]
+        st.session_state["annotation_store"].add(pos, neg)
+
+        st.session_state["prefetcher"].exclude_ids(pos)
+        st.session_state["sample"] = st.session_state["prefetcher"].pop()
+        st.rerun()
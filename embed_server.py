@@ -0,0 +1,79 @@
+import os
+from datetime import datetime
+import logging
+
+import torch
+import chromadb
+from aiohttp import web
+
+import config
+from src.embedders_package import NamedEmbedder
+from src.embedding_server import EmbeddingServer
+from src.image_fetcher import ImageFetcher
+from src.image_cache import ImageCache
+
+log_dir = os.path.join("logs", "embed_server")
+if not os.path.exists(log_dir):
+    os.makedirs(log_dir)
+
+log_filename = datetime.now().strftime('%Y-%m-%d_%H-%M-%S') + '.log'
+log_filepath = os.path.join(log_dir, log_filename)
+
+logging.basicConfig(
+    level=logging.DEBUG,
+    handlers=[
+        logging.FileHandler(log_filepath),
+        logging.StreamHandler()
+    ]
+)
+logging.getLogger("httpcore").setLevel(logging.WARNING)
+logging.getLogger("httpx").setLevel(logging.WARNING)
+logger = logging.getLogger(__name__)
+
+
+def main():
+    logger.info(f"COLLECTION_NAME: {config.COLLECTION_NAME}")
+    logger.info(f"CHROMADB_PATH: {config.CHROMADB_PATH}")
+    logger.info(f"MODEL_NAME: {config.MODEL_NAME}")
+    logger.info(f"SERVE_MODEL_CFG: {config.SERVE_MODEL_CFG}")
+    logger.info(f"SERVE_CFG: {config.SERVE_CFG}")
+    logger.info(f"SERVE_TORCH_THREADS: {config.SERVE_TORCH_THREADS}")
+    logger.info(f"IMAGE_DECODE_CFG: {config.IMAGE_DECODE_CFG}")
+
+    if config.SERVE_TORCH_THREADS > 0:
+        torch.set_num_threads(config.SERVE_TORCH_THREADS)
+
+    db = chromadb.PersistentClient(
+        path=config.CHROMADB_PATH
+    )
+    collection = db.get_collection(
+        name=config.COLLECTION_NAME,
+    )
+    logger.info(f"Number of elements in collection: {collection.count()}")
+
+    cache = ImageCache(**config.IMAGE_CACHE_CFG) if config.IMAGE_CACHE_CFG is not None else None
+    fetcher = ImageFetcher(**config.FETCHER_CFG, cache=cache)
+    embedder = NamedEmbedder(
+        name=config.MODEL_NAME,
+        cfg=config.SERVE_MODEL_CFG,
+        fetcher=fetcher,
+        **config.IMAGE_DECODE_CFG
+    )
+
+    server = EmbeddingServer(
+        embedder=embedder,
+        collection=collection,
+        logger=logger,
+        **config.SERVE_CFG
+    )
+    app = server.app()
+
+    async def close_fetcher(app):
+        await fetcher.aclose()
+    app.on_cleanup.append(close_fetcher)
+
+    web.run_app(app, host=config.SERVE_HOST, port=config.SERVE_PORT, print=logger.info)
+
+
+if __name__ == "__main__":
+    main()
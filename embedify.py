@@ -1,16 +1,24 @@
 import os
-import json
 from datetime import datetime
 import logging
 import asyncio
+import functools
 
 from tqdm import tqdm
+import numpy as np
 import chromadb
-from torch.utils.data import DataLoader
 
 import config
 from src.embedders_package import NamedEmbedder
-from src.embeddify_utils import deduplicate_data, CustomCollate
+from src.embeddify_utils import find_duplicate_urls, drop_duplicates, batched, CustomCollate
+from src.formatted_reader import read_formatted_data
+from src.embeddify_pipeline import EmbeddifyPipeline
+from src.chroma_writer import ChromaWriter
+from src.image_fetcher import ImageFetcher
+from src.image_cache import ImageCache
+from src.url_index import UrlIndex
+from src.failure_ledger import FailureLedger
+from src.near_duplicates import NearDuplicateFilter
 
 log_dir = os.path.join("logs", "embeddify")
 if not os.path.exists(log_dir):
@@ -33,8 +41,89 @@ logger = logging.getLogger(__name__)
 logger.info(f"FORMATTED_DATA_NAME: {config.FORMATTED_DATA_NAME}")
 logger.info(f"COLLECTION_NAME: {config.COLLECTION_NAME}")
 logger.info(f"COLLECTION_METRIC: {config.COLLECTION_METRIC}")
+logger.info(f"EMBEDDIFY_MODE: {config.EMBEDDIFY_MODE}")
+logger.info(f"EMBEDDING_CACHE_DIR: {config.EMBEDDING_CACHE_DIR}")
+logger.info(f"IMAGE_DECODE_CFG: {config.IMAGE_DECODE_CFG}")
+logger.info(f"FAILURE_LEDGER_CFG: {config.FAILURE_LEDGER_CFG}")
+
+
+def stream_remaining(duplicate_urls):
+    """
+    Lazily reads formatted data from the start, dropping duplicates, already embedded items
+    and urls failed recently. Opens its own url index and ledger connections, which are closed once stream ends.
+    """
+    url_index = UrlIndex(config.URL_INDEX_PATH)
+    failures = FailureLedger(config.FAILURE_LEDGER_PATH, **config.FAILURE_LEDGER_CFG)
+    try:
+        data = read_formatted_data(config.FORMATTED_DATA_PATH)
+        yield from failures.filter_retryable(url_index.filter_new(drop_duplicates(data, duplicate_urls)))
+    finally:
+        failures.close()
+        url_index.close()
+
+
+async def run_loader(stream_factory, embedder, writer, failures):
+    """ Sequential fallback: download, embed and write batch by batch """
+    if config.NEAR_DUPLICATE_MAX_DISTANCE is not None:
+        # embedder does not return decoded images, so they can not be hashed here
+        logger.warning("NEAR_DUPLICATE_MAX_DISTANCE is not supported in loader mode, near-duplicate images are embedded too")
+    # formatted data is read and filtered once in the main process: workers reading it in parallel would each have
+    # to parse and filter the whole file, and duplicates dropped there would not get into duplicate_urls report
+    collate = CustomCollate(config.CUSTOM_ID_FIELD)
+    batches = map(collate, batched(stream_factory(), config.BATCH_SIZE))
+    pbar = tqdm()
+    # batches are read lazily from disk, so they are pulled in a thread not to stall the event loop
+    while (batch := await asyncio.to_thread(next, batches, None)) is not None:
+        ids, urls, metas = batch
+        pbar.update(len(ids))
+        url2emb, url2err = await embedder(urls)
+        loaded = [(id, url, meta) for id, url, meta in zip(ids, urls, metas) if url in url2emb]
+        if len(loaded) > 0:
+            loaded_ids, loaded_urls, loaded_metas = zip(*loaded)
+            writer.add(
+                list(loaded_ids),
+                np.stack([url2emb[url] for url in loaded_urls]),
+                list(loaded_metas)
+            )
+            failures.record_success(list(loaded_urls))
+
+        for url, error in url2err.items():
+            logger.error(f"Error for URL {url}: {error}")
+            failures.record_failure(url, error)
+    pbar.close()
+
+
+async def run_pipeline(stream_factory, embedder, writer, failures):
+    """ Overlapped fetch / decode / embed / write stages """
+    collate = CustomCollate(config.CUSTOM_ID_FIELD)
+    batches = map(collate, batched(stream_factory(), config.BATCH_SIZE))
+    pipeline = EmbeddifyPipeline(
+        embedder=embedder,
+        sink=writer,
+        logger=logger,
+        batch_size=config.BATCH_SIZE,
+        fetch_workers=config.PIPELINE_FETCH_WORKERS,
+        decode_workers=config.PIPELINE_DECODE_WORKERS,
+        write_workers=config.PIPELINE_WRITE_WORKERS,
+        queue_size=config.PIPELINE_QUEUE_SIZE,
+        batch_timeout=config.PIPELINE_BATCH_TIMEOUT,
+        near_duplicates=NearDuplicateFilter(config.NEAR_DUPLICATE_MAX_DISTANCE, config.DEDUP_MAX_EXAMPLES)
+            if config.NEAR_DUPLICATE_MAX_DISTANCE is not None else None,
+        failures=failures
+    )
+    await pipeline.run(batches)
+
+
+embedify_mode2runner = {
+    "loader": run_loader,
+    "pipeline": run_pipeline
+}
+
 
 async def main():
+    if config.EMBEDDIFY_MODE not in embedify_mode2runner:
+        raise Exception(f"No embedify mode named {config.EMBEDDIFY_MODE}")
+
     # load data
     db = chromadb.PersistentClient(
         path=config.CHROMADB_PATH
@@ -49,48 +138,48 @@ async def main():
     )
     logger.info(f"Number of elements in collection: {collection.count()}")
 
-
-    with open(config.FORMATTED_DATA_PATH) as f:
-        data = json.load(f)
-    logger.info(f"Number of elements in formatted data: {len(data)}")
-
-    data = deduplicate_data(data, logger)
-
-    collection_urls = [meta["url"] for meta in collection.get(include=["metadatas"])["metadatas"]]
-    data = [item for item in data if item["url"] not in collection_urls]
-    logger.info(f"Number of elements remain to be added: {len(data)}")
-
-    loader = DataLoader(
-        dataset=data,
-        batch_size=config.BATCH_SIZE,
-        shuffle=False,
-        drop_last=False,
-        pin_memory=config.PIN_MEMORY,
-        num_workers=config.NUM_WORKERS,
-        collate_fn=CustomCollate(config.CUSTOM_ID_FIELD)
+    # formatted data is never fully loaded: one pass finds duplicates, another one streams remaining items
+    duplicate_urls = find_duplicate_urls(
+        read_formatted_data(config.FORMATTED_DATA_PATH),
+        logger,
+        max_examples=config.DEDUP_MAX_EXAMPLES
     )
 
+    url_index = UrlIndex(config.URL_INDEX_PATH)
+    url_index.sync(collection, logger)
+    stream_factory = functools.partial(stream_remaining, duplicate_urls)
+    failures = FailureLedger(config.FAILURE_LEDGER_PATH, **config.FAILURE_LEDGER_CFG)
+
     # load model
+    cache = ImageCache(**config.IMAGE_CACHE_CFG) if config.IMAGE_CACHE_CFG is not None else None
+    fetcher = ImageFetcher(**config.FETCHER_CFG, cache=cache)
     embedder = NamedEmbedder(
         name=config.MODEL_NAME, 
-        cfg=config.MODEL_CFG
+        cfg=config.MODEL_CFG,
+        fetcher=fetcher,
+        embedding_cache_dir=config.EMBEDDING_CACHE_DIR,
+        **config.IMAGE_DECODE_CFG
     )
 
-
-    for ids, urls, metas in tqdm(loader):
-        url2emb, url2err = await embedder(urls)
-        if len(url2emb) > 0:
-
-            collection.add(
-                ids=[id for id, url in zip(ids, urls) if url in url2emb],
-                embeddings=[url2emb[url] for url in urls if url in url2emb],
-                metadatas=[meta for meta, url in zip(metas, urls) if url in url2emb]
-            )
-
-        for url, error in url2err.items():
-            logger.error(f"Error for URL {url}: {error}")
-
-
+    writer = ChromaWriter(
+        collection=collection,
+        url_index=url_index,
+        logger=logger,
+        write_batch_size=config.CHROMA_WRITE_BATCH_SIZE,
+        max_batch_size=db.max_batch_size,
+        max_pending=config.CHROMA_WRITE_MAX_PENDING
+    )
+    try:
+        async with fetcher:
+            await embedify_mode2runner[config.EMBEDDIFY_MODE](stream_factory, embedder, writer, failures)
+    finally:
+        # already embedded items are written even if run is interrupted
+        writer.close()
+
+    url_index.close()
+    duplicate_urls.report(logger)
+    failures.report(logger, config.FAILURE_LEDGER_REPORT_TOP)
+    failures.close()
     logger.info(f"Number of elements in collection after embedding: {collection.count()}")
 
 
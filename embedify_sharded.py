@@ -0,0 +1,163 @@
+import os
+from datetime import datetime
+import logging
+import asyncio
+import multiprocessing
+
+import chromadb
+
+import config
+from src.embedders_package import NamedEmbedder
+from src.embeddify_utils import find_duplicate_urls, drop_duplicates, batched, CustomCollate, DuplicateUrls
+from src.embeddify_pipeline import EmbeddifyPipeline
+from src.embeddify_shards import shard_of, StagingWriter, merge_staging
+from src.formatted_reader import read_formatted_data
+from src.image_fetcher import ImageFetcher
+from src.image_cache import ImageCache
+from src.url_index import UrlIndex
+from src.failure_ledger import FailureLedger
+from src.near_duplicates import NearDuplicateFilter
+
+
+def setup_logging(name: str) -> logging.Logger:
+    log_dir = os.path.join("logs", "embeddify")
+    if not os.path.exists(log_dir):
+        os.makedirs(log_dir)
+
+    log_filename = datetime.now().strftime('%Y-%m-%d_%H-%M-%S') + f'_{name}.log'
+    log_filepath = os.path.join(log_dir, log_filename)
+
+    logging.basicConfig(
+        level=logging.DEBUG,
+        handlers=[
+            logging.FileHandler(log_filepath),
+            logging.StreamHandler()
+        ]
+    )
+    logging.getLogger("httpcore").setLevel(logging.WARNING)
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    return logging.getLogger(name)
+
+
+def stream_shard(duplicate_urls: DuplicateUrls, shard: int, n_shards: int):
+    """ Lazily reads items of the shard, dropping duplicates, already embedded ones and urls failed recently """
+    url_index = UrlIndex(config.URL_INDEX_PATH)
+    failures = FailureLedger(config.FAILURE_LEDGER_PATH, **config.FAILURE_LEDGER_CFG)
+    try:
+        data = read_formatted_data(config.FORMATTED_DATA_PATH)
+        data = (item for item in drop_duplicates(data, duplicate_urls) if shard_of(item["url"], n_shards) == shard)
+        yield from failures.filter_retryable(url_index.filter_new(data))
+    finally:
+        failures.close()
+        url_index.close()
+
+
+async def run_shard(shard: int, device: str, duplicate_urls: DuplicateUrls, logger):
+    n_shards = len(config.EMBEDIFY_SHARD_DEVICES)
+    # ids derived from urls, so merging a shard twice does not duplicate items
+    collate = CustomCollate(config.CUSTOM_ID_FIELD, stable_ids=True)
+    batches = map(collate, batched(stream_shard(duplicate_urls, shard, n_shards), config.BATCH_SIZE))
+
+    model_cfg = {**config.MODEL_CFG, "device": device} if "device" in config.MODEL_CFG else config.MODEL_CFG
+    cache = ImageCache(**config.IMAGE_CACHE_CFG) if config.IMAGE_CACHE_CFG is not None else None
+    # every shard has its own connection, sqlite serializes writes of shard processes
+    failures = FailureLedger(config.FAILURE_LEDGER_PATH, **config.FAILURE_LEDGER_CFG)
+    async with ImageFetcher(**config.FETCHER_CFG, cache=cache) as fetcher:
+        embedder = NamedEmbedder(
+            name=config.MODEL_NAME,
+            cfg=model_cfg,
+            fetcher=fetcher,
+            embedding_cache_dir=config.EMBEDDING_CACHE_DIR,
+            **config.IMAGE_DECODE_CFG
+        )
+        pipeline = EmbeddifyPipeline(
+            embedder=embedder,
+            sink=StagingWriter(config.EMBEDIFY_STAGING_DIR, shard),
+            logger=logger,
+            batch_size=config.BATCH_SIZE,
+            fetch_workers=config.PIPELINE_FETCH_WORKERS,
+            decode_workers=config.PIPELINE_DECODE_WORKERS,
+            write_workers=config.PIPELINE_WRITE_WORKERS,
+            queue_size=config.PIPELINE_QUEUE_SIZE,
+            batch_timeout=config.PIPELINE_BATCH_TIMEOUT,
+            near_duplicates=NearDuplicateFilter(config.NEAR_DUPLICATE_MAX_DISTANCE, config.DEDUP_MAX_EXAMPLES)
+                if config.NEAR_DUPLICATE_MAX_DISTANCE is not None else None,
+            failures=failures
+        )
+        try:
+            await pipeline.run(batches)
+        finally:
+            failures.close()
+
+
+def embed_shard(shard: int, device: str, duplicate_urls: DuplicateUrls):
+    """ Entry point of shard process """
+    logger = setup_logging(f"shard_{shard}")
+    logger.info(f"Shard {shard} on device {device}")
+    asyncio.run(run_shard(shard, device, duplicate_urls, logger))
+
+
+def main():
+    logger = setup_logging("sharded")
+    logger.info(f"FORMATTED_DATA_NAME: {config.FORMATTED_DATA_NAME}")
+    logger.info(f"COLLECTION_NAME: {config.COLLECTION_NAME}")
+    logger.info(f"COLLECTION_METRIC: {config.COLLECTION_METRIC}")
+    logger.info(f"EMBEDIFY_SHARD_DEVICES: {config.EMBEDIFY_SHARD_DEVICES}")
+    logger.info(f"EMBEDIFY_STAGING_DIR: {config.EMBEDIFY_STAGING_DIR}")
+    logger.info(f"EMBEDDING_CACHE_DIR: {config.EMBEDDING_CACHE_DIR}")
+    logger.info(f"IMAGE_DECODE_CFG: {config.IMAGE_DECODE_CFG}")
+    logger.info(f"FAILURE_LEDGER_CFG: {config.FAILURE_LEDGER_CFG}")
+
+    db = chromadb.PersistentClient(
+        path=config.CHROMADB_PATH
+    )
+    collection = db.get_or_create_collection(
+        name=config.COLLECTION_NAME,
+        metadata={
+            "hnsw:space": config.COLLECTION_METRIC
+        }
+    )
+    logger.info(f"Number of elements in collection: {collection.count()}")
+
+    url_index = UrlIndex(config.URL_INDEX_PATH)
+    url_index.sync(collection, logger)
+
+    # parts staged by interrupted run are merged first, so they are not embedded again
+    merge_staging(config.EMBEDIFY_STAGING_DIR, collection, url_index, logger)
+
+    duplicate_urls = find_duplicate_urls(
+        read_formatted_data(config.FORMATTED_DATA_PATH),
+        logger,
+        max_examples=config.DEDUP_MAX_EXAMPLES
+    )
+    duplicate_urls.report(logger)
+
+    # spawn: cuda can not be used in forked processes
+    ctx = multiprocessing.get_context("spawn")
+    processes = [
+        ctx.Process(target=embed_shard, args=(shard, device, duplicate_urls), name=f"shard_{shard}")
+        for shard, device in enumerate(config.EMBEDIFY_SHARD_DEVICES)
+    ]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+
+    failed = [process.name for process in processes if process.exitcode != 0]
+    if failed:
+        logger.error(f"Shards failed: {failed}, merging what they have staged")
+
+    merge_staging(config.EMBEDIFY_STAGING_DIR, collection, url_index, logger)
+    url_index.close()
+    logger.info(f"Number of elements in collection after embedding: {collection.count()}")
+
+    failures = FailureLedger(config.FAILURE_LEDGER_PATH, **config.FAILURE_LEDGER_CFG)
+    failures.report(logger, config.FAILURE_LEDGER_REPORT_TOP)
+    failures.close()
+
+    if failed:
+        raise Exception(f"Shards failed: {failed}")
+
+
+if __name__ == "__main__":
+    main()
@@ -4,11 +4,71 @@ import os
 MODEL_NAME = "clip"
 MODEL_CFG = {
     "device": "cuda",
-    "clip_version": "patrickjohncyh/fashion-clip"
+    "clip_version": "patrickjohncyh/fashion-clip",
+    # inference modes (optional)
+    "dtype": "float16",  # float32, float16 (not on cpu), bfloat16 (autocast)
+    "compile": False,  # torch.compile forward pass
+    "channels_last": True,
+    "quantize": False,  # int8 dynamic quantization, cpu only
+    "tensor_preprocess": True,  # resize/crop tensors and normalize on device instead of HF processor
+    "output_dtype": "float32"  # float32, float16
+}
+# cpu-only alternative: image tower exported to onnx and run with onnxruntime
+# MODEL_NAME = "onnx"
+# MODEL_CFG = {
+#     "model": "clip",  # clip, dinov2
+#     "version": "patrickjohncyh/fashion-clip",
+#     "cache_dir": os.path.join("data", "onnx"),
+#     "providers": ["CPUExecutionProvider"],  # or ["OpenVINOExecutionProvider", "CPUExecutionProvider"]
+#     "intra_op_threads": 0,
+#     "inter_op_threads": 0
+# }
+# embeddings cached by model config and image content, reused across collections, None to disable
+EMBEDDING_CACHE_DIR = os.path.join("data", "embedding_cache")
+IMAGE_DECODE_CFG = {
+    "draft": True,  # decode images downscaled to about model input size (JPEG draft mode) instead of full resolution
+    "max_pixels": 64 * 2**20  # images with more pixels to decode are rejected, bounds memory of one image, None to decode any
 }
 BATCH_SIZE = 256
-PIN_MEMORY = True
-NUM_WORKERS = 4
+
+# embedify configs
+EMBEDDIFY_MODE = "pipeline"  # pipeline (overlapped stages), loader (sequential batches read in the main process)
+PIPELINE_FETCH_WORKERS = 64  # concurrent downloads
+PIPELINE_DECODE_WORKERS = 8  # threads decoding images
+PIPELINE_WRITE_WORKERS = 1  # threads handing embedded batches to chroma writer
+PIPELINE_QUEUE_SIZE = 1024  # max items waiting between two stages
+PIPELINE_BATCH_TIMEOUT = 0.1  # max seconds model waits to fill up a batch
+CHROMA_WRITE_BATCH_SIZE = 5000  # items in one chroma write (capped by chroma max batch size)
+CHROMA_WRITE_MAX_PENDING = 4  # write batches waiting before embedding is paused
+EMBEDIFY_SHARD_DEVICES = ["cuda:0", "cuda:1"]  # embedify_sharded.py: one shard process per device
+DEDUP_MAX_EXAMPLES = 20  # number of duplicate urls shown in logs
+NEAR_DUPLICATE_MAX_DISTANCE = None  # max hamming distance of perceptual hashes of near-duplicate images, None to keep them (pipeline mode only)
+
+# image downloading configs (shared by embedify and ann_dirrify)
+FETCHER_CFG = {
+    "max_connections": 128,
+    "max_per_host": 16,
+    "timeout": 30.0,
+    "max_retries": 3,
+    "backoff": 0.5,
+    "http2": True
+}
+# urls failed to download or decode are skipped until their retry time (shared by embedify and ann_dirrify)
+FAILURE_LEDGER_CFG = {
+    "ttl": 3600.0,  # seconds before first retry of transient failure (timeout, 5xx), doubled on every next failure
+    "max_ttl": 30 * 86400.0  # max seconds between retries, permanent failures (404, 410, broken image) wait that long at once
+}
+FAILURE_LEDGER_REPORT_TOP = 20  # number of hosts with most failures shown in report
+
+# local image cache shared by embedify, ann_dirrify and annotate (None to disable)
+IMAGE_CACHE_CFG = {
+    "cache_dir": os.path.join("data", "image_cache"),
+    "max_bytes": 50 * 2**30,
+    "thumbnail_size": None  # max edge of thumbnails created on download, None to create them on demand
+}
+ANNOTATE_THUMBNAIL_SIZE = 512
+ANNOTATE_PREFETCH_SIZE = 8  # samples prepared in background by annotate.py
+ANNOTATION_COMPACT_EVERY = 1000  # annotations appended to log before it is compacted into ANNOTATED_DATA_PATH
 
 CUSTOM_ID_FIELD = "custom_id"
 # data configs
@@ -25,12 +85,88 @@ ANN_META_FIELDS = ["url"]
 
 ANN_SAMPLER_NAME = "meta_weighted_rand"
 ANN_SAMPLER_CFG = {
-    "meta_fields": "url"
+    "meta_fields": "url",
+    "weighting": "uniform",  # uniform over categories / inverse_frequency / temperature
+    # "temperature": 2.0,  # only for temperature weighting: 1 - proportional to category size, larger - closer to uniform
 }
 
+# ANN_SAMPLER_NAME = "cluster_weighted_rand"
+# ANN_SAMPLER_CFG = {
+#     "n_clusters": 100,
+#     "train_size": 0.1,  # int - number of items, float - fraction of collection
+#     "batch_size": 4096,  # vectors per MiniBatchKMeans step
+#     "max_iter": 3,  # epochs over training items
+#     "random_state": 42,
+#     "weighting": "uniform",  # cluster-balanced, see meta_weighted_rand
+#     "cache_dir": os.path.join("data", "embedded", "clusters")  # saved centroids and assignments keyed by collection id, None to refit every time
+# }
+
+# neighbour search used by samplers: chroma (collection.query), exact (brute force over cached embeddings), faiss, hnswlib
+ANN_SEARCH_NAME = "chroma"
+ANN_SEARCH_CFG = {}
+# ANN_SEARCH_NAME = "exact"
+# ANN_SEARCH_CFG = {"chunk_size": 65536}
+# ANN_SEARCH_NAME = "faiss"
+# ANN_SEARCH_CFG = {
+#     "index_type": "hnsw",  # hnsw: M, ef_construction, ef_search / ivf: nlist, nprobe, train_size
+#     "M": 32,
+#     "ef_construction": 200,
+#     "ef_search": 64,
+#     "cache_dir": os.path.join("data", "embedded", "search")  # built index is reused, None to rebuild every time
+# }
+# ANN_SEARCH_NAME = "hnswlib"
+# ANN_SEARCH_CFG = {"M": 32, "ef_construction": 200, "ef_search": 64, "threads": -1, "cache_dir": os.path.join("data", "embedded", "search")}
+
+# search_benchmark.py: recall@k against exact search and latency of every backend
+SEARCH_BENCHMARK_BACKENDS = [
+    {"name": "chroma"},
+    {"name": "exact"},
+    {"name": "faiss", "cfg": {"index_type": "hnsw", "ef_search": 64}},
+    {"name": "faiss", "cfg": {"index_type": "ivf", "nlist": 1024, "nprobe": 16}},
+    {"name": "hnswlib", "cfg": {"ef_search": 64}}
+]
+SEARCH_BENCHMARK_NQUERIES = 1000
+SEARCH_BENCHMARK_K = 21  # ANN_DIRRIFY_NNEAREST + 1, queried item itself is found too
+SEARCH_BENCHMARK_BATCH_SIZE = 32
+
+SAMPLER_INDEX_DIR = os.path.join("data", "sampler_index")  # cache of ids, metadata and embeddings for samplers, None to disable
+
 ANN_DIRRIFY_DIR_PATH = os.path.join("data", "dirrify", "tmp")
 ANN_DIRRIFY_NDIRS = 1000
 ANN_DIRRIFY_NNEAREST = 20
+ANN_DIRRIFY_BATCH_SIZE = 32  # directories sampled with one batched query
+ANN_DIRRIFY_DIRS_IN_FLIGHT = 8  # directories exported concurrently
+ANN_DIRRIFY_MAX_DOWNLOADS = 64  # images downloaded concurrently across all directories
+ANN_DIRRIFY_PROCESS_WORKERS = 4  # processes re-encoding images and drawing contact sheets
+# images are downsized to max_edge and re-encoded instead of saving originals, None to save originals
+ANN_DIRRIFY_IMAGE_CFG = {
+    "max_edge": 1024,
+    "format": "JPEG",  # JPEG, WEBP
+    "quality": 85
+}
+# one grid image of numbered tiles per directory, saved to ANN_DIRRIFY_CONTACT_SHEET_DIR_PATH, None to disable
+ANN_DIRRIFY_CONTACT_SHEET_CFG = {
+    "tile_size": 256,
+    "columns": 6,
+    "format": "JPEG",
+    "quality": 85
+}
+ANN_DIRLOAD_MODE = "once"  # once (load all directories), watch (load every directory once done marker is created in it)
+ANN_DIRLOAD_DONE_MARKER = "done"  # empty file annotator creates in finished directory, ignored as image
+ANN_DIRLOAD_WORKERS = 16  # threads reading directories in once mode
+
+# embed_server.py: http service embedding image / text queries and searching them in COLLECTION_NAME
+SERVE_HOST = "127.0.0.1"
+SERVE_PORT = 8080
+SERVE_MODEL_CFG = {**MODEL_CFG, "device": "cpu", "dtype": "float32"}  # same model as the collection on cpu, MODEL_CFG for onnx
+SERVE_CFG = {
+    "max_batch_size": 32,  # max queries in one model forward
+    "max_wait": 0.01,  # max seconds first query of a batch waits for others
+    "cache_size": 10000,  # cached embeddings of repeated queries, 0 to disable
+    "default_k": 20,
+    "max_k": 1000
+}
+SERVE_TORCH_THREADS = 0  # threads of cpu forward, 0 for torch default
 
 # default paths
 FORMATTED_DIR = "data/formatted"
@@ -39,9 +175,15 @@ ANNOTATED_DIR = "data/annotated"
 CHROMADB_NAME = "chroma"
 
 
-FORMATTED_DATA_PATH = os.path.join(FORMATTED_DIR, f"{FORMATTED_DATA_NAME}.json")
+FORMATTED_DATA_PATH = os.path.join(FORMATTED_DIR, f"{FORMATTED_DATA_NAME}.json")  # .json, .jsonl, .parquet or .arrow
 CHROMADB_PATH = os.path.join(EMBEDDED_DIR, f"{CHROMADB_NAME}")
 ANNOTATED_DATA_PATH = os.path.join(ANNOTATED_DIR, f"{ANNOTATED_DATA_NAME}.json")
+ANNOTATED_LOG_PATH = os.path.join(ANNOTATED_DIR, f"{ANNOTATED_DATA_NAME}.log.jsonl")  # annotations appended after last compaction into ANNOTATED_DATA_PATH
+URL_INDEX_PATH = os.path.join(EMBEDDED_DIR, f"{COLLECTION_NAME}_urls.sqlite")
+FAILURE_LEDGER_PATH = os.path.join(EMBEDDED_DIR, "failed_urls.sqlite")  # urls are not collection specific, so ledger is shared
+EMBEDIFY_STAGING_DIR = os.path.join(EMBEDDED_DIR, "staging", COLLECTION_NAME)
+ANN_DIRLOAD_STATE_PATH = f"{ANN_DIRRIFY_DIR_PATH}_dirload.sqlite"  # committed directories of the export
+ANN_DIRRIFY_CONTACT_SHEET_DIR_PATH = f"{ANN_DIRRIFY_DIR_PATH}_contact_sheets"  # outside of ANN_DIRRIFY_DIR_PATH, so ann_dirload does not see sheets
 
 
 
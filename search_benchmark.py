@@ -0,0 +1,94 @@
+import os
+import time
+from datetime import datetime
+import logging
+
+import numpy as np
+import chromadb
+
+import config
+from src.samplers_package.index import SamplerIndex
+from src.samplers_package.named_sampler import name2search_class
+
+log_dir = os.path.join("logs", "search_benchmark")
+if not os.path.exists(log_dir):
+    os.makedirs(log_dir)
+
+log_filename = datetime.now().strftime('%Y-%m-%d_%H-%M-%S') + '.log'
+log_filepath = os.path.join(log_dir, log_filename)
+
+logging.basicConfig(
+    level=logging.DEBUG,
+    handlers=[
+        logging.FileHandler(log_filepath),
+        logging.StreamHandler()
+    ]
+)
+logger = logging.getLogger(__name__)
+
+
+def recall_at_k(found: np.ndarray, exact: np.ndarray) -> float:
+    """ Mean fraction of exact top-k positions found by approximate search """
+    hits = [len(set(f[f != -1].tolist()) & set(e[e != -1].tolist())) / max((e != -1).sum(), 1) for f, e in zip(found, exact)]
+    return float(np.mean(hits))
+
+
+def benchmark(search, queries: np.ndarray, k: int, batch_size: int) -> dict:
+    """ Searches queries batch by batch, returns found positions and latencies of batches in ms """
+    found, latencies = [], []
+    for start in range(0, len(queries), batch_size):
+        t = time.perf_counter()
+        positions, _ = search.search(queries[start: start + batch_size], k)
+        latencies.append((time.perf_counter() - t) * 1000)
+        found.append(positions)
+    return {"positions": np.concatenate(found), "latencies": np.array(latencies)}
+
+
+def main():
+    logger.info(f"COLLECTION_NAME: {config.COLLECTION_NAME}")
+    logger.info(f"CHROMADB_PATH: {config.CHROMADB_PATH}")
+    logger.info(f"SEARCH_BENCHMARK_BACKENDS: {config.SEARCH_BENCHMARK_BACKENDS}")
+    logger.info(f"SEARCH_BENCHMARK_NQUERIES: {config.SEARCH_BENCHMARK_NQUERIES}")
+    logger.info(f"SEARCH_BENCHMARK_K: {config.SEARCH_BENCHMARK_K}")
+    logger.info(f"SEARCH_BENCHMARK_BATCH_SIZE: {config.SEARCH_BENCHMARK_BATCH_SIZE}")
+
+    db = chromadb.PersistentClient(path=config.CHROMADB_PATH)
+    collection = db.get_collection(name=config.COLLECTION_NAME)
+    index = SamplerIndex(collection, cache_dir=config.SAMPLER_INDEX_DIR)
+    logger.info(f"Number of elements in collection: {len(index)}")
+
+    # queries are collection items, the same way samplers query
+    rng = np.random.default_rng(0)
+    query_positions = np.sort(rng.choice(len(index), size=min(config.SEARCH_BENCHMARK_NQUERIES, len(index)), replace=False))
+    queries = np.asarray(index.embeddings[query_positions], dtype=np.float32)
+    k = config.SEARCH_BENCHMARK_K
+
+    exact = name2search_class["exact"](collection, index, {})
+    exact_positions = benchmark(exact, queries, k, config.SEARCH_BENCHMARK_BATCH_SIZE)["positions"]
+
+    rows = []
+    for backend in config.SEARCH_BENCHMARK_BACKENDS:
+        name, cfg = backend["name"], backend.get("cfg", {})
+        t = time.perf_counter()
+        search = name2search_class[name](collection, index, cfg)
+        build_time = time.perf_counter() - t
+
+        res = benchmark(search, queries, k, config.SEARCH_BENCHMARK_BATCH_SIZE)
+        latencies = res["latencies"]
+        rows.append({
+            "backend": f"{name} {cfg}",
+            "build_s": build_time,
+            f"recall@{k}": recall_at_k(res["positions"], exact_positions),
+            "p50_ms": float(np.percentile(latencies, 50)),
+            "p99_ms": float(np.percentile(latencies, 99)),
+            "qps": len(queries) / (latencies.sum() / 1000)
+        })
+        logger.info(f"{rows[-1]}")
+
+    logger.info(f"Batches of {config.SEARCH_BENCHMARK_BATCH_SIZE} queries, latency is per batch:")
+    for row in rows:
+        logger.info(" | ".join(f"{key}: {value:.4g}" if isinstance(value, float) else f"{key}: {value}" for key, value in row.items()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,147 @@
+from typing import List, Set, Iterator, Tuple
+import json
+import os
+import time
+
+
+def read_snapshot(path: str) -> list:
+    """ Annotations of compacted json, empty if it does not exist """
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        return json.load(f)
+
+
+def read_log(log_path: str, n_compacted: int) -> Iterator[dict]:
+    """
+    Yields annotations appended after compaction. Every log line has seq - its position in the full list,
+    so lines already compacted into snapshot (if process died before log was truncated) are skipped.
+    Torn last line of crashed process is skipped too.
+    """
+    if not os.path.exists(log_path):
+        return
+    with open(log_path) as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if entry["seq"] >= n_compacted:
+                yield entry
+
+
+def _drop_torn_tail(log_path: str):
+    """ Removes unfinished last line of crashed process, so new lines are not appended to it """
+    if not os.path.exists(log_path):
+        return
+    with open(log_path, "rb+") as f:
+        content = f.read()
+        if content and not content.endswith(b"\n"):
+            f.truncate(content.rfind(b"\n") + 1)
+
+
+def _load(path: str, log_path: str) -> Tuple[Set[str], int, int]:
+    """ Positive ids, number of annotations and number of not compacted ones """
+    snapshot = read_snapshot(path)
+    annotated_ids = {pos for ann in snapshot for pos in ann["pos"]}
+    n_logged = 0
+    for entry in read_log(log_path, len(snapshot)):
+        annotated_ids.update(entry["pos"])
+        n_logged += 1
+    return annotated_ids, len(snapshot) + n_logged, n_logged
+
+
+def load_annotated_ids(path: str, log_path: str) -> Set[str]:
+    """ Positive ids of snapshot and log, for readers not appending annotations """
+    return _load(path, log_path)[0]
+
+
+class AnnotationStore:
+    """
+    Annotations are appended to jsonl log, one line per annotation, instead of rewriting the whole json on every save.
+    Lines are flushed on every append (survive crash of the process) and fsynced in batches (survive crash of the machine).
+    Log is periodically compacted into json at path in the same format as before:
+        [{"pos": [...], "neg": [...]}, ...]
+    annotated_ids (positive ids) is loaded once and updated on every append.
+    Store has to be used by one process at a time.
+    """
+    def __init__(
+            self,
+            path: str,
+            log_path: str,
+            logger,
+            sync_every: int = 32,
+            sync_interval: float = 1.0,
+            compact_every: int = 10000
+        ):
+        """
+            path - compacted json, log_path - jsonl log of annotations appended after compaction
+            sync_every, sync_interval - log is fsynced after that many appends or seconds since last fsync
+            compact_every - log is compacted into json once it has that many annotations, 0 to compact only on close
+        """
+        self.path = path
+        self.log_path = log_path
+        self.logger = logger
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+        self.compact_every = compact_every
+
+        _drop_torn_tail(log_path)
+        self.annotated_ids, self.n_annotations, self.n_logged = _load(path, log_path)
+        self.n_unsynced = 0
+        self.last_sync = time.monotonic()
+        self.log = open(log_path, "a")
+
+    def __len__(self) -> int:
+        return self.n_annotations
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def add(self, pos: List[str], neg: List[str]):
+        """ Appends annotation """
+        self.log.write(json.dumps({"seq": self.n_annotations, "pos": pos, "neg": neg}) + "\n")
+        self.log.flush()
+        self.n_annotations += 1
+        self.n_logged += 1
+        self.n_unsynced += 1
+        self.annotated_ids.update(pos)
+
+        if self.n_unsynced >= self.sync_every or time.monotonic() - self.last_sync >= self.sync_interval:
+            self.sync()
+        if self.compact_every and self.n_logged >= self.compact_every:
+            self.compact()
+
+    def sync(self):
+        """ Forces appended annotations to disk """
+        if self.n_unsynced == 0:
+            return
+        os.fsync(self.log.fileno())
+        self.n_unsynced = 0
+        self.last_sync = time.monotonic()
+
+    def compact(self):
+        """ Writes snapshot and log into new json atomically, then truncates log """
+        self.sync()
+        if self.n_logged == 0:
+            return
+
+        snapshot = read_snapshot(self.path)
+        annotations = snapshot + [{"pos": entry["pos"], "neg": entry["neg"]} for entry in read_log(self.log_path, len(snapshot))]
+        with open(self.path + ".tmp", "w") as f:
+            json.dump(annotations, f, indent=4)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(self.path + ".tmp", self.path)
+
+        # if process dies here, lines left in log are skipped by their seq on next load
+        self.log.truncate(0)
+        self.n_logged = 0
+        self.logger.info(f"Compacted {len(annotations)} annotations into {self.path}")
+
+    def close(self):
+        self.compact()
+        self.log.close()
@@ -0,0 +1,126 @@
+from typing import List, Optional
+import threading
+import queue
+import time
+
+import numpy as np
+import chromadb
+
+from .url_index import UrlIndex
+
+
+# marks the end of writes inside the queue
+_STOP = None
+
+
+class ChromaWriter:
+    """
+    Coalesces small embedded batches into large collection writes done by a background thread.
+    add() blocks while max_pending write batches are waiting, which applies backpressure to embedding.
+    Writes are upserts, so a retried write after partial failure does not duplicate items.
+    """
+    def __init__(
+            self,
+            collection: chromadb.Collection,
+            url_index: UrlIndex,
+            logger,
+            write_batch_size: int = 5000,
+            max_batch_size: Optional[int] = None,
+            max_pending: int = 4,
+            max_retries: int = 3,
+            backoff: float = 1.0
+        ):
+        """
+            write_batch_size - number of items in one collection write
+            max_batch_size - max batch size chroma accepts (client.max_batch_size), caps write_batch_size
+            max_pending - number of write batches waiting for the background thread
+            max_retries - number of retries of failed write
+            backoff - delay before first retry in seconds, doubled on every next one
+        """
+        self.collection = collection
+        self.url_index = url_index
+        self.logger = logger
+        self.write_batch_size = min(write_batch_size, max_batch_size) if max_batch_size else write_batch_size
+        self.max_retries = max_retries
+        self.backoff = backoff
+
+        self.lock = threading.Lock()
+        self.ids: List[str] = []
+        self.embs: List[np.ndarray] = []
+        self.metas: List[dict] = []
+
+        self.n_written = 0
+        self.error: Optional[BaseException] = None
+        self.queue = queue.Queue(max_pending)
+        self.thread = threading.Thread(target=self._run, name="chroma_writer", daemon=True)
+        self.thread.start()
+
+    def add(self, ids: List[str], embs: np.ndarray, metas: List[dict]):
+        """ Buffers embedded batch, blocks if background thread is behind """
+        with self.lock:
+            self.ids.extend(ids)
+            self.embs.append(embs)
+            self.metas.extend(metas)
+            if len(self.ids) < self.write_batch_size:
+                return
+            batches = self._take_buffer()
+        for batch in batches:
+            self._put(batch)
+
+    def _take_buffer(self) -> list:
+        """ Splits buffer into write batches, has to be called under lock """
+        embs = np.concatenate(self.embs) if self.embs else np.empty((0, 0), dtype=np.float32)
+        batches = [
+            (self.ids[i: i + self.write_batch_size], embs[i: i + self.write_batch_size], self.metas[i: i + self.write_batch_size])
+            for i in range(0, len(self.ids), self.write_batch_size)
+        ]
+        self.ids, self.embs, self.metas = [], [], []
+        return batches
+
+    def _put(self, item):
+        while True:
+            if self.error is not None:
+                raise self.error
+            try:
+                self.queue.put(item, timeout=1.0)
+                return
+            except queue.Full:
+                continue
+
+    def _write(self, ids: List[str], embs: np.ndarray, metas: List[dict]):
+        for attempt in range(self.max_retries + 1):
+            try:
+                self.collection.upsert(ids=ids, embeddings=embs.tolist(), metadatas=metas)
+                break
+            except Exception as e:
+                if attempt == self.max_retries:
+                    raise
+                self.logger.warning(f"Collection write of {len(ids)} elements failed: {e}, retrying ...")
+                time.sleep(self.backoff * 2 ** attempt)
+        self.url_index.add(ids, [meta["url"] for meta in metas])
+        self.n_written += len(ids)
+
+    def _run(self):
+        while (item := self.queue.get()) is not _STOP:
+            try:
+                self._write(*item)
+            except BaseException as e:
+                self.error = e
+                self.logger.error(f"Collection writer stopped: {e}")
+                return
+
+    def flush(self):
+        """ Sends partially filled buffer to the background thread """
+        with self.lock:
+            batches = self._take_buffer()
+        for batch in batches:
+            self._put(batch)
+
+    def close(self):
+        """ Writes everything buffered and waits for the background thread """
+        self.flush()
+        self._put(_STOP)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+        self.logger.info(f"Collection writer finished, written {self.n_written} elements")
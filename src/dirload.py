@@ -0,0 +1,75 @@
+from typing import List, Tuple, Set, Optional
+import os
+import sqlite3
+import threading
+import time
+
+
+def dir_main_id(dir_name: str) -> str:
+    """ Directories are named "{dir index}_{main img id}" """
+    return dir_name.split("_")[-1]
+
+
+def file_item_id(file_name: str) -> str:
+    """ Images are named "{img index}_{img id}.{ext}" """
+    return file_name.split(".")[0].split("_")[-1]
+
+
+def read_annotated_dir(dir_path: str, sample_ids: List[str], done_marker: Optional[str], logger) -> Tuple[List[str], List[str]]:
+    """
+    Returns (pos, neg): sample ids whose images are left in directory are positives, deleted ones are negatives.
+    Done marker file is not an image, so it is ignored.
+    """
+    item_ids: Set[str] = set()
+    sample_id_set = set(sample_ids)
+    with os.scandir(dir_path) as entries:
+        for entry in entries:
+            if entry.name == done_marker:
+                continue
+            item_id = file_item_id(entry.name)
+            item_ids.add(item_id)
+            # little extra check
+            if item_id not in sample_id_set:
+                logger.warning(f"Name {item_id} of file {entry.name} in directory {dir_path} is not in samples.json")
+
+    pos = [id for id in sample_ids if id in item_ids]
+    neg = [id for id in sample_ids if id not in item_ids]
+    return pos, neg
+
+
+class DirloadState:
+    """
+    Persistent per-directory state of dirload, stored in sqlite next to the export directory.
+    Directory is committed once, so restarted or concurrent runs do not load it twice.
+    """
+    def __init__(self, path: str):
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS dirs ("
+            "name TEXT PRIMARY KEY, state TEXT NOT NULL, n_pos INTEGER, n_neg INTEGER, updated REAL NOT NULL"
+            ") WITHOUT ROWID"
+        )
+        self.conn.commit()
+
+    def state(self, dir_name: str) -> Optional[str]:
+        with self.lock:
+            row = self.conn.execute("SELECT state FROM dirs WHERE name = ?", (dir_name,)).fetchone()
+        return row[0] if row is not None else None
+
+    def committed(self) -> Set[str]:
+        with self.lock:
+            return {name for name, in self.conn.execute("SELECT name FROM dirs WHERE state = 'committed'")}
+
+    def mark(self, dir_name: str, state: str, n_pos: Optional[int] = None, n_neg: Optional[int] = None):
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO dirs (name, state, n_pos, n_neg, updated) VALUES (?, ?, ?, ?, ?)",
+                (dir_name, state, n_pos, n_neg, time.time())
+            )
+            self.conn.commit()
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
@@ -1,3 +1,4 @@
-from .base import BaseImgEmbedder
+from .base import BaseImgEmbedder, TorchImgEmbedder
 from .clip import CLIPEmbedder
-from .dinov2 import DinoV2Embedder
\ No newline at end of file
+from .dinov2 import DinoV2Embedder
+from .onnx_runtime import ONNXEmbedder, check_parity
\ No newline at end of file
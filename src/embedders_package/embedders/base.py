@@ -1,9 +1,119 @@
 from abc import ABC, abstractmethod
-from typing import List
+from typing import List, Tuple, Optional
 from PIL import Image
+import numpy as np
+import torch
+from torchvision.transforms import InterpolationMode
+from torchvision.transforms.v2 import functional as F
+
+
+name2dtype = {
+    "float32": torch.float32,
+    "float16": torch.float16,
+    "bfloat16": torch.bfloat16
+}
 
 
 class BaseImgEmbedder(ABC):
+    # shortest edge images are resized to before the model, None if unknown
+    input_size: Optional[int] = None
+
+    @abstractmethod
+    def __call__(self, imgs: List[Image.Image]) -> np.ndarray:
+        """ Returns contiguous (n_imgs, dim) array of embeddings """
+        pass
+
+
+class TorchImgEmbedder(BaseImgEmbedder):
+    """
+    Inference modes shared by HF image towers, all of them are set through MODEL_CFG:
+        dtype - autocast dtype of forward pass: float32 (no autocast), float16 (not on cpu) or bfloat16
+        compile - wrap forward pass with torch.compile
+        channels_last - keep model and inputs in channels last memory format
+        quantize - int8 dynamic quantization of linear layers, cpu only
+        tensor_preprocess - resize/crop uint8 tensors and normalize them on device instead of HF processor
+        output_dtype - dtype of returned embeddings: float32 or float16
+    """
+    def __init__(
+            self,
+            device: str,
+            dtype: str = "float32",
+            compile: bool = False,
+            channels_last: bool = False,
+            quantize: bool = False,
+            tensor_preprocess: bool = False,
+            output_dtype: str = "float32"
+        ):
+        if dtype not in name2dtype:
+            raise ValueError(f"dtype has to be one of {list(name2dtype)} not: {dtype}")
+        if output_dtype not in ("float32", "float16"):
+            raise ValueError(f"output_dtype has to be float32 or float16 not: {output_dtype}")
+        if quantize and torch.device(device).type != "cpu":
+            raise ValueError(f"quantize is supported only on cpu not: {device}")
+        if dtype == "float16" and torch.device(device).type == "cpu":
+            # cpu autocast does not support float16, torch would only warn and run float32
+            raise ValueError("dtype float16 is not supported on cpu, use bfloat16")
+
+        self.device = device
+        self.dtype = name2dtype[dtype]
+        self.compile = compile
+        self.channels_last = channels_last
+        self.quantize = quantize
+        self.tensor_preprocess = tensor_preprocess
+        self.output_dtype = np.dtype(output_dtype)
+
+    def _setup(self, model: torch.nn.Module, image_processor):
+        """ Has to be called by subclass after model and processor are loaded """
+        model.eval()
+        if self.quantize:
+            model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+        if self.channels_last:
+            model = model.to(memory_format=torch.channels_last)
+        self.model = model
+
+        self.image_processor = image_processor
+        self.resize_size, self.crop_size = self._processor_sizes(image_processor)
+        self.input_size = self.resize_size
+        self.mean = torch.tensor(image_processor.image_mean, device=self.device).view(1, -1, 1, 1)
+        self.std = torch.tensor(image_processor.image_std, device=self.device).view(1, -1, 1, 1)
+
+        self.forward = torch.compile(self._forward) if self.compile else self._forward
+
+    @staticmethod
+    def _processor_sizes(image_processor) -> Tuple[int, List[int]]:
+        """ Shortest edge to resize to and (height, width) of center crop used by HF processor """
+        size = image_processor.size
+        resize_size = size["shortest_edge"] if "shortest_edge" in size else min(size["height"], size["width"])
+        crop_size = image_processor.crop_size
+        return resize_size, [crop_size["height"], crop_size["width"]]
+
     @abstractmethod
-    def __call__(self, imgs: List[Image.Image]) -> List[List[float]]:
-        pass
\ No newline at end of file
+    def _forward(self, pixel_values: torch.Tensor) -> torch.Tensor:
+        pass
+
+    def _preprocess(self, images: List[Image.Image]) -> torch.Tensor:
+        if not self.tensor_preprocess:
+            return self.image_processor(images=images, return_tensors="pt")["pixel_values"].to(self.device)
+
+        # resize and crop stay uint8 on cpu, rescaling and normalization are done batched on device
+        tensors = []
+        for img in images:
+            tensor = F.pil_to_tensor(img)
+            tensor = F.resize(tensor, self.resize_size, interpolation=InterpolationMode.BICUBIC, antialias=True)
+            tensors.append(F.center_crop(tensor, self.crop_size))
+        batch = torch.stack(tensors).to(self.device, non_blocking=True)
+        return (batch.float() / 255 - self.mean) / self.std
+
+    @torch.no_grad()
+    def __call__(self, images: List[Image.Image]) -> np.ndarray:
+        pixel_values = self._preprocess(images)
+        if self.channels_last:
+            pixel_values = pixel_values.contiguous(memory_format=torch.channels_last)
+
+        with torch.autocast(
+                device_type=torch.device(self.device).type,
+                dtype=self.dtype,
+                enabled=self.dtype != torch.float32
+            ):
+            embs = self.forward(pixel_values)
+        return np.ascontiguousarray(embs.float().cpu().numpy(), dtype=self.output_dtype)
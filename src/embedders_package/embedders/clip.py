@@ -1,22 +1,31 @@
 from typing import List
-from PIL import Image
+import numpy as np
 import torch
 from transformers import CLIPProcessor, CLIPModel
 
-from .base import BaseImgEmbedder
+from .base import TorchImgEmbedder
 
 
-class CLIPEmbedder(BaseImgEmbedder):
-    def __init__(self, clip_version, device):
-        self.model = CLIPModel.from_pretrained(clip_version).to(device)
-        self.model.eval()
+class CLIPEmbedder(TorchImgEmbedder):
+    def __init__(self, clip_version, device, **inference_cfg):
+        super().__init__(device, **inference_cfg)
+        model = CLIPModel.from_pretrained(clip_version).to(device)
         self.processor = CLIPProcessor.from_pretrained(clip_version)
-        self.device = device
+        self._setup(model, self.processor.image_processor)
 
 
+    def _forward(self, pixel_values: torch.Tensor) -> torch.Tensor:
+        return self.model.get_image_features(pixel_values=pixel_values)
+
     @torch.no_grad()
-    def __call__(self, images: List[Image.Image]) -> List[List[float]]:
-        processed = self.processor(images=images, return_tensors="pt")
-        embs = self.model.get_image_features(pixel_values=processed["pixel_values"].to(self.device))
-        return embs.tolist()
+    def embed_texts(self, texts: List[str]) -> np.ndarray:
+        """ Text embeddings in the same space as image ones, for query by text """
+        inputs = self.processor(text=texts, return_tensors="pt", padding=True, truncation=True).to(self.device)
+        with torch.autocast(
+                device_type=torch.device(self.device).type,
+                dtype=self.dtype,
+                enabled=self.dtype != torch.float32
+            ):
+            embs = self.model.get_text_features(**inputs)
+        return np.ascontiguousarray(embs.float().cpu().numpy(), dtype=self.output_dtype)
 
@@ -1,22 +1,17 @@
-from typing import List
-from PIL import Image
 import torch
 from transformers import AutoImageProcessor, AutoModel
 
-from .base import BaseImgEmbedder
+from .base import TorchImgEmbedder
 
 
-class DinoV2Embedder(BaseImgEmbedder):
-    def __init__(self, dino_version, device):
+class DinoV2Embedder(TorchImgEmbedder):
+    def __init__(self, dino_version, device, **inference_cfg):
+        super().__init__(device, **inference_cfg)
         self.processor = AutoImageProcessor.from_pretrained(dino_version)
-        self.model = AutoModel.from_pretrained(dino_version).to(device)
-        self.model.eval()
-        self.device = device
+        model = AutoModel.from_pretrained(dino_version).to(device)
+        self._setup(model, self.processor)
 
 
-    @torch.no_grad()
-    def __call__(self, images: List[Image.Image]) -> List[List[float]]:
-        processed = self.processor(images=images, return_tensors="pt")
-        outputs = self.model(pixel_values=processed["pixel_values"].to(self.device))
-        return outputs.pooler_output.tolist()
+    def _forward(self, pixel_values: torch.Tensor) -> torch.Tensor:
+        return self.model(pixel_values=pixel_values).pooler_output
 
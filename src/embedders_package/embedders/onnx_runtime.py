@@ -0,0 +1,135 @@
+from typing import List, Optional, Callable, Dict
+import os
+from PIL import Image
+import numpy as np
+import torch
+from transformers import AutoImageProcessor
+
+from .base import BaseImgEmbedder, TorchImgEmbedder
+from .clip import CLIPEmbedder
+from .dinov2 import DinoV2Embedder
+
+
+# torch embedders image towers are exported from, always in float32 on cpu
+name2torch_embedder: Dict[str, Callable[[str], TorchImgEmbedder]] = {
+    "clip": lambda version: CLIPEmbedder(clip_version=version, device="cpu"),
+    "dinov2": lambda version: DinoV2Embedder(dino_version=version, device="cpu")
+}
+
+
+class _TowerModule(torch.nn.Module):
+    """ Wraps forward pass of torch embedder into module for export """
+    def __init__(self, embedder: TorchImgEmbedder):
+        super().__init__()
+        self.embedder = embedder
+        self.model = embedder.model
+
+    def forward(self, pixel_values: torch.Tensor) -> torch.Tensor:
+        return self.embedder._forward(pixel_values)
+
+
+def random_images(n: int, size: int = 256, seed: int = 0) -> List[Image.Image]:
+    """ Synthetic images for parity checks """
+    rng = np.random.default_rng(seed)
+    return [Image.fromarray(rng.integers(0, 256, (size, size, 3), dtype=np.uint8)) for _ in range(n)]
+
+
+def check_parity(reference: BaseImgEmbedder, embedder: BaseImgEmbedder, images: List[Image.Image], min_cosine: float = 0.999) -> float:
+    """
+    Compares embeddings of two embedders on the same images, so switching backend does not
+    silently change vector space. Returns the lowest cosine similarity, raises if it is below min_cosine.
+    """
+    expected = reference(images).astype(np.float32)
+    actual = embedder(images).astype(np.float32)
+    if expected.shape != actual.shape:
+        raise ValueError(f"Embeddings shapes differ: {expected.shape} != {actual.shape}")
+
+    cosine = (expected * actual).sum(axis=1) / (np.linalg.norm(expected, axis=1) * np.linalg.norm(actual, axis=1))
+    worst = float(cosine.min())
+    if worst < min_cosine:
+        raise ValueError(f"Embeddings differ from reference: min cosine similarity {worst} < {min_cosine}")
+    return worst
+
+
+class ONNXEmbedder(BaseImgEmbedder):
+    """
+    Runs CLIP or DINOv2 image tower with ONNX Runtime, for cpu-only machines.
+    Tower is exported from the torch embedder once and cached in cache_dir, right after export
+    it is checked for parity with torch on synthetic images.
+    OpenVINO is used by passing providers=["OpenVINOExecutionProvider", "CPUExecutionProvider"].
+    """
+    def __init__(
+            self,
+            model: str,
+            version: str,
+            cache_dir: str,
+            providers: Optional[List[str]] = None,
+            intra_op_threads: int = 0,
+            inter_op_threads: int = 0,
+            opset: int = 17,
+            output_dtype: str = "float32",
+            parity_check: bool = True
+        ):
+        """
+            model - name of torch embedder to export: clip or dinov2
+            version - HF name of the model
+            cache_dir - directory of exported models
+            providers - onnxruntime execution providers, cpu by default
+            intra_op_threads, inter_op_threads - onnxruntime thread pools sizes, 0 means default
+            opset - onnx opset version used for export
+            output_dtype - dtype of returned embeddings: float32 or float16
+            parity_check - check exported model against torch right after export
+        """
+        import onnxruntime as ort
+
+        if model not in name2torch_embedder:
+            raise Exception(f"No model named {model} to export")
+
+        self.processor = AutoImageProcessor.from_pretrained(version)
+        self.input_size = TorchImgEmbedder._processor_sizes(self.processor)[0]
+        self.output_dtype = np.dtype(output_dtype)
+
+        os.makedirs(cache_dir, exist_ok=True)
+        self.model_path = os.path.join(cache_dir, f"{model}_{version.replace('/', '--')}_opset{opset}.onnx")
+        reference = None
+        if not os.path.exists(self.model_path):
+            reference = name2torch_embedder[model](version)
+            self.export(reference, self.model_path, opset)
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        options.intra_op_num_threads = intra_op_threads
+        options.inter_op_num_threads = inter_op_threads
+        if inter_op_threads > 1:
+            options.execution_mode = ort.ExecutionMode.ORT_PARALLEL
+        self.session = ort.InferenceSession(
+            self.model_path,
+            sess_options=options,
+            providers=providers if providers is not None else ["CPUExecutionProvider"]
+        )
+
+        if reference is not None and parity_check:
+            check_parity(reference, self, random_images(4))
+
+    @staticmethod
+    def export(embedder: TorchImgEmbedder, path: str, opset: int):
+        """ Exports image tower with dynamic batch size, written atomically """
+        crop_height, crop_width = embedder.crop_size
+        dummy = torch.zeros(1, 3, crop_height, crop_width)
+        tmp_path = f"{path}.tmp"
+        with torch.no_grad():
+            torch.onnx.export(
+                _TowerModule(embedder).eval(),
+                dummy,
+                tmp_path,
+                input_names=["pixel_values"],
+                output_names=["embeddings"],
+                dynamic_axes={"pixel_values": {0: "batch"}, "embeddings": {0: "batch"}},
+                opset_version=opset
+            )
+        os.replace(tmp_path, path)
+
+    def __call__(self, images: List[Image.Image]) -> np.ndarray:
+        pixel_values = self.processor(images=images, return_tensors="np")["pixel_values"].astype(np.float32)
+        embs = self.session.run(["embeddings"], {"pixel_values": pixel_values})[0]
+        return np.ascontiguousarray(embs, dtype=self.output_dtype)
@@ -1,39 +1,115 @@
-import httpx
 import asyncio
-from typing import List, Tuple, Union, Dict, Callable
+from typing import List, Tuple, Union, Dict, Callable, Optional
 from PIL import Image
-from io import BytesIO
+import numpy as np
 
 from .embedders import *
+from ..image_fetcher import ImageFetcher
+from ..embedding_cache import EmbeddingCache
+from ..image_decode import decode_image
 
 name2model_class: Dict[str, Callable[..., BaseImgEmbedder]] = {
     "clip": CLIPEmbedder,
-    "dinov2": DinoV2Embedder
+    "dinov2": DinoV2Embedder,
+    "onnx": ONNXEmbedder
 }
 
 
 class NamedEmbedder:
-    def __init__(self, name: str, cfg: str):
+    def __init__(
+            self,
+            name: str,
+            cfg: str,
+            fetcher: Optional[ImageFetcher] = None,
+            embedding_cache_dir: Optional[str] = None,
+            draft: bool = True,
+            max_pixels: Optional[int] = None
+        ):
         """
             Initialize embedder by its name and config.
+            Images are downloaded with the given fetcher, if it is not specified default one is created.
+            If embedding_cache_dir is specified, embeddings are cached there by model config and image content,
+            and images seen before are not passed through the model.
+            draft - decode images downscaled to about model input size instead of full resolution
+            max_pixels - images with more pixels to decode are rejected, None to decode any
         """
         if name not in name2model_class:
             raise Exception(f"No model named {name}")
         self.model = name2model_class[name](**cfg)
+        self.fetcher = fetcher if fetcher is not None else ImageFetcher()
+        self.decode_min_edge = self.model.input_size if draft else None
+        self.max_pixels = max_pixels
+        # downscaled decoding slightly changes embeddings, so they are cached separately
+        cache_cfg = {**cfg, "draft": True} if draft else cfg
+        self.embedding_cache = EmbeddingCache(embedding_cache_dir, name, cache_cfg) if embedding_cache_dir is not None else None
 
-    @staticmethod
-    async def fetch_image(url: str) -> Union[Image.Image, Exception]:
+    def content_key(self, content: bytes) -> Optional[bytes]:
+        """
+        Key of the image in embedding cache, None if cache is disabled.
+        """
+        return EmbeddingCache.content_hash(content) if self.embedding_cache is not None else None
+
+    def cached_embeddings(self, keys: List[Optional[bytes]]) -> Dict[bytes, np.ndarray]:
+        """
+        Returns key -> embedding of already embedded images.
+        """
+        keys = [key for key in keys if key is not None]
+        if self.embedding_cache is None or len(keys) == 0:
+            return {}
+        return self.embedding_cache.get_many(keys)
+
+    async def fetch_content(self, url: str) -> bytes:
+        """
+        Asynchronously downloads raw bytes of the image by URL. Raises on failure.
+        """
+        return await self.fetcher.fetch(url)
+
+    def decode_image(self, content: bytes) -> Image.Image:
+        """
+        Decodes raw image bytes into RGB Image downscaled for the model. Raises on failure.
+        CPU bound, so it should not be called inside event loop.
+        """
+        return decode_image(content, min_edge=self.decode_min_edge, max_pixels=self.max_pixels)
+
+    async def fetch_image(self, url: str) -> Union[Image.Image, Exception]:
         """
         Asynchronously fetches an image from a URL. Returns an Image object or an exception.
+        Image is decoded in a thread, so other downloads are not stalled.
         """
         try:
-            async with httpx.AsyncClient() as client:
-                response = await client.get(url)
-                response.raise_for_status()
-                return Image.open(BytesIO(response.content)).convert("RGB")
+            content = await self.fetch_content(url)
+            return await asyncio.to_thread(self.decode_image, content)
         except Exception as e:
             return e
 
+    def embed(self, imgs: List[Image.Image], keys: Optional[List[bytes]] = None) -> np.ndarray:
+        """
+        Runs model on already loaded images, embeddings are cached by keys if they are given.
+        """
+        embs = self.model(imgs)
+        if self.embedding_cache is not None and keys is not None:
+            self.embedding_cache.put_many(keys, embs)
+        return embs
+
+    @property
+    def supports_text(self) -> bool:
+        return hasattr(self.model, "embed_texts")
+
+    def embed_texts(self, texts: List[str]) -> np.ndarray:
+        """
+        Runs text tower of the model, only CLIP has one.
+        """
+        if not self.supports_text:
+            raise Exception(f"Model {type(self.model).__name__} does not embed texts")
+        return self.model.embed_texts(texts)
+
+    async def fetch_contents(self, urls: List[str]) -> List[Union[bytes, Exception]]:
+        """
+        Asynchronously downloads a batch of images. Returns a mix of raw bytes and exceptions.
+        """
+        tasks = [self.fetch_content(url) for url in urls]
+        return await asyncio.gather(*tasks, return_exceptions=True)
+
     async def fetch_images(self, urls: List[str]) -> List[Union[Image.Image, Exception]]:
         """
         Asynchronously fetches a batch of images from URLs. Returns a mix of Image objects and exceptions.
@@ -42,38 +118,49 @@ class NamedEmbedder:
         return await asyncio.gather(*tasks, return_exceptions=True)
 
     async def __call__(self, urls: List[str]) -> Tuple[
-            Dict[str, List[float]], 
+            Dict[str, np.ndarray], 
             Dict[str, Exception]
         ]:
         """
         Asynchronously fetches and processes a batch of image URLs, embedding them and returns two dictionaries:
             Of succesfully loaded urls and embeddings
             Of not succesfully loaded urls and exceptions
+        Images found in embedding cache are not decoded and not passed through the model.
         """
-        results = await self.fetch_images(urls)
+        results = await self.fetch_contents(urls)
 
-        loaded_urls, loaded_imgs, err_urls, errors = [], [], [], []
-        for url, res in zip(urls, results):
-            if isinstance(res, Image.Image):
-                loaded_urls.append(url)
-                loaded_imgs.append(res)
-            else:
-                err_urls.append(url)
-                errors.append(res)
-        
         url2emb = {}
         url2err = {}
+        loaded = [(url, res, self.content_key(res)) for url, res in zip(urls, results) if isinstance(res, bytes)]
+        key2emb = self.cached_embeddings([key for _, _, key in loaded])
+
+        missing = []
+        for url, content, key in loaded:
+            if key in key2emb:
+                url2emb[url] = key2emb[key]
+            else:
+                missing.append((url, content, key))
+        # images are decoded in threads, PIL releases GIL while decoding
+        imgs = await asyncio.gather(
+            *[asyncio.to_thread(self.decode_image, content) for _, content, _ in missing],
+            return_exceptions=True
+        )
+
+        loaded_urls, loaded_imgs, loaded_keys = [], [], []
+        for (url, _, key), img in zip(missing, imgs):
+            if isinstance(img, Exception):
+                url2err[url] = img
+                continue
+            loaded_urls.append(url)
+            loaded_imgs.append(img)
+            loaded_keys.append(key)
+
         if len(loaded_imgs) > 0:
-            embs = self.model(loaded_imgs)
-            url2emb = {
-                url: emb for url, emb in zip(loaded_urls, embs)
-            }
-        
-        if len(err_urls) > 0:
-            url2err = {
-                url: err for url, err in zip(err_urls, errors)
-            }
+            embs = self.embed(loaded_imgs, loaded_keys if self.embedding_cache is not None else None)
+            url2emb.update(zip(loaded_urls, embs))
+
+        for url, res in zip(urls, results):
+            if not isinstance(res, bytes):
+                url2err[url] = res
 
         return url2emb, url2err
-    
-    
\ No newline at end of file
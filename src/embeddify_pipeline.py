@@ -0,0 +1,234 @@
+from typing import List, Tuple, Iterable, Optional, Protocol
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import time
+
+from tqdm import tqdm
+from PIL import Image
+import numpy as np
+
+from .embedders_package import NamedEmbedder
+from .near_duplicates import NearDuplicateFilter, dhash
+from .failure_ledger import FailureLedger
+
+
+# marks the end of the stream inside a stage queue
+_STOP = None
+
+
+class EmbeddingSink(Protocol):
+    """ Where the write stage puts embedded batches """
+    def add(self, ids: List[str], embs: np.ndarray, metas: List[dict]) -> None:
+        ...
+
+
+class EmbeddifyPipeline:
+    """
+    Staged producer/consumer pipeline: fetch -> decode -> embed -> write.
+    Stages are connected with bounded queues, so downloads, decoding, model forward
+    and writes of different items overlap instead of running one after another.
+    """
+    def __init__(
+            self,
+            embedder: NamedEmbedder,
+            sink: EmbeddingSink,
+            logger,
+            batch_size: int = 256,
+            fetch_workers: int = 64,
+            decode_workers: int = 4,
+            write_workers: int = 1,
+            queue_size: int = 1024,
+            batch_timeout: float = 0.1,
+            near_duplicates: Optional[NearDuplicateFilter] = None,
+            failures: Optional[FailureLedger] = None
+        ):
+        """
+            batch_size - max number of images in one model forward
+            fetch_workers - number of concurrent downloads
+            decode_workers - number of threads decoding images
+            write_workers - number of threads writing to sink
+            queue_size - max number of items waiting between two stages
+            batch_timeout - max seconds the model waits to fill up a batch
+            near_duplicates - if set, decoded images near-duplicate to already seen ones are skipped
+            failures - if set, failed downloads and decodes are recorded there, written urls are cleared
+        """
+        self.embedder = embedder
+        self.sink = sink
+        self.logger = logger
+
+        self.batch_size = batch_size
+        self.fetch_workers = fetch_workers
+        self.decode_workers = decode_workers
+        self.write_workers = write_workers
+        self.queue_size = queue_size
+        self.batch_timeout = batch_timeout
+        self.near_duplicates = near_duplicates
+        self.failures = failures
+
+        self.n_added = 0
+        self.n_failed = 0
+        self.n_cached = 0
+
+    async def _produce(self, batches: Iterable[Tuple[List[str], List[str], List[dict]]], out_queue: asyncio.Queue):
+        batches = iter(batches)
+        # batches may be read lazily from disk, so they are pulled in a thread not to stall downloads
+        while (batch := await asyncio.to_thread(next, batches, None)) is not None:
+            ids, urls, metas = batch
+            for item in zip(ids, urls, metas):
+                await out_queue.put(item)
+
+    async def _fetch(self, in_queue: asyncio.Queue, out_queue: asyncio.Queue):
+        while (item := await in_queue.get()) is not _STOP:
+            id, url, meta = item
+            try:
+                content = await self.embedder.fetch_content(url)
+            except Exception as e:
+                self._log_error(url, e)
+                continue
+            await out_queue.put((id, url, meta, content))
+
+    async def _decode(self, in_queue: asyncio.Queue, out_queue: asyncio.Queue, executor: ThreadPoolExecutor):
+        loop = asyncio.get_running_loop()
+        while (item := await in_queue.get()) is not _STOP:
+            id, url, meta, content = item
+            try:
+                img, h, key, emb = await loop.run_in_executor(executor, self._decode_image, content)
+            except Exception as e:
+                self._log_error(url, e)
+                continue
+            if h is not None and self.near_duplicates.match(url, h) is not None:
+                continue
+            await out_queue.put((id, url, meta, img, key, emb))
+
+    async def _next_batch(self, in_queue: asyncio.Queue) -> Tuple[list, bool]:
+        """ Collects up to batch_size items waiting not longer than batch_timeout after the first one """
+        item = await in_queue.get()
+        if item is _STOP:
+            return [], True
+
+        batch = [item]
+        deadline = time.monotonic() + self.batch_timeout
+        while len(batch) < self.batch_size:
+            timeout = deadline - time.monotonic()
+            try:
+                item = in_queue.get_nowait() if timeout <= 0 else await asyncio.wait_for(in_queue.get(), timeout)
+            except (asyncio.QueueEmpty, asyncio.TimeoutError):
+                break
+            if item is _STOP:
+                return batch, True
+            batch.append(item)
+        return batch, False
+
+    async def _embed(self, in_queue: asyncio.Queue, out_queue: asyncio.Queue, executor: ThreadPoolExecutor):
+        loop = asyncio.get_running_loop()
+        stopped = False
+        while not stopped:
+            batch, stopped = await self._next_batch(in_queue)
+            if len(batch) == 0:
+                continue
+            ids, urls, metas, imgs, keys, embs = zip(*batch)
+            # only images missing in embedding cache are passed through the model
+            missing = [i for i, emb in enumerate(embs) if emb is None]
+            self.n_cached += len(embs) - len(missing)
+            if len(missing) == len(embs):
+                embs = await loop.run_in_executor(executor, self.embedder.embed, list(imgs), list(keys))
+            else:
+                embs = list(embs)
+                if missing:
+                    new_embs = await loop.run_in_executor(
+                        executor, self.embedder.embed, [imgs[i] for i in missing], [keys[i] for i in missing]
+                    )
+                    for i, emb in zip(missing, new_embs):
+                        embs[i] = emb
+                embs = np.stack(embs)
+            await out_queue.put((list(ids), list(urls), embs, list(metas)))
+
+    async def _write(self, in_queue: asyncio.Queue, executor: ThreadPoolExecutor, pbar: tqdm):
+        loop = asyncio.get_running_loop()
+        while (item := await in_queue.get()) is not _STOP:
+            ids, urls, embs, metas = item
+            await loop.run_in_executor(executor, self._write_batch, ids, urls, embs, metas)
+            self.n_added += len(ids)
+            pbar.update(len(ids))
+
+    def _write_batch(self, ids: List[str], urls: List[str], embs: np.ndarray, metas: List[dict]):
+        self.sink.add(ids, embs, metas)
+        if self.failures is not None:
+            self.failures.record_success(urls)
+
+    def _decode_image(self, content: bytes) -> Tuple[Optional[Image.Image], Optional[int], Optional[bytes], Optional[np.ndarray]]:
+        """
+        Returns (image, perceptual hash, embedding cache key, cached embedding).
+        Image is not decoded if its embedding is cached and near-duplicates are not filtered,
+        perceptual hash is computed only if they are.
+        """
+        key = self.embedder.content_key(content)
+        emb = self.embedder.cached_embeddings([key]).get(key) if key is not None else None
+        if emb is not None and self.near_duplicates is None:
+            return None, None, key, emb
+        img = self.embedder.decode_image(content)
+        return img, dhash(img) if self.near_duplicates is not None else None, key, emb
+
+    def _log_error(self, url: str, error: Exception):
+        self.n_failed += 1
+        self.logger.error(f"Error for URL {url}: {error}")
+        if self.failures is not None:
+            self.failures.record_failure(url, error)
+
+    @staticmethod
+    async def _close_stages(stages: List[Tuple[List[asyncio.Task], Optional[asyncio.Queue]]]):
+        """ Waits for all workers of each stage in order and then stops the workers of the next one """
+        for i, (tasks, out_queue) in enumerate(stages):
+            await asyncio.gather(*tasks)
+            if out_queue is not None:
+                for _ in range(len(stages[i + 1][0])):
+                    await out_queue.put(_STOP)
+
+    async def run(self, batches: Iterable[Tuple[List[str], List[str], List[dict]]], total: Optional[int] = None):
+        """
+        Embeds all batches of (ids, urls, metadatas) and adds them to the sink.
+        """
+        fetch_queue = asyncio.Queue(self.queue_size)
+        decode_queue = asyncio.Queue(self.queue_size)
+        embed_queue = asyncio.Queue(self.queue_size)
+        # every item of write queue is a whole batch
+        write_queue = asyncio.Queue(max(1, self.queue_size // self.batch_size))
+
+        decode_executor = ThreadPoolExecutor(self.decode_workers, thread_name_prefix="decode")
+        embed_executor = ThreadPoolExecutor(1, thread_name_prefix="embed")
+        write_executor = ThreadPoolExecutor(self.write_workers, thread_name_prefix="write")
+        pbar = tqdm(total=total)
+
+        producer = [asyncio.create_task(self._produce(batches, fetch_queue))]
+        fetchers = [asyncio.create_task(self._fetch(fetch_queue, decode_queue)) for _ in range(self.fetch_workers)]
+        decoders = [asyncio.create_task(self._decode(decode_queue, embed_queue, decode_executor)) for _ in range(self.decode_workers)]
+        embedders = [asyncio.create_task(self._embed(embed_queue, write_queue, embed_executor))]
+        writers = [asyncio.create_task(self._write(write_queue, write_executor, pbar)) for _ in range(self.write_workers)]
+        closing = asyncio.create_task(self._close_stages([
+            (producer, fetch_queue),
+            (fetchers, decode_queue),
+            (decoders, embed_queue),
+            (embedders, write_queue),
+            (writers, None)
+        ]))
+        all_tasks = producer + fetchers + decoders + embedders + writers + [closing]
+
+        try:
+            # returns as soon as any stage fails, so the others do not hang on full queues
+            await asyncio.wait(all_tasks, return_when=asyncio.FIRST_EXCEPTION)
+            for task in all_tasks:
+                if task.done() and not task.cancelled() and task.exception() is not None:
+                    raise task.exception()
+        except BaseException:
+            for task in all_tasks:
+                task.cancel()
+            await asyncio.gather(*all_tasks, return_exceptions=True)
+            raise
+        finally:
+            pbar.close()
+            for executor in (decode_executor, embed_executor, write_executor):
+                executor.shutdown(wait=True)
+
+        self.logger.info(f"Pipeline finished: added {self.n_added} ({self.n_cached} from embedding cache), failed {self.n_failed}")
+        if self.near_duplicates is not None:
+            self.near_duplicates.report(self.logger)
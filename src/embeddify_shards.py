@@ -0,0 +1,87 @@
+from typing import List, Iterator, Tuple
+import hashlib
+import json
+import os
+import threading
+
+import numpy as np
+import chromadb
+
+from .url_index import UrlIndex
+
+
+def shard_of(url: str, n_shards: int) -> int:
+    """ Stable shard of the item, the same in every process and every run """
+    return int.from_bytes(hashlib.blake2b(url.encode(), digest_size=8).digest(), "little") % n_shards
+
+
+def shard_dir(staging_dir: str, shard: int) -> str:
+    return os.path.join(staging_dir, f"shard_{shard:03d}")
+
+
+class StagingWriter:
+    """
+    Sink of one shard: every embedded batch is written into its own part file of the shard staging directory.
+    Parts are written atomically, so merge never sees half-written ones.
+    add() may be called from several write threads, part numbers are taken under lock, so every part has its own file.
+    """
+    def __init__(self, staging_dir: str, shard: int):
+        self.dir_path = shard_dir(staging_dir, shard)
+        os.makedirs(self.dir_path, exist_ok=True)
+        self.n_parts = len(list_parts(self.dir_path))
+        self.lock = threading.Lock()
+
+    def add(self, ids: List[str], embs: np.ndarray, metas: List[dict]):
+        with self.lock:
+            part_path = os.path.join(self.dir_path, f"part_{self.n_parts:08d}.npz")
+            self.n_parts += 1
+
+        tmp_path = f"{part_path}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez(
+                f,
+                ids=np.array(ids),
+                embeddings=embs,
+                metadatas=np.array([json.dumps(meta) for meta in metas])
+            )
+        os.replace(tmp_path, part_path)
+
+
+def list_parts(dir_path: str) -> List[str]:
+    return sorted(
+        os.path.join(dir_path, name)
+        for name in os.listdir(dir_path)
+        if name.startswith("part_") and name.endswith(".npz")
+    )
+
+
+def iter_staged(staging_dir: str) -> Iterator[Tuple[str, List[str], np.ndarray, List[dict]]]:
+    """ Yields (part path, ids, embeddings, metadatas) of all parts in deterministic shard/part order """
+    if not os.path.exists(staging_dir):
+        return
+    for name in sorted(os.listdir(staging_dir)):
+        dir_path = os.path.join(staging_dir, name)
+        if not (name.startswith("shard_") and os.path.isdir(dir_path)):
+            continue
+        for part_path in list_parts(dir_path):
+            with np.load(part_path) as part:
+                ids = part["ids"].tolist()
+                embs = part["embeddings"]
+                metas = [json.loads(meta) for meta in part["metadatas"]]
+            yield part_path, ids, embs, metas
+
+
+def merge_staging(staging_dir: str, collection: chromadb.Collection, url_index: UrlIndex, logger) -> int:
+    """
+    Loads all staged parts into the collection and removes them. Upsert makes merge idempotent:
+    if it is interrupted, running it again does not duplicate already merged items.
+    Returns number of merged items.
+    """
+    n_merged = 0
+    for part_path, ids, embs, metas in iter_staged(staging_dir):
+        collection.upsert(ids=ids, embeddings=embs.tolist(), metadatas=metas)
+        url_index.add(ids, [meta["url"] for meta in metas])
+        os.remove(part_path)
+        n_merged += len(ids)
+    logger.info(f"Merged {n_merged} staged elements into collection")
+    return n_merged
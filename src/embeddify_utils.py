@@ -1,45 +1,118 @@
-from typing import List, Tuple
-from collections import defaultdict
+from typing import List, Tuple, Dict, Iterable, Iterator
+import itertools
+import hashlib
 import uuid
 
+import numpy as np
+
 
 class CustomCollate:
-    def __init__(self, id_field=None):
+    def __init__(self, id_field=None, stable_ids=False):
+        """
+            If id_field is not specified, ids are random uuids, or uuids derived from urls if stable_ids is set
+            (so the same item gets the same id in every run).
+        """
         self.id_field = id_field
+        self.stable_ids = stable_ids
 
     def __call__(self, batch: List[dict]) -> Tuple[List[str], List[str], List[dict]]:
         """ Returns list of ids(uuid), urls and list of metadata excluding those that are not in collection """
-        if self.id_field is None:
+        if self.id_field is None and self.stable_ids:
+            return [str(uuid.uuid5(uuid.NAMESPACE_URL, item["url"])) for item in batch], [item["url"] for item in batch], batch
+        elif self.id_field is None:
             return [str(uuid.uuid4()) for _ in batch], [item["url"] for item in batch], batch
         else:
             return [item[self.id_field] for item in batch], [item["url"] for item in batch], batch
 
 
-def deduplicate_data(metadatas: List[dict], logger) -> List[dict]:
+def batched(items: Iterable[dict], batch_size: int) -> Iterator[List[dict]]:
+    items = iter(items)
+    while batch := list(itertools.islice(items, batch_size)):
+        yield batch
+
+
+def url_digests(urls: List[str]) -> np.ndarray:
+    """ 64-bit blake2b digests of URLs """
+    return np.fromiter(
+        (int.from_bytes(hashlib.blake2b(url.encode(), digest_size=8).digest(), "little") for url in urls),
+        dtype=np.uint64,
+        count=len(urls)
+    )
+
+
+class DuplicateUrls:
+    """
+    Compact set of duplicated URLs: sorted array of their 64-bit digests (8 bytes per duplicated URL).
+    Distinct URLs with colliding digests would be treated as duplicates, which is negligible at 64 bits.
+    Remembers up to max_examples dropped URLs, so duplicates are reported by a short summary.
+    """
+    def __init__(self, digests: np.ndarray, n_items: int, n_duplicate_items: int, max_examples: int = 20):
+        self.digests = digests
+        self.n_items = n_items
+        self.n_duplicate_items = n_duplicate_items
+        self.max_examples = max_examples
+        self.url2count: Dict[str, int] = {}
+
+    def __len__(self) -> int:
+        return len(self.digests)
+
+    def mask(self, urls: List[str]) -> np.ndarray:
+        """ Vectorized membership test, True for duplicated URLs """
+        if len(self.digests) == 0:
+            return np.zeros(len(urls), dtype=bool)
+        digests = url_digests(urls)
+        pos = np.minimum(np.searchsorted(self.digests, digests), len(self.digests) - 1)
+        return self.digests[pos] == digests
+
+    def record(self, url: str):
+        """ Counts dropped URL if it is one of the first max_examples or already among them """
+        if url in self.url2count or len(self.url2count) < self.max_examples:
+            self.url2count[url] = self.url2count.get(url, 0) + 1
+
+    def report(self, logger):
+        if len(self) == 0:
+            logger.info("No duplicate URLs found.")
+            return
+        logger.warning(
+            f"Found {len(self)} duplicate URLs in {self.n_duplicate_items} of {self.n_items} elements, "
+            f"continuing without all duplicate elements"
+        )
+        if self.url2count:
+            examples = ", ".join(f"{url} (x{count})" for url, count in self.url2count.items())
+            logger.warning(f"First {len(self.url2count)} duplicate URLs: {examples}")
+
+
+def find_duplicate_urls(metadatas: Iterable[dict], logger, chunk_size: int = 100000, max_examples: int = 20) -> DuplicateUrls:
+    """
+    First pass of deduplication: goes through the metadata stream keeping only 64-bit digests
+    of URLs and returns the ones that occur more than once.
+    """
+    chunks = []
+    n_items = 0
+    for batch in batched(metadatas, chunk_size):
+        n_items += len(batch)
+        chunks.append(url_digests([meta['url'] for meta in batch if meta.get('url')]))
+
+    digests = np.sort(np.concatenate(chunks)) if chunks else np.empty(0, dtype=np.uint64)
+    repeated = digests[1:] == digests[:-1]
+    duplicate_digests = np.unique(digests[1:][repeated])
+    # every duplicated URL is counted once more than the number of its repeats
+    n_duplicate_items = int(repeated.sum()) + len(duplicate_digests)
+
+    logger.info(f"Number of elements in formatted data: {n_items}")
+    logger.info(f"Number of duplicate URLs: {len(duplicate_digests)}")
+    return DuplicateUrls(duplicate_digests, n_items, n_duplicate_items, max_examples)
+
+
+def drop_duplicates(metadatas: Iterable[dict], duplicate_urls: DuplicateUrls, chunk_size: int = 10000) -> Iterator[dict]:
     """
-    Checks for duplicate URLs in the metadata list.
-    If such URLs exist, logs them. If no duplicates are found, logs a message indicating that.
-    Returns a list of metadata with duplicates removed.
+    Second pass of deduplication: lazily yields metadata whose URL is not among duplicates,
+    dropped ones are recorded into duplicate_urls report.
     """
-    url_count = defaultdict(int)  # Using defaultdict to count occurrences of each URL
-    duplicate_urls = set()        # Set to store duplicate URLs
-
-    # Iterate over the metadata list and count occurrences of each URL
-    for meta in metadatas:
-        url = meta.get('url')
-        if url:
-            url_count[url] += 1
-            if url_count[url] > 1:
-                duplicate_urls.add(url)
-
-    if duplicate_urls:
-        logger.warning(f"Duplicate URLs found: {duplicate_urls}")
-        logger.info(f"Continuing without all duplicate elements")
-
-        # Filter out elements that have URLs in the duplicate_urls set
-        metadatas = [meta for meta in metadatas if meta.get('url') not in duplicate_urls]
-        logger.info(f"Number of deduplicated data: {len(metadatas)}")
-    else:
-        logger.info("No duplicate URLs found.")
-    
-    return metadatas
+    for batch in batched(metadatas, chunk_size):
+        mask = duplicate_urls.mask([meta.get('url') or "" for meta in batch])
+        for meta, is_duplicate in zip(batch, mask):
+            if is_duplicate:
+                duplicate_urls.record(meta['url'])
+            else:
+                yield meta
@@ -0,0 +1,124 @@
+from typing import List, Dict, Optional
+import hashlib
+import fcntl
+import json
+import os
+import sqlite3
+import threading
+
+import numpy as np
+
+from .sqlite_utils import execute_in
+
+
+def model_key(model_name: str, model_cfg: dict) -> str:
+    """ Hash of model name and config, device does not change embeddings, so it is not a part of the key """
+    cfg = {key: value for key, value in model_cfg.items() if key != "device"}
+    return hashlib.sha256(json.dumps({"name": model_name, "cfg": cfg}, sort_keys=True).encode()).hexdigest()
+
+
+class EmbeddingCache:
+    """
+    Persistent cache of embeddings of one model keyed by hash of raw image bytes, shared by all collections.
+    Embeddings are appended as rows of a flat binary file read through memory map,
+    content hash -> row index is stored in sqlite. Every model config gets its own directory.
+    Appends are serialized with a file lock, so shard processes can share the cache.
+    """
+    def __init__(self, cache_dir: str, model_name: str, model_cfg: dict):
+        self.dir_path = os.path.join(cache_dir, f"{model_name}_{model_key(model_name, model_cfg)[:16]}")
+        os.makedirs(self.dir_path, exist_ok=True)
+        with open(os.path.join(self.dir_path, "model.json"), "w") as f:
+            json.dump({"name": model_name, "cfg": model_cfg}, f, indent=4, default=str)
+
+        self.data_path = os.path.join(self.dir_path, "embeddings.bin")
+        self.lock_path = os.path.join(self.dir_path, "embeddings.lock")
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(os.path.join(self.dir_path, "keys.sqlite"), check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS keys (hash BLOB PRIMARY KEY, row INTEGER NOT NULL) WITHOUT ROWID")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        self.conn.commit()
+
+        self.dim: Optional[int] = None
+        self.dtype: Optional[np.dtype] = None
+        self.mmap: Optional[np.memmap] = None
+        self._load_meta()
+
+    @staticmethod
+    def content_hash(content: bytes) -> bytes:
+        return hashlib.blake2b(content, digest_size=16).digest()
+
+    def _load_meta(self):
+        meta = dict(self.conn.execute("SELECT key, value FROM meta"))
+        if "dim" in meta:
+            self.dim = int(meta["dim"])
+            self.dtype = np.dtype(meta["dtype"])
+
+    def _rows(self, hashes: List[bytes]) -> Dict[bytes, int]:
+        return dict(execute_in(self.conn, "SELECT hash, row FROM keys WHERE hash IN ({})", hashes))
+
+    def _mapped(self, max_row: int) -> np.memmap:
+        """ Memory map covering max_row, remapped if file has grown since it was opened """
+        if self.mmap is None or len(self.mmap) <= max_row:
+            n_rows = os.path.getsize(self.data_path) // (self.dim * self.dtype.itemsize)
+            self.mmap = np.memmap(self.data_path, dtype=self.dtype, mode="r", shape=(n_rows, self.dim))
+        return self.mmap
+
+    def get_many(self, hashes: List[bytes]) -> Dict[bytes, np.ndarray]:
+        """ Returns hash -> embedding for those hashes that are cached """
+        with self.lock:
+            hash2row = self._rows(hashes)
+            if not hash2row:
+                return {}
+            if self.dim is None:
+                # another process has created the cache after it was opened
+                self._load_meta()
+            mmap = self._mapped(max(hash2row.values()))
+            return {h: np.array(mmap[row]) for h, row in hash2row.items()}
+
+    def put_many(self, hashes: List[bytes], embs: np.ndarray):
+        """ Appends embeddings of not yet cached hashes """
+        with self.lock, open(self.lock_path, "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            if self.dim is None:
+                self._load_meta()
+            if self.dim is None:
+                self.dim, self.dtype = embs.shape[1], embs.dtype
+                self.conn.executemany(
+                    "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+                    [("dim", str(self.dim)), ("dtype", self.dtype.str)]
+                )
+            if embs.shape[1] != self.dim:
+                raise ValueError(f"Embedding dim {embs.shape[1]} does not match cached dim {self.dim}")
+
+            # other processes could have added some of them meanwhile, duplicates inside the batch are skipped too
+            cached = self._rows(hashes)
+            new = {}
+            for i, h in enumerate(hashes):
+                if h not in cached and h not in new:
+                    new[h] = i
+            if not new:
+                self.conn.commit()
+                return
+
+            row_size = self.dim * self.dtype.itemsize
+            with open(self.data_path, "ab") as f:
+                # torn row of crashed append is dropped, so rows stay aligned
+                size = f.tell()
+                if size % row_size:
+                    f.truncate(size - size % row_size)
+                    f.seek(0, os.SEEK_END)
+                first_row = f.tell() // row_size
+                f.write(np.ascontiguousarray(embs[list(new.values())], dtype=self.dtype).tobytes())
+            # rows are written before keys, so a crash in between leaves only unreferenced rows
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO keys (hash, row) VALUES (?, ?)",
+                zip(new, range(first_row, first_row + len(new)))
+            )
+            self.conn.commit()
+
+    def close(self):
+        with self.lock:
+            self.mmap = None
+            self.conn.close()
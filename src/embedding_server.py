@@ -0,0 +1,274 @@
+from typing import Dict, Callable, Optional, Any, Hashable, TYPE_CHECKING
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import base64
+import hashlib
+import time
+
+from aiohttp import web
+import numpy as np
+
+if TYPE_CHECKING:
+    # only for annotations, so server can be run and tested with any embedder of the same interface without torch
+    from .embedders_package import NamedEmbedder
+
+
+class DynamicBatcher:
+    """
+    Coalesces concurrent single-item requests into batches: a batch is run as soon as it has
+    max_batch_size items or max_wait seconds passed since its first item arrived.
+    fn maps list of items to array of results and runs in executor, so event loop is not blocked.
+    """
+    def __init__(self, fn: Callable[[list], np.ndarray], executor: ThreadPoolExecutor, max_batch_size: int = 32, max_wait: float = 0.01):
+        self.fn = fn
+        self.executor = executor
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self.task: Optional[asyncio.Task] = None
+        self.batch_sizes: deque = deque(maxlen=10000)
+
+    def start(self):
+        self.task = asyncio.create_task(self._run())
+
+    async def close(self):
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+
+    async def __call__(self, item) -> np.ndarray:
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((item, future))
+        return await future
+
+    async def _next_batch(self) -> list:
+        batch = [await self.queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            try:
+                batch.append(self.queue.get_nowait() if timeout <= 0 else await asyncio.wait_for(self.queue.get(), timeout))
+            except (asyncio.QueueEmpty, asyncio.TimeoutError):
+                break
+        return batch
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._next_batch()
+            # requests cancelled by their clients while waiting are not computed
+            batch = [(item, future) for item, future in batch if not future.done()]
+            if len(batch) == 0:
+                continue
+            self.batch_sizes.append(len(batch))
+            try:
+                results = await loop.run_in_executor(self.executor, self.fn, [item for item, _ in batch])
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            for (_, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+
+
+class LRUCache:
+    """ Least recently used embeddings of repeated queries """
+    def __init__(self, max_size: int = 10000):
+        self.max_size = max_size
+        self.items: OrderedDict = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        if key not in self.items:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.items.move_to_end(key)
+        return self.items[key]
+
+    def put(self, key: Hashable, value: Any):
+        if self.max_size <= 0:
+            return
+        self.items[key] = value
+        self.items.move_to_end(key)
+        while len(self.items) > self.max_size:
+            self.items.popitem(last=False)
+
+
+class LatencyStats:
+    """ Latencies of the last window requests per endpoint, in ms """
+    def __init__(self, window: int = 10000):
+        self.window = window
+        self.name2latencies: Dict[str, deque] = {}
+
+    def add(self, name: str, latency: float):
+        self.name2latencies.setdefault(name, deque(maxlen=self.window)).append(latency * 1000)
+
+    def summary(self) -> Dict[str, dict]:
+        return {
+            name: {
+                "count": len(latencies),
+                "p50_ms": float(np.percentile(latencies, 50)),
+                "p99_ms": float(np.percentile(latencies, 99))
+            }
+            for name, latencies in self.name2latencies.items() if len(latencies) > 0
+        }
+
+
+class EmbeddingServer:
+    """
+    HTTP service embedding queries with NamedEmbedder and searching them in chroma collection.
+    Concurrent requests are embedded together: images and texts have their own dynamic batchers.
+    Embeddings of repeated queries (same image content, url or text) are taken from LRU cache.
+    Endpoints, all of them take and return json:
+        POST /embed {"url": ...} | {"image": base64 bytes} | {"text": ...} -> {"embedding": [...]}
+        POST /query the same as /embed and optional "k", "where" -> {"ids", "distances", "metadatas"}
+        GET /stats -> p50/p99 latencies per endpoint, batch sizes and cache hits
+    """
+    def __init__(
+            self,
+            embedder: "NamedEmbedder",
+            collection,
+            logger,
+            max_batch_size: int = 32,
+            max_wait: float = 0.01,
+            cache_size: int = 10000,
+            default_k: int = 20,
+            max_k: int = 1000
+        ):
+        """
+            max_batch_size - max number of queries in one model forward
+            max_wait - max seconds the first query of a batch waits for others
+            cache_size - max number of cached query embeddings, 0 to disable
+            default_k, max_k - default and max number of results of /query
+        """
+        self.embedder = embedder
+        self.collection = collection
+        self.logger = logger
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.default_k = default_k
+        self.max_k = max_k
+
+        self.cache = LRUCache(cache_size)
+        self.stats = LatencyStats()
+        # one thread runs model forward, so batches of images and texts do not compete for cpu
+        self.model_executor = ThreadPoolExecutor(1, thread_name_prefix="model")
+        self.image_batcher: Optional[DynamicBatcher] = None
+        self.text_batcher: Optional[DynamicBatcher] = None
+
+    def app(self) -> web.Application:
+        app = web.Application(client_max_size=32 * 2**20, middlewares=[self._timed])
+        app.router.add_post("/embed", self.handle_embed)
+        app.router.add_post("/query", self.handle_query)
+        app.router.add_get("/stats", self.handle_stats)
+        app.on_startup.append(self._start)
+        app.on_cleanup.append(self._close)
+        return app
+
+    async def _start(self, app: web.Application):
+        self.image_batcher = DynamicBatcher(self.embedder.embed, self.model_executor, self.max_batch_size, self.max_wait)
+        self.image_batcher.start()
+        if self.embedder.supports_text:
+            self.text_batcher = DynamicBatcher(self.embedder.embed_texts, self.model_executor, self.max_batch_size, self.max_wait)
+            self.text_batcher.start()
+
+    async def _close(self, app: web.Application):
+        for batcher in (self.image_batcher, self.text_batcher):
+            if batcher is not None:
+                await batcher.close()
+        self.model_executor.shutdown(wait=True)
+        self.logger.info(f"Server stats: {self.summary()}")
+
+    @web.middleware
+    async def _timed(self, request: web.Request, handler):
+        t = time.perf_counter()
+        try:
+            return await handler(request)
+        finally:
+            self.stats.add(f"{request.method} {request.path}", time.perf_counter() - t)
+
+    async def embed_query(self, body: dict) -> np.ndarray:
+        """ Embedding of url, base64 image or text query, raises HTTPBadRequest for wrong ones """
+        for field in ("text", "url", "image"):
+            if field in body and not isinstance(body[field], str):
+                raise web.HTTPBadRequest(text=f"{field} has to be string")
+
+        if "text" in body:
+            if self.text_batcher is None:
+                raise web.HTTPBadRequest(text="Model does not support text queries")
+            key = ("text", body["text"])
+        elif "url" in body:
+            key = ("url", body["url"])
+        elif "image" in body:
+            try:
+                content = base64.b64decode(body["image"], validate=True)
+            except ValueError:
+                raise web.HTTPBadRequest(text="image has to be base64 encoded")
+            key = ("image", hashlib.blake2b(content, digest_size=16).digest())
+        else:
+            raise web.HTTPBadRequest(text="Query has to have one of fields: url, image, text")
+
+        emb = self.cache.get(key)
+        if emb is not None:
+            return emb
+
+        if "text" in body:
+            emb = await self.text_batcher(body["text"])
+        else:
+            if "url" in body:
+                try:
+                    content = await self.embedder.fetch_content(body["url"])
+                except Exception as e:
+                    raise web.HTTPBadGateway(text=f"Error loading {body['url']}: {e}")
+            try:
+                img = await asyncio.to_thread(self.embedder.decode_image, content)
+            except Exception as e:
+                raise web.HTTPBadRequest(text=f"Error decoding image: {e}")
+            emb = await self.image_batcher(img)
+        self.cache.put(key, emb)
+        return emb
+
+    @staticmethod
+    async def _json_body(request: web.Request) -> dict:
+        try:
+            body = await request.json()
+        except ValueError:
+            raise web.HTTPBadRequest(text="Body has to be json")
+        if not isinstance(body, dict):
+            raise web.HTTPBadRequest(text="Body has to be json object")
+        return body
+
+    async def handle_embed(self, request: web.Request) -> web.Response:
+        emb = await self.embed_query(await self._json_body(request))
+        return web.json_response({"embedding": emb.astype(np.float32).tolist()})
+
+    async def handle_query(self, request: web.Request) -> web.Response:
+        body = await self._json_body(request)
+        k = body.get("k", self.default_k)
+        if not isinstance(k, int) or not 0 < k <= self.max_k:
+            raise web.HTTPBadRequest(text=f"k has to be integer from 1 to {self.max_k}")
+        emb = await self.embed_query(body)
+        res = await asyncio.to_thread(
+            self.collection.query,
+            query_embeddings=[emb.astype(np.float32).tolist()],
+            n_results=k,
+            where=body.get("where"),
+            include=["metadatas", "distances"]
+        )
+        return web.json_response({"ids": res["ids"][0], "distances": res["distances"][0], "metadatas": res["metadatas"][0]})
+
+    def summary(self) -> dict:
+        batch_sizes = [size for batcher in (self.image_batcher, self.text_batcher) if batcher is not None for size in batcher.batch_sizes]
+        return {
+            "latency": self.stats.summary(),
+            "batches": {"count": len(batch_sizes), "mean_size": float(np.mean(batch_sizes)) if batch_sizes else 0.0},
+            "cache": {"size": len(self.cache.items), "hits": self.cache.hits, "misses": self.cache.misses}
+        }
+
+    async def handle_stats(self, request: web.Request) -> web.Response:
+        return web.json_response(self.summary())
@@ -0,0 +1,141 @@
+from typing import List, Dict, Set, Iterable, Iterator
+from urllib.parse import urlsplit
+import threading
+import sqlite3
+import time
+
+import httpx
+from PIL import UnidentifiedImageError
+
+from .sqlite_utils import execute_in, filter_urls
+
+# errors retrying which makes no sense soon, they are retried after max_ttl
+PERMANENT_ERRORS = {"http_400", "http_401", "http_403", "http_404", "http_410", "decode"}
+
+
+def error_class(error: BaseException) -> str:
+    """ Short class of download / decode error used for retry policy and reports """
+    if isinstance(error, httpx.HTTPStatusError):
+        return f"http_{error.response.status_code}"
+    if isinstance(error, httpx.TimeoutException):
+        return "timeout"
+    if isinstance(error, httpx.TransportError):
+        return "connection"
+    if isinstance(error, (UnidentifiedImageError, SyntaxError)):
+        # PIL raises SyntaxError for some broken files
+        return "decode"
+    return type(error).__name__
+
+
+def url_host(url: str) -> str:
+    return urlsplit(url).netloc
+
+
+class FailureLedger:
+    """
+    Persistent ledger of urls which failed to download or decode, stored in sqlite.
+    Failed url is not retried until its retry time: ttl doubled on every next failure up to max_ttl,
+    permanent errors (404, decode, ...) wait max_ttl at once. Successful url is removed from ledger.
+    Successes and failures are also counted per host for the report.
+    """
+    def __init__(self, path: str, ttl: float = 3600.0, max_ttl: float = 30 * 86400.0):
+        """
+            ttl - seconds before first retry of transient failure
+            max_ttl - max seconds between retries
+        """
+        self.ttl = ttl
+        self.max_ttl = max_ttl
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS failures ("
+            "url TEXT PRIMARY KEY, host TEXT NOT NULL, error_class TEXT NOT NULL, message TEXT, "
+            "attempts INTEGER NOT NULL, first_failed REAL NOT NULL, last_failed REAL NOT NULL, retry_after REAL NOT NULL"
+            ") WITHOUT ROWID"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS failures_host ON failures (host)")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS hosts (host TEXT PRIMARY KEY, n_success INTEGER NOT NULL, n_failed INTEGER NOT NULL) WITHOUT ROWID"
+        )
+        self.conn.commit()
+
+    def _retry_delay(self, cls: str, attempts: int) -> float:
+        if cls in PERMANENT_ERRORS:
+            return self.max_ttl
+        return min(self.ttl * 2 ** (attempts - 1), self.max_ttl)
+
+    def record_failure(self, url: str, error: BaseException):
+        cls = error_class(error)
+        now = time.time()
+        with self.lock:
+            row = self.conn.execute("SELECT attempts, first_failed FROM failures WHERE url = ?", (url,)).fetchone()
+            attempts, first_failed = (row[0] + 1, row[1]) if row is not None else (1, now)
+            self.conn.execute(
+                "INSERT OR REPLACE INTO failures (url, host, error_class, message, attempts, first_failed, last_failed, retry_after) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (url, url_host(url), cls, str(error)[:500], attempts, first_failed, now, now + self._retry_delay(cls, attempts))
+            )
+            self._count(url_host(url), 0, 1)
+            self.conn.commit()
+
+    def record_success(self, urls: List[str]):
+        """ Removes recovered urls and counts successes of their hosts """
+        host2count: Dict[str, int] = {}
+        for url in urls:
+            host = url_host(url)
+            host2count[host] = host2count.get(host, 0) + 1
+        with self.lock:
+            execute_in(self.conn, "DELETE FROM failures WHERE url IN ({})", urls)
+            for host, count in host2count.items():
+                self._count(host, count, 0)
+            self.conn.commit()
+
+    def _count(self, host: str, n_success: int, n_failed: int):
+        """ Has to be called under lock """
+        self.conn.execute(
+            "INSERT INTO hosts (host, n_success, n_failed) VALUES (?, ?, ?) "
+            "ON CONFLICT (host) DO UPDATE SET n_success = n_success + excluded.n_success, n_failed = n_failed + excluded.n_failed",
+            (host, n_success, n_failed)
+        )
+
+    def blocked_many(self, urls: List[str]) -> Set[str]:
+        """ Urls which failed and whose retry time has not come yet """
+        with self.lock:
+            rows = execute_in(self.conn, "SELECT url FROM failures WHERE retry_after > ? AND url IN ({})", urls, (time.time(),))
+        return {url for url, in rows}
+
+    def is_blocked(self, url: str) -> bool:
+        return bool(self.blocked_many([url]))
+
+    def filter_retryable(self, items: Iterable[dict], batch_size: int = 10000) -> Iterator[dict]:
+        """
+        Lazily yields items whose urls are not blocked, checking them batch by batch.
+        """
+        return filter_urls(items, self.blocked_many, batch_size)
+
+    def report(self, logger, top: int = 20):
+        """ Logs failure rates of hosts with most failures and their most common error classes """
+        with self.lock:
+            n_failed_urls = self.conn.execute("SELECT COUNT(*) FROM failures").fetchone()[0]
+            n_blocked = self.conn.execute("SELECT COUNT(*) FROM failures WHERE retry_after > ?", (time.time(),)).fetchone()[0]
+            hosts = self.conn.execute(
+                "SELECT host, n_success, n_failed FROM hosts WHERE n_failed > 0 ORDER BY n_failed DESC LIMIT ?", (top,)
+            ).fetchall()
+            host2errors = {
+                host: self.conn.execute(
+                    "SELECT error_class, COUNT(*) FROM failures WHERE host = ? GROUP BY error_class ORDER BY COUNT(*) DESC LIMIT 3",
+                    (host,)
+                ).fetchall()
+                for host, _, _ in hosts
+            }
+
+        logger.info(f"Failure ledger: {n_failed_urls} failed urls, {n_blocked} of them are not retried yet")
+        for host, n_success, n_failed in hosts:
+            errors = ", ".join(f"{cls}: {count}" for cls, count in host2errors[host])
+            logger.info(f"    {host}: failed {n_failed}/{n_success + n_failed} ({n_failed / (n_success + n_failed):.1%}), {errors}")
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
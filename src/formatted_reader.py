@@ -0,0 +1,67 @@
+from typing import Iterator
+import json
+import os
+
+
+def read_jsonl(path: str) -> Iterator[dict]:
+    """ One json object per line """
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def read_json_array(path: str) -> Iterator[dict]:
+    """
+    Json array of objects, parsed incrementally with ijson.
+    If ijson is not installed, falls back to loading the whole file.
+    """
+    try:
+        import ijson
+    except ImportError:
+        with open(path) as f:
+            yield from json.load(f)
+        return
+
+    with open(path, "rb") as f:
+        # use_float keeps numbers as python floats instead of Decimal, like json.load does
+        yield from ijson.items(f, "item", use_float=True)
+
+
+def read_parquet(path: str, chunk_size: int = 10000) -> Iterator[dict]:
+    """ Parquet file read by record batches of chunk_size rows """
+    import pyarrow.parquet as pq
+
+    parquet_file = pq.ParquetFile(path)
+    for batch in parquet_file.iter_batches(batch_size=chunk_size):
+        yield from batch.to_pylist()
+
+
+def read_arrow(path: str) -> Iterator[dict]:
+    """ Arrow IPC (feather v2) file read by its record batches """
+    import pyarrow as pa
+
+    with pa.memory_map(path) as source:
+        reader = pa.ipc.open_file(source)
+        for i in range(reader.num_record_batches):
+            yield from reader.get_batch(i).to_pylist()
+
+
+ext2reader = {
+    ".jsonl": read_jsonl,
+    ".json": read_json_array,
+    ".parquet": read_parquet,
+    ".arrow": read_arrow,
+    ".feather": read_arrow
+}
+
+
+def read_formatted_data(path: str) -> Iterator[dict]:
+    """
+    Lazily yields items of formatted data, format is chosen by file extension.
+    Memory does not depend on the size of the file.
+    """
+    ext = os.path.splitext(path)[1]
+    if ext not in ext2reader:
+        raise Exception(f"No reader for formatted data with extension {ext}")
+    return ext2reader[ext](path)
@@ -0,0 +1,157 @@
+from typing import Optional, Dict
+from collections import OrderedDict
+from io import BytesIO
+import hashlib
+import threading
+import os
+
+from .image_decode import decode_image
+
+
+class ImageCache:
+    """
+    Content addressed on-disk cache of downloaded images, keyed by URL hash.
+    Stores raw bytes and optionally resized JPEG thumbnails, total size is kept under max_bytes
+    by evicting least recently used files. Safe to use from several threads of one process,
+    several processes may share the directory (each of them evicts by its own view of it).
+    """
+    def __init__(self, cache_dir: str, max_bytes: int = 50 * 2**30, thumbnail_size: Optional[int] = None):
+        """
+            cache_dir - root directory of the cache
+            max_bytes - size cap of all stored files
+            thumbnail_size - if set, thumbnail with this max edge is stored together with raw bytes
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.thumbnail_size = thumbnail_size
+
+        self.lock = threading.Lock()
+        # path -> size, ordered from least to most recently used
+        self.lru: Dict[str, int] = OrderedDict()
+        self.total_bytes = 0
+        self._scan()
+
+    def _scan(self):
+        """ Restores LRU order of already stored files by their modification time """
+        os.makedirs(self.cache_dir, exist_ok=True)
+        entries = []
+        for root, _, files in os.walk(self.cache_dir):
+            for name in files:
+                path = os.path.join(root, name)
+                if name.endswith(".tmp"):
+                    # left by interrupted write
+                    os.remove(path)
+                    continue
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, path, stat.st_size))
+
+        for _, path, size in sorted(entries):
+            self.lru[path] = size
+            self.total_bytes += size
+
+    @staticmethod
+    def key(url: str) -> str:
+        return hashlib.sha256(url.encode()).hexdigest()
+
+    def _path(self, kind: str, url: str) -> str:
+        key = self.key(url)
+        return os.path.join(self.cache_dir, kind, key[:2], key)
+
+    def raw_path(self, url: str) -> str:
+        return self._path("raw", url)
+
+    def _thumbnail_path(self, url: str, max_edge: int) -> str:
+        return self._path(f"thumb_{max_edge}", url) + ".jpg"
+
+    def _touch(self, path: str) -> bool:
+        """ Marks file as recently used, returns False if it is not in cache """
+        with self.lock:
+            if path not in self.lru:
+                return False
+            self.lru.move_to_end(path)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            # evicted by another process
+            with self.lock:
+                self.total_bytes -= self.lru.pop(path, 0)
+            return False
+        return True
+
+    def _store(self, path: str, content: bytes):
+        """ Atomically writes file and evicts least recently used ones above size cap """
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(content)
+        os.replace(tmp_path, path)
+
+        evicted = []
+        with self.lock:
+            self.total_bytes -= self.lru.pop(path, 0)
+            self.lru[path] = len(content)
+            self.total_bytes += len(content)
+            while self.total_bytes > self.max_bytes and len(self.lru) > 1:
+                old_path, old_size = self.lru.popitem(last=False)
+                self.total_bytes -= old_size
+                evicted.append(old_path)
+
+        for old_path in evicted:
+            try:
+                os.remove(old_path)
+            except FileNotFoundError:
+                pass
+
+    def get(self, url: str) -> Optional[bytes]:
+        """ Returns raw bytes of the image or None if it is not cached """
+        path = self.raw_path(url)
+        if not self._touch(path):
+            return None
+        try:
+            with open(path, "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def put(self, url: str, content: bytes):
+        """ Stores raw bytes of the image and its thumbnail if thumbnail_size is set """
+        self._store(self.raw_path(url), content)
+        if self.thumbnail_size is not None:
+            try:
+                self._store(self._thumbnail_path(url, self.thumbnail_size), self.make_thumbnail(content, self.thumbnail_size))
+            except Exception:
+                # raw bytes are kept anyway, decoding errors are reported by consumers
+                pass
+
+    def thumbnail_path(self, url: str, max_edge: Optional[int] = None) -> Optional[str]:
+        """
+        Returns local path of the thumbnail, creating it from raw bytes if needed.
+        Returns None if image is not cached or can not be decoded.
+        """
+        max_edge = max_edge if max_edge is not None else self.thumbnail_size
+        if max_edge is None:
+            raise ValueError("max_edge has to be specified if cache has no thumbnail_size")
+
+        path = self._thumbnail_path(url, max_edge)
+        if self._touch(path):
+            return path
+
+        content = self.get(url)
+        if content is None:
+            return None
+        try:
+            self._store(path, self.make_thumbnail(content, max_edge))
+        except Exception:
+            return None
+        return path
+
+    @staticmethod
+    def make_thumbnail(content: bytes, max_edge: int, quality: int = 90) -> bytes:
+        """ Decodes image, downsizes it to max_edge keeping aspect ratio and encodes as JPEG """
+        img = decode_image(content, max_edge=max_edge)
+        out = BytesIO()
+        img.save(out, format="JPEG", quality=quality)
+        return out.getvalue()
@@ -0,0 +1,33 @@
+from typing import Optional
+from io import BytesIO
+
+from PIL import Image
+
+
+def decode_image(
+        content: bytes,
+        min_edge: Optional[int] = None,
+        max_edge: Optional[int] = None,
+        max_pixels: Optional[int] = None
+    ) -> Image.Image:
+    """
+    Decodes raw image bytes into RGB Image. Raises on failure.
+    JPEGs are decoded at reduced scale (draft mode) if it keeps requested size, so large images are never decoded in full:
+        min_edge - image is downscaled while its shortest edge stays not less than min_edge,
+            other formats are reduced by integer factor after decoding
+        max_edge - image is downsized to fit max_edge x max_edge keeping aspect ratio
+        max_pixels - images having more pixels to decode are rejected, so memory of one image is bounded
+    """
+    img = Image.open(BytesIO(content))
+    draft_edge = max((edge for edge in (min_edge, max_edge) if edge is not None), default=None)
+    if draft_edge is not None:
+        # DCT scaling: 1/2, 1/4 or 1/8 of the pixels are decoded, both edges stay not less than draft_edge
+        img.draft("RGB", (draft_edge, draft_edge))
+    if max_pixels is not None and img.width * img.height > max_pixels:
+        raise ValueError(f"Image of size {img.size} has more than {max_pixels} pixels")
+    img = img.convert("RGB")
+    if min_edge is not None and (factor := min(img.size) // min_edge) >= 2:
+        img = img.reduce(factor)
+    if max_edge is not None:
+        img.thumbnail((max_edge, max_edge))
+    return img
@@ -0,0 +1,54 @@
+from typing import List, Tuple, Optional
+from io import BytesIO
+import math
+
+from PIL import Image, ImageDraw, ImageFont
+
+from .image_decode import decode_image
+
+
+# extension of exported files by PIL format
+format2ext = {
+    "JPEG": "jpg",
+    "WEBP": "webp"
+}
+
+
+def _encode(img: Image.Image, format: str, quality: int) -> bytes:
+    if format not in format2ext:
+        raise Exception(f"No export format named {format}")
+    out = BytesIO()
+    img.save(out, format=format, quality=quality)
+    return out.getvalue()
+
+
+def reencode(content: bytes, max_edge: Optional[int] = 1024, format: str = "JPEG", quality: int = 85) -> bytes:
+    """ Decodes image, downsizes it to max_edge and encodes in format, runs in process pool """
+    return _encode(decode_image(content, max_edge=max_edge), format, quality)
+
+
+def contact_sheet(
+        tiles: List[Tuple[int, bytes]],
+        tile_size: int = 256,
+        columns: int = 6,
+        format: str = "JPEG",
+        quality: int = 85
+    ) -> bytes:
+    """
+    Single grid image of (number, image bytes) tiles, every tile is labeled with its number,
+    images which can not be decoded are left blank. Runs in process pool.
+    """
+    rows = max(math.ceil(len(tiles) / columns), 1)
+    sheet = Image.new("RGB", (columns * tile_size, rows * tile_size), "white")
+    draw = ImageDraw.Draw(sheet)
+    font = ImageFont.load_default()
+    for cell, (number, content) in enumerate(tiles):
+        x, y = (cell % columns) * tile_size, (cell // columns) * tile_size
+        try:
+            img = decode_image(content, max_edge=tile_size)
+            sheet.paste(img, (x + (tile_size - img.width) // 2, y + (tile_size - img.height) // 2))
+        except Exception:
+            pass
+        draw.rectangle((x, y, x + 24, y + 14), fill="black")
+        draw.text((x + 3, y + 2), str(number), fill="white", font=font)
+    return _encode(sheet, format, quality)
@@ -0,0 +1,114 @@
+from typing import Dict, Optional
+from urllib.parse import urlsplit
+import asyncio
+import random
+
+import httpx
+
+from .image_cache import ImageCache
+
+
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+class ImageFetcher:
+    """
+    Long-lived pooled HTTP client shared by everything that downloads images.
+    Keeps connections alive (HTTP/2 where server supports it), limits total and per-host
+    concurrency and retries 429/5xx responses and transport errors with exponential backoff.
+    """
+    def __init__(
+            self,
+            max_connections: int = 128,
+            max_per_host: int = 16,
+            timeout: float = 30.0,
+            max_retries: int = 3,
+            backoff: float = 0.5,
+            max_backoff: float = 30.0,
+            http2: bool = True,
+            cache: Optional[ImageCache] = None
+        ):
+        """
+            max_connections - max number of simultaneous requests (and pooled connections)
+            max_per_host - max number of simultaneous requests to one host
+            timeout - seconds for connect/read/write/pool timeouts
+            max_retries - number of retries after the first attempt
+            backoff - first retry delay in seconds, doubled on every next attempt
+            max_backoff - upper bound for one retry delay
+            http2 - negotiate HTTP/2 (requires httpx[http2])
+            cache - if set, images are read from and stored to it
+        """
+        self.cache = cache
+        self.max_per_host = max_per_host
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+        self.client = httpx.AsyncClient(
+            http2=http2,
+            timeout=httpx.Timeout(timeout),
+            limits=httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=max_connections
+            ),
+            follow_redirects=True
+        )
+        self.total_semaphore = asyncio.Semaphore(max_connections)
+        self.host2semaphore: Dict[str, asyncio.Semaphore] = {}
+
+    async def __aenter__(self) -> "ImageFetcher":
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.aclose()
+
+    async def aclose(self):
+        await self.client.aclose()
+
+    def _host_semaphore(self, url: str) -> asyncio.Semaphore:
+        host = urlsplit(url).netloc
+        if host not in self.host2semaphore:
+            self.host2semaphore[host] = asyncio.Semaphore(self.max_per_host)
+        return self.host2semaphore[host]
+
+    def _retry_delay(self, attempt: int, response: Optional[httpx.Response]) -> float:
+        """ Uses Retry-After header if server sent it, otherwise exponential backoff with jitter """
+        if response is not None and "Retry-After" in response.headers:
+            try:
+                return min(float(response.headers["Retry-After"]), self.max_backoff)
+            except ValueError:
+                pass
+        delay = min(self.backoff * 2 ** attempt, self.max_backoff)
+        return delay * (0.5 + random.random() / 2)
+
+    async def fetch(self, url: str) -> bytes:
+        """
+        Returns raw bytes by URL, from cache if possible. Raises httpx exceptions if all attempts failed.
+        """
+        if self.cache is None:
+            return await self.download(url)
+
+        content = await asyncio.to_thread(self.cache.get, url)
+        if content is None:
+            content = await self.download(url)
+            await asyncio.to_thread(self.cache.put, url, content)
+        return content
+
+    async def download(self, url: str) -> bytes:
+        """
+        Downloads raw bytes by URL. Raises httpx exceptions if all attempts failed.
+        """
+        for attempt in range(self.max_retries + 1):
+            response = None
+            try:
+                async with self._host_semaphore(url), self.total_semaphore:
+                    response = await self.client.get(url)
+                if response.status_code not in RETRY_STATUS_CODES:
+                    response.raise_for_status()
+                    return response.content
+                if attempt == self.max_retries:
+                    response.raise_for_status()
+            except httpx.TransportError:
+                if attempt == self.max_retries:
+                    raise
+            await asyncio.sleep(self._retry_delay(attempt, response))
@@ -0,0 +1,94 @@
+from typing import List, Dict, Optional, Tuple
+from array import array
+from PIL import Image
+import numpy as np
+
+
+def dhash(img: Image.Image, hash_size: int = 8) -> int:
+    """
+    64-bit difference hash: signs of horizontal gradients of the downsized grayscale image.
+    Robust to rescaling and re-encoding, so resized copies of one photo get close hashes.
+    """
+    small = img.convert("L").resize((hash_size + 1, hash_size), Image.Resampling.BILINEAR)
+    pixels = np.asarray(small, dtype=np.int16)
+    bits = (pixels[:, 1:] > pixels[:, :-1]).flatten()
+    return int.from_bytes(np.packbits(bits).tobytes(), "big")
+
+
+class NearDuplicateFilter:
+    """
+    Finds images whose perceptual hash is within max_distance bits from an already seen one.
+    Hashes are split into max_distance + 1 bands: by pigeonhole principle close hashes share
+    at least one band exactly, so only items from matching buckets are compared.
+    Seen items are kept compactly: hashes in one uint64 array, urls in one utf-8 buffer,
+    buckets hold int64 indices of items, so memory is about 8 * (n_bands + 2) bytes plus url length per image.
+    """
+    def __init__(self, max_distance: int = 4, max_examples: int = 20):
+        self.max_distance = max_distance
+        self.max_examples = max_examples
+
+        self.n_bands = max_distance + 1
+        # bit offsets of bands covering all 64 bits
+        self.band_bounds = [i * 64 // self.n_bands for i in range(self.n_bands + 1)]
+        # band index -> band value -> indices of seen items
+        self.buckets: List[Dict[int, array]] = [{} for _ in range(self.n_bands)]
+
+        self.n_seen = 0
+        self.hashes = np.empty(1024, dtype=np.uint64)
+        self.url_bytes = bytearray()
+        self.url_offsets = array("q", [0])
+
+        self.n_near_duplicates = 0
+        self.examples: List[Tuple[str, str]] = []
+
+    def _bands(self, h: int) -> List[int]:
+        return [
+            (h >> start) & ((1 << (end - start)) - 1)
+            for start, end in zip(self.band_bounds[:-1], self.band_bounds[1:])
+        ]
+
+    def _url(self, i: int) -> str:
+        return self.url_bytes[self.url_offsets[i]: self.url_offsets[i + 1]].decode()
+
+    def _add(self, url: str, h: int, bands: List[int]):
+        if self.n_seen == len(self.hashes):
+            self.hashes = np.resize(self.hashes, 2 * len(self.hashes))
+        self.hashes[self.n_seen] = h
+        self.url_bytes += url.encode()
+        self.url_offsets.append(len(self.url_bytes))
+        for bucket, band in zip(self.buckets, bands):
+            if band not in bucket:
+                bucket[band] = array("q")
+            bucket[band].append(self.n_seen)
+        self.n_seen += 1
+
+    def match(self, url: str, h: int) -> Optional[str]:
+        """
+        Returns URL of the already seen near-duplicate image, otherwise remembers this one and returns None.
+        """
+        bands = self._bands(h)
+        for bucket, band in zip(self.buckets, bands):
+            if band not in bucket:
+                continue
+            candidates = np.array(bucket[band], dtype=np.int64)
+            # hamming distances of all candidates at once: popcount of xor through unpacked bits
+            xor = self.hashes[candidates] ^ np.uint64(h)
+            distances = np.unpackbits(xor.view(np.uint8).reshape(-1, 8), axis=1).sum(axis=1)
+            close = np.flatnonzero(distances <= self.max_distance)
+            if len(close) > 0:
+                other_url = self._url(int(candidates[close[0]]))
+                self.n_near_duplicates += 1
+                if len(self.examples) < self.max_examples:
+                    self.examples.append((url, other_url))
+                return other_url
+
+        self._add(url, h, bands)
+        return None
+
+    def report(self, logger):
+        if self.n_near_duplicates == 0:
+            logger.info("No near-duplicate images found.")
+            return
+        logger.warning(f"Skipped {self.n_near_duplicates} near-duplicate images")
+        examples = ", ".join(f"{url} ~ {other_url}" for url, other_url in self.examples)
+        logger.warning(f"First {len(self.examples)} near-duplicates: {examples}")
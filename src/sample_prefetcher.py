@@ -0,0 +1,191 @@
+from typing import List, Optional, NamedTuple, Deque, Set
+from collections import deque
+import threading
+import asyncio
+
+from .samplers_package import NamedSampler
+from .samplers_package.samplers import URLMetaPair
+from .image_fetcher import ImageFetcher
+from .image_cache import ImageCache
+
+
+class PrefetchedSample(NamedTuple):
+    main_item: URLMetaPair
+    nearest_items: List[URLMetaPair]
+    # local thumbnail paths, or urls if images are not cached
+    main_img: str
+    nearest_imgs: List[str]
+
+
+class SamplePrefetcher:
+    """
+    Keeps a queue of upcoming samples with their images already downloaded and resized to thumbnails.
+    Queue is refilled by a background thread, sampler is shared with the caller, so every access to it is under lock.
+    Sampled main items stay in sampler until excluded, so main items of queued and shown samples are reserved
+    and not queued twice. Queued samples containing excluded ids are dropped, and so are downloaded samples
+    containing ids excluded during their download. Nearest items excluded before are kept, as without prefetching.
+    When every remaining item is reserved, pop returns None instead of waiting for samples that can not come.
+    """
+    def __init__(
+            self,
+            sampler: NamedSampler,
+            logger,
+            n_nearest: int,
+            prefetch_size: int = 8,
+            fetcher_cfg: Optional[dict] = None,
+            cache: Optional[ImageCache] = None,
+            thumbnail_size: Optional[int] = None
+        ):
+        """
+            prefetch_size - number of samples kept ready
+            fetcher_cfg - kwargs of ImageFetcher downloading images into cache
+            cache - images are downloaded only if it is specified, otherwise urls are shown and loaded by browser
+            thumbnail_size - max edge of shown thumbnails
+        """
+        self.sampler = sampler
+        self.logger = logger
+        self.n_nearest = n_nearest
+        self.prefetch_size = prefetch_size
+        self.fetcher_cfg = fetcher_cfg or {}
+        self.cache = cache
+        self.thumbnail_size = thumbnail_size
+
+        self.cond = threading.Condition()
+        self.queue: Deque[PrefetchedSample] = deque()
+        self.current: Optional[PrefetchedSample] = None
+        # set when every remaining item is reserved, worker waits for pop or exclusion to release some
+        self.stalled = False
+        self.exhausted = False
+        self.stopping = False
+        self.error: Optional[BaseException] = None
+        # ids excluded while the current batch is downloaded, None when no batch is downloaded
+        self.excluded_during_download: Optional[Set[str]] = None
+
+        self.thread = threading.Thread(target=self._run, name="sample_prefetcher", daemon=True)
+        self.thread.start()
+
+    def _reserved_ids(self) -> Set[str]:
+        """ Main ids of queued and currently shown samples, has to be called under lock """
+        samples = list(self.queue) + ([self.current] if self.current is not None else [])
+        return {sample.main_item.id for sample in samples}
+
+    def _run(self):
+        try:
+            asyncio.run(self._refill_forever())
+        except BaseException as e:
+            self.logger.error(f"Sample prefetcher stopped: {e}")
+            with self.cond:
+                self.error = e
+                self.cond.notify_all()
+
+    async def _refill_forever(self):
+        if self.cache is None:
+            return await self._refill_loop(None)
+        async with ImageFetcher(**self.fetcher_cfg, cache=self.cache) as fetcher:
+            await self._refill_loop(fetcher)
+
+    async def _refill_loop(self, fetcher: Optional[ImageFetcher]):
+        while True:
+            with self.cond:
+                while not self.stopping and (self.exhausted or self.stalled or len(self.queue) >= self.prefetch_size):
+                    self.cond.wait()
+                if self.stopping:
+                    return
+                n_nearest = self.n_nearest
+                batch = self.sampler.sample_batch(self.prefetch_size - len(self.queue), n_nearest)
+                if not batch:
+                    self.exhausted = True
+                    self.cond.notify_all()
+                    continue
+                self.excluded_during_download = set()
+
+            # images are downloaded without lock, so caller can pop and exclude meanwhile
+            samples = [await self._prefetch(fetcher, main_item, nearest_items) for main_item, nearest_items in batch]
+
+            with self.cond:
+                excluded, self.excluded_during_download = self.excluded_during_download, None
+                n_added = 0
+                for sample in samples:
+                    if n_nearest == self.n_nearest and self._is_valid(sample, excluded):
+                        self.queue.append(sample)
+                        n_added += 1
+                # samples with reserved main items are drawn again while unreserved items remain
+                self.stalled = n_added == 0 and self._n_unreserved() == 0
+                self.cond.notify_all()
+
+    def _n_unreserved(self) -> int:
+        """ Number of remaining items which are not reserved, has to be called under lock """
+        pool = self.sampler.sampler.pool
+        reserved = self.sampler.index.positions(list(self._reserved_ids()))
+        return len(pool) - sum(int(i) in pool for i in reserved)
+
+    def _is_valid(self, sample: PrefetchedSample, excluded: Set[str]) -> bool:
+        """
+        Main item is not already reserved and no item of the sample is among excluded while it was downloaded,
+        has to be called under lock
+        """
+        if sample.main_item.id in self._reserved_ids():
+            return False
+        return not excluded & {item.id for item in [sample.main_item] + sample.nearest_items}
+
+    async def _prefetch(self, fetcher: Optional[ImageFetcher], main_item: URLMetaPair, nearest_items: List[URLMetaPair]) -> PrefetchedSample:
+        main_img, *nearest_imgs = await self._local_images(fetcher, [main_item.url] + [item.url for item in nearest_items])
+        return PrefetchedSample(main_item, nearest_items, main_img, nearest_imgs)
+
+    async def _local_images(self, fetcher: Optional[ImageFetcher], urls: List[str]) -> List[str]:
+        """ Thumbnail paths of downloaded images, url is kept if cache is disabled or image could not be loaded """
+        if fetcher is None:
+            return urls
+        await asyncio.gather(*[fetcher.fetch(url) for url in urls], return_exceptions=True)
+        paths = await asyncio.gather(*[asyncio.to_thread(self.cache.thumbnail_path, url, self.thumbnail_size) for url in urls])
+        return [path or url for url, path in zip(urls, paths)]
+
+    def set_n_nearest(self, n_nearest: int):
+        """ Queued samples with other number of nearest items are dropped """
+        with self.cond:
+            if n_nearest == self.n_nearest:
+                return
+            self.n_nearest = n_nearest
+            self.queue.clear()
+            self.stalled = False
+            self.cond.notify_all()
+
+    def pop(self, timeout: Optional[float] = None) -> Optional[PrefetchedSample]:
+        """
+        Next sample, waits while queue is being filled. Returns None if no samples remaining,
+        every remaining item is reserved or timeout expired.
+        """
+        with self.cond:
+            # replaced sample is released before waiting, so worker can sample its main item again
+            self.current = None
+            self.stalled = False
+            self.cond.notify_all()
+            self.cond.wait_for(lambda: self.queue or self.exhausted or self.stalled or self.error is not None, timeout=timeout)
+            if self.error is not None:
+                raise self.error
+            self.current = self.queue.popleft() if self.queue else None
+            self.cond.notify_all()
+            return self.current
+
+    def exclude_ids(self, ids: List[str]):
+        """ Excludes ids from sampler and drops queued samples containing them """
+        ids = set(ids)
+        with self.cond:
+            self.sampler.exclude_ids(list(ids))
+            if self.excluded_during_download is not None:
+                self.excluded_during_download |= ids
+            n_queued = len(self.queue)
+            self.queue = deque(
+                sample for sample in self.queue
+                if not ids & {item.id for item in [sample.main_item] + sample.nearest_items}
+            )
+            if len(self.queue) < n_queued:
+                self.logger.debug(f"Dropped {n_queued - len(self.queue)} prefetched samples with excluded ids")
+            self.stalled = False
+            self.cond.notify_all()
+
+    def close(self):
+        with self.cond:
+            self.stopping = True
+            self.cond.notify_all()
+        self.thread.join()
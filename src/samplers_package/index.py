@@ -0,0 +1,164 @@
+from typing import List, Dict, Optional, Any
+import json
+import os
+
+import numpy as np
+import chromadb
+
+
+class SamplerIndex:
+    """
+    Collection loaded once for samplers:
+        ids - array of utf-8 encoded ids (fixed width bytes), position in it is the item index used by samplers
+        codes - (n_items, n_fields) int32 matrix of dictionary-encoded metadata columns, -1 if field is missing
+        values - per field list of original metadata values, code is position in it
+        embeddings - (n_items, dim) float32 matrix, memory-mapped from cache_dir if it is specified
+    If cache_dir is specified and cache matches collection id, size and version, collection is not read at all.
+    Collection recreated under the same name gets new id, so its cache is rebuilt.
+    version is a number changing whenever collection elements are written (UrlIndex.version), so updates
+    keeping collection size are not missed. If it is None, cache is checked by collection id and size only.
+    """
+    def __init__(
+            self,
+            collection: chromadb.Collection,
+            cache_dir: Optional[str] = None,
+            page_size: int = 10000,
+            version: Optional[int] = None
+        ):
+        self.collection = collection
+        self.page_size = page_size
+        self.collection_id = str(collection.id)
+        self.version = version
+        self._id2pos: Optional[Dict[str, int]] = None
+
+        count = collection.count()
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            prefix = os.path.join(cache_dir, collection.name)
+            self.index_path = f"{prefix}_index.npz"
+            self.embeddings_path = f"{prefix}_embeddings.npy"
+            if self._is_cached(count):
+                self._load()
+                return
+        else:
+            self.index_path = self.embeddings_path = None
+
+        self._build(count)
+        if cache_dir is not None:
+            self._save()
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def _is_cached(self, count: int) -> bool:
+        if not (os.path.exists(self.index_path) and os.path.exists(self.embeddings_path)):
+            return False
+        with np.load(self.index_path) as index:
+            if "collection_id" not in index or str(index["collection_id"]) != self.collection_id or len(index["ids"]) != count:
+                return False
+            # caches written before ids were stored as bytes are rebuilt
+            if index["ids"].dtype.kind != "S":
+                return False
+            return self.version is None or ("version" in index and int(index["version"]) == self.version)
+
+    def _allocate_embeddings(self, count: int, dim: int) -> np.ndarray:
+        """ Embeddings are written straight to the cache file if it is used, so they never have to fit in memory """
+        if self.embeddings_path is None:
+            return np.empty((count, dim), dtype=np.float32)
+        return np.lib.format.open_memmap(self.embeddings_path + ".tmp", mode="w+", dtype=np.float32, shape=(count, dim))
+
+    def _build(self, count: int):
+        """ Reads collection page by page, encoding metadata columns on the fly """
+        ids: List[str] = []
+        field2column: Dict[str, int] = {}
+        value2code: List[Dict[Any, int]] = []
+        rows: List[List[int]] = []
+        self.embeddings = None
+
+        for offset in range(0, count, self.page_size):
+            page = self.collection.get(include=["embeddings", "metadatas"], limit=self.page_size, offset=offset)
+            page_embs = np.asarray(page["embeddings"], dtype=np.float32)
+            if self.embeddings is None:
+                self.embeddings = self._allocate_embeddings(count, page_embs.shape[1])
+            self.embeddings[len(ids): len(ids) + len(page_embs)] = page_embs
+            ids.extend(page["ids"])
+
+            for meta in page["metadatas"]:
+                row = [-1] * len(field2column)
+                for field, value in (meta or {}).items():
+                    if field not in field2column:
+                        field2column[field] = len(field2column)
+                        value2code.append({})
+                        row.append(-1)
+                    codes = value2code[field2column[field]]
+                    if value not in codes:
+                        codes[value] = len(codes)
+                    row[field2column[field]] = codes[value]
+                rows.append(row)
+
+        if self.embeddings is None:
+            self.embeddings = self._allocate_embeddings(0, 0)
+        # bytes take 1 byte per character of ascii ids (uuids), numpy unicode strings take 4
+        self.ids = np.array([id.encode() for id in ids], dtype=np.bytes_)
+        self.fields = list(field2column)
+        self.values: List[List[Any]] = [list(codes) for codes in value2code]
+        # rows read before a field first appeared are shorter
+        self.codes = np.full((len(rows), len(self.fields)), -1, dtype=np.int32)
+        for i, row in enumerate(rows):
+            self.codes[i, :len(row)] = row
+
+    def _save(self):
+        self.embeddings.flush()
+        del self.embeddings
+        os.replace(self.embeddings_path + ".tmp", self.embeddings_path)
+        # reopened read-only, so pages are loaded lazily and shared between processes
+        self.embeddings = np.load(self.embeddings_path, mmap_mode="r")
+
+        with open(self.index_path + ".tmp", "wb") as f:
+            np.savez(
+                f,
+                ids=self.ids,
+                collection_id=np.array(self.collection_id),
+                version=np.array(self.version if self.version is not None else -1),
+                codes=self.codes,
+                fields=np.array(json.dumps(self.fields)),
+                values=np.array(json.dumps(self.values))
+            )
+        os.replace(self.index_path + ".tmp", self.index_path)
+
+    def _load(self):
+        with np.load(self.index_path) as index:
+            self.ids = index["ids"]
+            self.codes = index["codes"]
+            self.fields = json.loads(str(index["fields"]))
+            self.values = json.loads(str(index["values"]))
+        self.embeddings = np.load(self.embeddings_path, mmap_mode="r")
+
+    def field_codes(self, fields: List[str]) -> np.ndarray:
+        """ (n_items, len(fields)) matrix of codes of the given metadata fields """
+        for field in fields:
+            if field not in self.fields:
+                raise ValueError(f"No metadata field {field} in collection {self.collection.name}")
+        return self.codes[:, [self.fields.index(field) for field in fields]]
+
+    def metadata(self, i: int) -> dict:
+        """ Decodes metadata of the item """
+        return {
+            field: self.values[column][code]
+            for column, (field, code) in enumerate(zip(self.fields, self.codes[i]))
+            if code != -1
+        }
+
+    def id(self, i: int) -> str:
+        return self.ids[i].decode()
+
+    def id2pos(self) -> Dict[str, int]:
+        """ Mapping of ids to positions, built on first use """
+        if self._id2pos is None:
+            self._id2pos = {id.decode(): i for i, id in enumerate(self.ids.tolist())}
+        return self._id2pos
+
+    def positions(self, ids: List[str]) -> np.ndarray:
+        """ Positions of the given ids, unknown ids are skipped """
+        id2pos = self.id2pos()
+        return np.array([id2pos[id] for id in ids if id in id2pos], dtype=np.int64)
@@ -2,17 +2,46 @@ from typing import Optional, Tuple, List
 import chromadb
 
 from .samplers import *
-import logging
+from .searches import *
+from .index import SamplerIndex
 
 name2sampler_class = {
     "rand": AnnRandomSampler,
-    "meta_weighted_rand": AnnMetaWeightedRandomSampler
+    "meta_weighted_rand": AnnMetaWeightedRandomSampler,
+    "cluster_weighted_rand": AnnClusterWeightedRandomSampler
+}
+
+name2search_class = {
+    "chroma": ChromaSearch,
+    "exact": ExactSearch,
+    "faiss": FaissSearch,
+    "hnswlib": HnswSearch
 }
 
 
 class NamedSampler:
-    def __init__(self, collection: chromadb.Collection,  meta_fields: dict, name: str, cfg: dict):
-        self.sampler: BaseAnnSampler = name2sampler_class[name](collection, cfg)
+    def __init__(
+            self,
+            collection: chromadb.Collection,
+            meta_fields: dict,
+            name: str,
+            cfg: dict,
+            index_cache_dir: Optional[str] = None,
+            search_name: str = "chroma",
+            search_cfg: Optional[dict] = None,
+            index_version: Optional[int] = None
+        ):
+        """
+            Collection is loaded into SamplerIndex once (and cached in index_cache_dir if specified),
+            samplers read main items from it without requests to collection.
+            index_version - number changing on every collection write (UrlIndex.version), cached index of other version is rebuilt
+            Nearest items are found with neighbour search named search_name (chroma query by default).
+        """
+        if search_name not in name2search_class:
+            raise Exception(f"No neighbour search named {search_name}")
+        self.index = SamplerIndex(collection, cache_dir=index_cache_dir, version=index_version)
+        self.search: BaseNeighbourSearch = name2search_class[search_name](collection, self.index, search_cfg or {})
+        self.sampler: BaseAnnSampler = name2sampler_class[name](collection, self.index, self.search, cfg)
         self.meta_fields = meta_fields
 
 
@@ -20,6 +49,14 @@ class NamedSampler:
         self.sampler.exclude_ids(ids)
 
 
+    def filter_metadata(self, items: List[URLMetaPair]) -> None:
+        """ Only specified meta fields are remaining """
+        if self.meta_fields is None:
+            return
+        for item in items:
+            item.metadata = {field: item.metadata.get(field) for field in self.meta_fields}
+
+
     def __call__(self, n_nearest: int) -> Optional[Tuple[URLMetaPair, List[URLMetaPair]]]:
         sample_res = self.sampler(n_nearest)
         # no samples remaining
@@ -28,15 +65,12 @@ class NamedSampler:
         
         # there are samples
         main_item, nearest_items = sample_res
+        self.filter_metadata([main_item] + nearest_items)
+        return main_item, nearest_items
 
-        # filter metadata fields
-        if self.meta_fields is None:
-            return main_item, nearest_items
 
-        # only specified meta fields are remaining
-        main_item.metadata = {field: main_item.metadata.get(field) for field in self.meta_fields}
-        for item in nearest_items:
-            item.metadata = {field: item.metadata.get(field) for field in self.meta_fields}
-
-        return main_item, nearest_items
-    
+    def sample_batch(self, k: int, n_nearest: int) -> List[Tuple[URLMetaPair, List[URLMetaPair]]]:
+        """ Up to k samples without common items, empty if no samples remaining """
+        batch = self.sampler.sample_batch(k, n_nearest)
+        self.filter_metadata([item for main_item, nearest_items in batch for item in [main_item] + nearest_items])
+        return batch
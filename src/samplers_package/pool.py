@@ -0,0 +1,165 @@
+from typing import Optional
+import numpy as np
+
+
+class SumTree:
+    """
+    Non-negative weights of n leaves with O(log n) update and weighted draw.
+    Every node holds the sum of its children, recomputed from them on update, so zero weights stay exactly zero.
+    """
+    def __init__(self, weights: np.ndarray):
+        self.n = len(weights)
+        self.leaves = 1
+        while self.leaves < self.n:
+            self.leaves *= 2
+        tree = np.zeros(2 * self.leaves, dtype=np.float64)
+        tree[self.leaves: self.leaves + self.n] = weights
+        for i in range(self.leaves - 1, 0, -1):
+            tree[i] = tree[2 * i] + tree[2 * i + 1]
+        # python floats are faster than numpy scalars in per-node loops
+        self.tree = tree.tolist()
+
+    @property
+    def total(self) -> float:
+        return self.tree[1]
+
+    def __getitem__(self, i: int) -> float:
+        return self.tree[self.leaves + i]
+
+    def update(self, i: int, weight: float):
+        node = self.leaves + i
+        self.tree[node] = float(weight)
+        node //= 2
+        while node > 0:
+            self.tree[node] = self.tree[2 * node] + self.tree[2 * node + 1]
+            node //= 2
+
+    def find(self, u: float) -> int:
+        """ Leaf whose cumulative weight range contains u, u in [0, total) """
+        node = 1
+        while node < self.leaves:
+            left = self.tree[2 * node]
+            if u < left:
+                node = 2 * node
+            else:
+                u -= left
+                node = 2 * node + 1
+        return node - self.leaves
+
+    def draw(self, rng: np.random.Generator) -> int:
+        """ Leaf drawn with probability proportional to its weight, total has to be positive """
+        if self.total <= 0:
+            raise ValueError("All weights are zero")
+        while True:
+            i = self.find(rng.random() * self.total)
+            # rounding at range boundaries can reach zero leaf, it is redrawn
+            if i < self.n and self[i] > 0:
+                return i
+
+
+class RemainingPool:
+    """
+    Set of remaining item positions with O(1) removal and O(1) uniform draw.
+    Remaining positions are kept densely in the first `size` cells of items, removed position is
+    swapped with the last remaining one; slots maps position -> its cell, so position is remaining
+    if its cell is below size.
+    If categories (int code per position) are given, pool also keeps an inverted index: positions
+    sorted by category once with argsort, every category owns a segment of it with remaining positions
+    kept densely at its start in the same way. So counts per category and draws within a category are O(1) too.
+    If category weights are set, they are kept in a sum tree where categories without remaining items
+    have zero weight, so weighted category draw is O(log number of categories).
+    """
+    def __init__(self, n: int, categories: Optional[np.ndarray] = None, seed: Optional[int] = None):
+        self.items = np.arange(n, dtype=np.int64)
+        self.slots = np.arange(n, dtype=np.int64)
+        self.size = n
+        self.rng = np.random.default_rng(seed)
+
+        self.categories = categories
+        self.counts = np.bincount(categories) if categories is not None and n > 0 else np.zeros(0, dtype=np.int64)
+        if categories is not None:
+            self.grouped = np.argsort(categories, kind="stable")
+            self.group_slots = np.empty(n, dtype=np.int64)
+            self.group_slots[self.grouped] = np.arange(n)
+            self.starts = np.cumsum(self.counts) - self.counts
+        self.category_weights: Optional[np.ndarray] = None
+        self.weight_tree: Optional[SumTree] = None
+
+    def set_category_weights(self, weights: np.ndarray):
+        """ Weights of categories used by draw_category, exhausted categories are not drawn until items are added back """
+        self.category_weights = np.asarray(weights, dtype=np.float64)
+        self.weight_tree = SumTree(np.where(self.counts > 0, self.category_weights, 0.0))
+
+    def __len__(self) -> int:
+        return self.size
+
+    def __contains__(self, i: int) -> bool:
+        return self.slots[i] < self.size
+
+    def remaining(self) -> np.ndarray:
+        """ View of remaining positions, in no particular order """
+        return self.items[:self.size]
+
+    def remaining_in(self, category: int) -> np.ndarray:
+        """ View of remaining positions of the category, in no particular order """
+        start = self.starts[category]
+        return self.grouped[start: start + self.counts[category]]
+
+    @staticmethod
+    def _swap(items: np.ndarray, slots: np.ndarray, i: int, slot: int):
+        """ Swaps position i with the one in the given cell """
+        other = items[slot]
+        items[slots[i]], items[slot] = other, i
+        slots[other], slots[i] = slots[i], slot
+
+    def remove(self, i: int) -> bool:
+        """ Removes position, returns False if it was already removed """
+        if self.slots[i] >= self.size:
+            return False
+
+        # swapped with the last remaining position and left behind the boundary
+        self._swap(self.items, self.slots, i, self.size - 1)
+        self.size -= 1
+        if self.categories is not None:
+            category = self.categories[i]
+            self._swap(self.grouped, self.group_slots, i, self.starts[category] + self.counts[category] - 1)
+            self.counts[category] -= 1
+            if self.weight_tree is not None and self.counts[category] == 0:
+                self.weight_tree.update(category, 0.0)
+        return True
+
+    def add(self, i: int) -> bool:
+        """ Returns removed position back to the pool, returns False if it is already there """
+        if self.slots[i] < self.size:
+            return False
+
+        self._swap(self.items, self.slots, i, self.size)
+        self.size += 1
+        if self.categories is not None:
+            category = self.categories[i]
+            self._swap(self.grouped, self.group_slots, i, self.starts[category] + self.counts[category])
+            self.counts[category] += 1
+            if self.weight_tree is not None and self.counts[category] == 1:
+                self.weight_tree.update(category, self.category_weights[category])
+        return True
+
+    def remove_many(self, positions: np.ndarray) -> int:
+        """ Removes positions, returns number of actually removed ones """
+        return sum(self.remove(i) for i in positions.tolist())
+
+    def draw(self) -> int:
+        """ Uniformly random remaining position, the pool has to be non-empty """
+        return int(self.items[self.rng.integers(self.size)])
+
+    def draw_category(self) -> int:
+        """ Category with remaining items drawn according to category weights, they have to be set """
+        return self.weight_tree.draw(self.rng)
+
+    def draw_from(self, category: int) -> int:
+        """ Uniformly random remaining position of the category, the category has to be non-empty """
+        return int(self.grouped[self.starts[category] + self.rng.integers(self.counts[category])])
+
+    def sample(self, k: int) -> np.ndarray:
+        """ Up to k distinct uniformly random remaining positions """
+        k = min(k, self.size)
+        return self.items[self.rng.choice(self.size, size=k, replace=False)]
@@ -1,4 +1,5 @@
 from .base import URLMetaPair, BaseAnnSampler
 
 from .rand import AnnRandomSampler
-from .meta_weighted_rand import AnnMetaWeightedRandomSampler
\ No newline at end of file
+from .meta_weighted_rand import AnnMetaWeightedRandomSampler
+from .cluster_weighted_rand import AnnClusterWeightedRandomSampler
@@ -1,7 +1,13 @@
 from typing import List, Tuple, Optional
 from abc import ABC, abstractmethod
+import numpy as np
+import chromadb
 from pydantic import BaseModel
 
+from ..index import SamplerIndex
+from ..pool import RemainingPool
+from ..searches import BaseNeighbourSearch
+
 
 class URLMetaPair(BaseModel):
     id: str
@@ -10,15 +16,93 @@ class URLMetaPair(BaseModel):
 
 
 class BaseAnnSampler(ABC):
+    def __init__(
+            self,
+            collection: chromadb.Collection,
+            index: SamplerIndex,
+            search: BaseNeighbourSearch,
+            categories: Optional[np.ndarray] = None,
+            seed: Optional[int] = None
+        ):
+        """
+            Remaining items are kept in pool, categories (int code per item) let it count remaining items per category.
+            Nearest items are found with the given search.
+        """
+        self.collection = collection
+        self.index = index
+        self.search = search
+        self.pool = RemainingPool(len(index), categories=categories, seed=seed)
+
+
     @abstractmethod
+    def draw_position(self) -> int:
+        """ Position of the next main item among remaining ones, pool is guaranteed to be non-empty """
+        pass
+
+
     def __call__(self, n_nearest: int) -> Optional[Tuple[URLMetaPair, List[URLMetaPair]]]:
         """ Returns some item and list of nearest items, if no remaining returns None"""
-        pass 
+        batch = self.sample_batch(1, n_nearest)
+        return batch[0] if batch else None
 
 
-    @abstractmethod
     def exclude_ids(self, ids: List[str]) -> None:
-        """ To guarantee that ids are going to be repeated """
-        pass
+        """ To guarantee that ids are not going to be repeated """
+        self.pool.remove_many(self.index.positions(ids))
+
+
+    def item(self, i: int) -> URLMetaPair:
+        """ Item by its position in index, without requests to collection """
+        meta = self.index.metadata(i)
+        return URLMetaPair(
+            id=self.index.id(i),
+            url=meta["url"],
+            metadata=meta
+        )
+
+
+    def draw_positions(self, k: int) -> np.ndarray:
+        """ Up to k distinct main items, drawn one by one, they stay in pool until excluded by caller """
+        drawn = []
+        while len(drawn) < k and len(self.pool) > 0:
+            i = self.draw_position()
+            self.pool.remove(i)
+            drawn.append(i)
+        for i in drawn:
+            self.pool.add(i)
+        return np.array(drawn, dtype=np.int64)
+
+
+    def sample_batch(self, k: int, n_nearest: int, overfetch: Optional[int] = None) -> List[Tuple[URLMetaPair, List[URLMetaPair]]]:
+        """
+        Returns up to k distinct main items with their nearest items, found by one batched search.
+        Any item appears at most once in the batch: as a main item or among nearest of the first main item
+        it is close to. To keep lists full, overfetch extra results are queried (n_nearest by default if k > 1).
+        If no remaining returns empty list.
+        """
+        positions = self.draw_positions(k)
+        if len(positions) == 0:
+            return []
+        if overfetch is None:
+            overfetch = n_nearest if len(positions) > 1 else 0
 
+        main_items = [self.item(i) for i in positions.tolist()]
+        nearest_positions, _ = self.search.search(np.asarray(self.index.embeddings[positions]), n_nearest + 1 + overfetch)
 
+        used_positions = set(positions.tolist())
+        batch = []
+        for main_item, row in zip(main_items, nearest_positions.tolist()):
+            nearest_items = []
+            for i in row:
+                if len(nearest_items) == n_nearest:
+                    break
+                # rows are padded with -1 if less items are found
+                if i == -1 or i in used_positions:
+                    continue
+                item = self.item(i)
+                if item.url == main_item.url:
+                    continue
+                used_positions.add(i)
+                nearest_items.append(item)
+            batch.append((main_item, nearest_items))
+        return batch
@@ -1,76 +1,100 @@
-from typing import List, Tuple
-import random
+from typing import Optional, Tuple
+import os
+
+import numpy as np
 import chromadb
-from .base import BaseAnnSampler, URLMetaPair
-from sklearn.cluster import KMeans
+from sklearn.cluster import MiniBatchKMeans
+
+from .base import BaseAnnSampler
+from .weighting import category_weights
+from ..index import SamplerIndex
+from ..searches import BaseNeighbourSearch
 
 
 class AnnClusterWeightedRandomSampler(BaseAnnSampler):
-    def __init__(self, collection: chromadb.Collection, cfg: dict):
-        self.collection = collection
-        self.ids: List[str] = collection.get()["ids"]
+    """
+    Embeddings are clustered with MiniBatchKMeans, then cluster is drawn with cfg["weighting"] weights
+    (uniform by default, so every cluster is equally represented) and uniformly random remaining item of it.
+    Training vectors are streamed from index embeddings in chunks, so they never have to fit in memory.
+    If cfg["cache_dir"] is specified, centroids and per-item assignments are saved there keyed by collection id,
+    embedding dim and clustering parameters (n_clusters, train_size, batch_size, max_iter, random_state),
+    and reused while collection size does not change.
+    Collection re-embedded with another model is a new collection, so its clusters are fitted again.
+    """
+    def __init__(self, collection: chromadb.Collection, index: SamplerIndex, search: BaseNeighbourSearch, cfg: dict):
         self.cfg = cfg
-        self.cluster = KMeans(
-            n_clusters=cfg["n_clusters"],
-            max_iter=cfg["max_iter"],
-            random_state=cfg["random_state"]
-        )
-        if isinstance(cfg["train_size"], int):
-            if cfg["train_size"] > len(self.ids):
-                raise ValueError(f"train_size has to be less then collection size {len(self.ids)} not: {cfg['train_size']}")
-            train_size = cfg["train_size"]
-        elif isinstance(cfg["train_size"], float):
-            if not (0 < cfg["train_size"] <= 1):
-                raise ValueError(f"train_size has to be in (0, 1] not: {cfg['train_size']}")
-            train_size = int(cfg["train_size"] * len(self.ids))
+        self.n_clusters = cfg["n_clusters"]
+        self.chunk_size = cfg.get("batch_size", 4096)
+        self.random_state = cfg.get("random_state")
+        self.cache_path = self._cache_path(index, cfg)
+
+        cached = self._load(len(index))
+        if cached is None:
+            self.centroids, self.assignments = self._fit(index)
+            self._save()
         else:
-            raise TypeError(f"train_size has to be int of float not: {type(cfg['train_size'])}")
-        
-        random.seed(cfg["random_state"])
-        train_ids = random.sample(self.ids, k=train_size)
-        train_data = self.collection.get(train_ids, include=["embeddings"])["embeddings"]
-        self.cluster.fit(train_data)
-        self.buffer_size = cfg["buffer_size"]
-        
+            self.centroids, self.assignments = cached
 
-    def create_buffer(self):
-        self.buffer = random.sample(self.ids, k=self.buffer_size)
+        super().__init__(collection, index, search, categories=self.assignments, seed=self.random_state)
+        self.pool.set_category_weights(category_weights(self.pool.counts, cfg))
 
+    def _cache_path(self, index: SamplerIndex, cfg: dict) -> Optional[str]:
+        if cfg.get("cache_dir") is None:
+            return None
+        os.makedirs(cfg["cache_dir"], exist_ok=True)
+        dim = index.embeddings.shape[1]
+        params = f"k{self.n_clusters}_train{cfg['train_size']}_bs{self.chunk_size}_it{cfg.get('max_iter', 1)}_seed{self.random_state}"
+        name = f"{index.collection_id}_dim{dim}_{params}"
+        return os.path.join(cfg["cache_dir"], f"{name}.npz")
 
-    def exclude_ids(self, ids: List[str]):
-        self.ids = [id for id in self.ids if id not in ids]
+    def _train_size(self, n: int) -> int:
+        train_size = self.cfg["train_size"]
+        if isinstance(train_size, int):
+            if train_size > n:
+                raise ValueError(f"train_size has to be less then collection size {n} not: {train_size}")
+            return train_size
+        elif isinstance(train_size, float):
+            if not (0 < train_size <= 1):
+                raise ValueError(f"train_size has to be in (0, 1] not: {train_size}")
+            return int(train_size * n)
+        raise TypeError(f"train_size has to be int of float not: {type(train_size)}")
 
+    def _fit(self, index: SamplerIndex) -> Tuple[np.ndarray, np.ndarray]:
+        """ Streams training chunks into MiniBatchKMeans for max_iter epochs, then assigns all items chunk by chunk """
+        rng = np.random.default_rng(self.random_state)
+        train_positions = np.sort(rng.choice(len(index), size=self._train_size(len(index)), replace=False))
+        kmeans = MiniBatchKMeans(
+            n_clusters=self.n_clusters,
+            batch_size=self.chunk_size,
+            random_state=self.random_state,
+            n_init=1
+        )
+        # first chunk has to contain at least n_clusters vectors to initialize centroids
+        chunk_size = max(self.chunk_size, self.n_clusters)
+        for _ in range(self.cfg.get("max_iter", 1)):
+            for start in range(0, len(train_positions), chunk_size):
+                # sorted positions keep memmap reads sequential
+                kmeans.partial_fit(np.asarray(index.embeddings[train_positions[start: start + chunk_size]]))
 
-    def __call__(self, n_nearest: int) -> Tuple[URLMetaPair, List[URLMetaPair]]:
-        if len(self.ids) == 0:
+        assignments = np.empty(len(index), dtype=np.int64)
+        for start in range(0, len(index), chunk_size):
+            assignments[start: start + chunk_size] = kmeans.predict(np.asarray(index.embeddings[start: start + chunk_size]))
+        return kmeans.cluster_centers_.astype(np.float32), assignments
+
+    def _load(self, n: int) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+        if self.cache_path is None or not os.path.exists(self.cache_path):
             return None
-        i = random.randint(0, len(self.ids) - 1)
-        main_id = self.ids[i]
-        main_item_data = self.collection.get(
-            ids=main_id,
-            include=["embeddings", "metadatas"]
-        )
-        main_emb = main_item_data["embeddings"][0]
-        main_meta = main_item_data["metadatas"][0]
-        main_url = main_meta["url"]
-        main_item = URLMetaPair(
-            id=main_id,
-            url=main_url,
-            metadata=main_meta
-        )
+        with np.load(self.cache_path) as cached:
+            if len(cached["assignments"]) != n:
+                return None
+            return cached["centroids"], cached["assignments"]
 
-        nearest_data = self.collection.query(
-            query_embeddings=[main_emb],
-            n_results=n_nearest + 1,
-            include=["metadatas"]
-        )
-        nearest_items = [
-            URLMetaPair(
-                id=id,
-                url=meta["url"],
-                metadata=meta
-            ) 
-            for id, meta in zip(nearest_data["ids"][0], nearest_data["metadatas"][0]) if meta["url"] != main_url
-        ]
-        
-        return main_item, nearest_items
+    def _save(self):
+        if self.cache_path is None:
+            return
+        with open(self.cache_path + ".tmp", "wb") as f:
+            np.savez(f, centroids=self.centroids, assignments=self.assignments)
+        os.replace(self.cache_path + ".tmp", self.cache_path)
+
+    def draw_position(self) -> int:
+        return self.pool.draw_from(self.pool.draw_category())
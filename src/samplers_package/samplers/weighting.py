@@ -0,0 +1,32 @@
+import numpy as np
+
+
+def uniform_weights(sizes: np.ndarray, cfg: dict) -> np.ndarray:
+    """ Every category is equally likely """
+    return np.ones(len(sizes))
+
+
+def inverse_frequency_weights(sizes: np.ndarray, cfg: dict) -> np.ndarray:
+    """ Category weight is 1 / size, so small categories are oversampled the most """
+    return 1.0 / sizes
+
+
+def temperature_weights(sizes: np.ndarray, cfg: dict) -> np.ndarray:
+    """ Category weight is size ^ (1 / temperature): 1 is item-uniform sampling, large temperature tends to uniform over categories """
+    return sizes ** (1.0 / cfg["temperature"])
+
+
+name2weighting = {
+    "uniform": uniform_weights,
+    "inverse_frequency": inverse_frequency_weights,
+    "temperature": temperature_weights
+}
+
+
+def category_weights(sizes: np.ndarray, cfg: dict) -> np.ndarray:
+    """ Weights of categories with given initial sizes according to cfg["weighting"] (uniform by default) """
+    weighting = cfg.get("weighting", "uniform")
+    if weighting not in name2weighting:
+        raise Exception(f"No weighting named {weighting}")
+    # empty categories are never drawn, they only must not break division
+    return name2weighting[weighting](np.maximum(sizes, 1).astype(np.float64), cfg)
@@ -0,0 +1,5 @@
+from .base import BaseNeighbourSearch
+from .chroma import ChromaSearch
+from .exact import ExactSearch
+from .faiss_search import FaissSearch
+from .hnsw import HnswSearch
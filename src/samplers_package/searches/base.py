@@ -0,0 +1,46 @@
+from typing import Tuple
+from abc import ABC, abstractmethod
+import numpy as np
+import chromadb
+
+from ..index import SamplerIndex
+
+
+class BaseNeighbourSearch(ABC):
+    """
+    Nearest neighbour search over items of sampler index.
+    Distances follow collection metric the way chroma defines them:
+        l2 - squared euclidean distance, ip - 1 - dot product, cosine - 1 - cosine similarity
+    """
+    def __init__(self, collection: chromadb.Collection, index: SamplerIndex, cfg: dict):
+        self.collection = collection
+        self.index = index
+        self.cfg = cfg
+        self.metric = (collection.metadata or {}).get("hnsw:space", "l2")
+        if self.metric not in ("l2", "ip", "cosine"):
+            raise ValueError(f"Unknown collection metric {self.metric}")
+
+    @abstractmethod
+    def search(self, queries: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Returns (n_queries, k) positions of nearest items sorted by distance and (n_queries, k) their distances.
+        If less than k items are found, rows are padded with position -1 and distance inf.
+        """
+        pass
+
+
+def normalize(embs: np.ndarray) -> np.ndarray:
+    """ Rows scaled to unit length, zero rows are kept zero """
+    norms = np.linalg.norm(embs, axis=1, keepdims=True)
+    return embs / np.maximum(norms, 1e-12)
+
+
+def padded(positions: np.ndarray, distances: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+    """ Pads search results having less than k columns """
+    n_missing = k - positions.shape[1]
+    if n_missing <= 0:
+        return positions, distances
+    return (
+        np.pad(positions, ((0, 0), (0, n_missing)), constant_values=-1),
+        np.pad(distances, ((0, 0), (0, n_missing)), constant_values=np.inf)
+    )
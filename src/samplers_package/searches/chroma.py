@@ -0,0 +1,27 @@
+from typing import Tuple
+import numpy as np
+
+from .base import BaseNeighbourSearch, padded
+
+
+class ChromaSearch(BaseNeighbourSearch):
+    """ Batched collection.query, recall and latency are controlled by chroma hnsw settings of the collection """
+    def search(self, queries: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        k_found = min(k, len(self.index))
+        positions = np.full((len(queries), k_found), -1, dtype=np.int64)
+        distances = np.full((len(queries), k_found), np.inf, dtype=np.float32)
+        if k_found == 0:
+            return padded(positions, distances, k)
+
+        res = self.collection.query(
+            query_embeddings=np.asarray(queries, dtype=np.float32).tolist(),
+            n_results=k_found,
+            include=["distances"]
+        )
+        id2pos = self.index.id2pos()
+        for row, (ids, dists) in enumerate(zip(res["ids"], res["distances"])):
+            # items added to collection after index was built are unknown to samplers
+            found = [(id2pos[id], dist) for id, dist in zip(ids, dists) if id in id2pos]
+            positions[row, :len(found)] = [pos for pos, _ in found]
+            distances[row, :len(found)] = [dist for _, dist in found]
+        return padded(positions, distances, k)
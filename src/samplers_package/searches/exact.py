@@ -0,0 +1,58 @@
+from typing import Tuple
+import numpy as np
+
+from .base import BaseNeighbourSearch, normalize, padded
+
+
+class ExactSearch(BaseNeighbourSearch):
+    """
+    Brute force search: queries are multiplied by index embeddings chunk by chunk (BLAS matmul),
+    running top-k is merged with every chunk. Embeddings stay memory-mapped, only one chunk is read at a time.
+    Exact, so it is the reference for recall of approximate searches, fast enough for small and medium collections.
+        cfg["chunk_size"] - number of embeddings multiplied at once
+    """
+    def __init__(self, collection, index, cfg: dict):
+        super().__init__(collection, index, cfg)
+        self.chunk_size = cfg.get("chunk_size", 65536)
+
+        # norms are computed once, so embeddings themselves are never copied
+        self.sq_norms = np.empty(len(index), dtype=np.float32)
+        for start in range(0, len(index), self.chunk_size):
+            chunk = np.asarray(index.embeddings[start: start + self.chunk_size], dtype=np.float32)
+            self.sq_norms[start: start + len(chunk)] = (chunk ** 2).sum(axis=1)
+        self.inv_norms = 1.0 / np.maximum(np.sqrt(self.sq_norms), 1e-12)
+
+    def _distances(self, queries: np.ndarray, start: int, chunk: np.ndarray) -> np.ndarray:
+        dots = queries @ chunk.T
+        if self.metric == "cosine":
+            return 1.0 - dots * self.inv_norms[start: start + len(chunk)]
+        if self.metric == "ip":
+            return 1.0 - dots
+        return self.sq_norms[start: start + len(chunk)] - 2.0 * dots + (queries ** 2).sum(axis=1, keepdims=True)
+
+    def search(self, queries: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        queries = np.asarray(queries, dtype=np.float32)
+        if self.metric == "cosine":
+            queries = normalize(queries)
+
+        best_positions = np.full((len(queries), 0), -1, dtype=np.int64)
+        best_distances = np.full((len(queries), 0), np.inf, dtype=np.float32)
+        for start in range(0, len(self.index), self.chunk_size):
+            chunk = np.asarray(self.index.embeddings[start: start + self.chunk_size], dtype=np.float32)
+            distances = np.concatenate([best_distances, self._distances(queries, start, chunk)], axis=1)
+            positions = np.concatenate([
+                best_positions,
+                np.broadcast_to(np.arange(start, start + len(chunk)), (len(queries), len(chunk)))
+            ], axis=1)
+
+            k_best = min(k, distances.shape[1])
+            top = np.argpartition(distances, k_best - 1, axis=1)[:, :k_best]
+            best_distances = np.take_along_axis(distances, top, axis=1)
+            best_positions = np.take_along_axis(positions, top, axis=1)
+
+        order = np.argsort(best_distances, axis=1, kind="stable")
+        return padded(
+            np.take_along_axis(best_positions, order, axis=1),
+            np.take_along_axis(best_distances, order, axis=1),
+            k
+        )
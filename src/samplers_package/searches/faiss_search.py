@@ -0,0 +1,95 @@
+from typing import Optional, Tuple
+import os
+
+import numpy as np
+
+from .base import BaseNeighbourSearch, normalize, padded
+
+
+class FaissSearch(BaseNeighbourSearch):
+    """
+    Approximate search with faiss index built from index embeddings chunk by chunk.
+        cfg["index_type"] - "hnsw" (IndexHNSWFlat) or "ivf" (IndexIVFFlat)
+        cfg["M"], cfg["ef_construction"], cfg["ef_search"] - hnsw graph degree and search breadth, larger ef - higher recall
+        cfg["nlist"], cfg["nprobe"], cfg["train_size"] - ivf number of lists, lists visited per query, items to train on
+        cfg["chunk_size"] - number of embeddings added at once
+        cfg["cache_dir"] - built index is saved there keyed by collection id and reused while collection size does not change
+    Cosine is searched as inner product of normalized vectors.
+    faiss is imported only when this search is used, so it is an optional dependency.
+    """
+    def __init__(self, collection, index, cfg: dict):
+        import faiss
+
+        super().__init__(collection, index, cfg)
+        self.index_type = cfg.get("index_type", "hnsw")
+        if self.index_type not in ("hnsw", "ivf"):
+            raise Exception(f"No faiss index type named {self.index_type}")
+        self.chunk_size = cfg.get("chunk_size", 65536)
+        self.faiss_metric = faiss.METRIC_L2 if self.metric == "l2" else faiss.METRIC_INNER_PRODUCT
+
+        self.cache_path = self._cache_path()
+        self.faiss_index = self._load()
+        if self.faiss_index is None:
+            self.faiss_index = self._build()
+            if self.cache_path is not None:
+                faiss.write_index(self.faiss_index, self.cache_path + ".tmp")
+                os.replace(self.cache_path + ".tmp", self.cache_path)
+
+        # search time parameters are not part of the saved index, so they can be tuned without rebuilding
+        if self.index_type == "hnsw":
+            self.faiss_index.hnsw.efSearch = cfg.get("ef_search", 64)
+        else:
+            self.faiss_index.nprobe = cfg.get("nprobe", 16)
+
+    def _cache_path(self) -> Optional[str]:
+        if self.cfg.get("cache_dir") is None:
+            return None
+        os.makedirs(self.cfg["cache_dir"], exist_ok=True)
+        if self.index_type == "hnsw":
+            params = f"hnsw_M{self.cfg.get('M', 32)}_efc{self.cfg.get('ef_construction', 200)}"
+        else:
+            params = f"ivf{self.cfg.get('nlist', 1024)}"
+        return os.path.join(self.cfg["cache_dir"], f"{self.collection.name}_{self.index.collection_id}_{params}.faiss")
+
+    def _load(self) -> Optional["faiss.Index"]:
+        import faiss
+
+        if self.cache_path is None or not os.path.exists(self.cache_path):
+            return None
+        faiss_index = faiss.read_index(self.cache_path)
+        return faiss_index if faiss_index.ntotal == len(self.index) else None
+
+    def _chunk(self, start: int, stop: int) -> np.ndarray:
+        chunk = np.asarray(self.index.embeddings[start: stop], dtype=np.float32)
+        return normalize(chunk) if self.metric == "cosine" else chunk
+
+    def _build(self) -> "faiss.Index":
+        import faiss
+
+        dim = self.index.embeddings.shape[1]
+        if self.index_type == "hnsw":
+            faiss_index = faiss.IndexHNSWFlat(dim, self.cfg.get("M", 32), self.faiss_metric)
+            faiss_index.hnsw.efConstruction = self.cfg.get("ef_construction", 200)
+        else:
+            nlist = self.cfg.get("nlist", 1024)
+            faiss_index = faiss.IndexIVFFlat(faiss.IndexFlat(dim, self.faiss_metric), dim, nlist, self.faiss_metric)
+            # faiss recommends at least 39 training vectors per list
+            train_size = min(self.cfg.get("train_size", 64 * nlist), len(self.index))
+            rng = np.random.default_rng(0)
+            train_positions = np.sort(rng.choice(len(self.index), size=train_size, replace=False))
+            train_data = np.asarray(self.index.embeddings[train_positions], dtype=np.float32)
+            faiss_index.train(normalize(train_data) if self.metric == "cosine" else train_data)
+
+        for start in range(0, len(self.index), self.chunk_size):
+            faiss_index.add(self._chunk(start, start + self.chunk_size))
+        return faiss_index
+
+    def search(self, queries: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        queries = np.asarray(queries, dtype=np.float32)
+        if self.metric == "cosine":
+            queries = normalize(queries)
+        scores, positions = self.faiss_index.search(np.ascontiguousarray(queries), min(k, len(self.index)))
+        # faiss returns squared l2 distances or inner products
+        distances = scores if self.metric == "l2" else 1.0 - scores
+        distances[positions == -1] = np.inf
+        return padded(positions.astype(np.int64), distances.astype(np.float32), k)
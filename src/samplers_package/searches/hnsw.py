@@ -0,0 +1,75 @@
+from typing import Optional, Tuple
+import os
+
+import numpy as np
+
+from .base import BaseNeighbourSearch, padded
+
+
+class HnswSearch(BaseNeighbourSearch):
+    """
+    Approximate search with hnswlib graph built from index embeddings chunk by chunk,
+    hnswlib distances are defined the same way as chroma ones.
+    hnswlib module is provided by chroma-hnswlib dependency of chromadb, standalone hnswlib package must not be installed
+    next to it, they install the same module and chroma needs methods of its fork. It is imported only when this search is used.
+        cfg["M"], cfg["ef_construction"], cfg["ef_search"] - graph degree and search breadth, larger ef - higher recall
+        cfg["threads"] - threads used for building and batched queries, -1 for all cores
+        cfg["chunk_size"] - number of embeddings added at once
+        cfg["cache_dir"] - built graph is saved there keyed by collection id and reused while collection size does not change
+    """
+    def __init__(self, collection, index, cfg: dict):
+        super().__init__(collection, index, cfg)
+        self.chunk_size = cfg.get("chunk_size", 65536)
+        self.threads = cfg.get("threads", -1)
+        self.dim = index.embeddings.shape[1]
+
+        self.cache_path = self._cache_path()
+        self.graph = self._load()
+        if self.graph is None:
+            self.graph = self._build()
+            if self.cache_path is not None:
+                self.graph.save_index(self.cache_path + ".tmp")
+                os.replace(self.cache_path + ".tmp", self.cache_path)
+        self.ef_search = cfg.get("ef_search", 64)
+        self.graph.set_ef(self.ef_search)
+
+    def _cache_path(self) -> Optional[str]:
+        if self.cfg.get("cache_dir") is None:
+            return None
+        os.makedirs(self.cfg["cache_dir"], exist_ok=True)
+        params = f"hnswlib_M{self.cfg.get('M', 32)}_efc{self.cfg.get('ef_construction', 200)}"
+        return os.path.join(self.cfg["cache_dir"], f"{self.collection.name}_{self.index.collection_id}_{params}.bin")
+
+    def _load(self) -> Optional["hnswlib.Index"]:
+        import hnswlib
+
+        if self.cache_path is None or not os.path.exists(self.cache_path):
+            return None
+        graph = hnswlib.Index(space=self.metric, dim=self.dim)
+        graph.load_index(self.cache_path)
+        return graph if graph.get_current_count() == len(self.index) else None
+
+    def _build(self) -> "hnswlib.Index":
+        import hnswlib
+
+        graph = hnswlib.Index(space=self.metric, dim=self.dim)
+        graph.init_index(
+            max_elements=max(len(self.index), 1),
+            ef_construction=self.cfg.get("ef_construction", 200),
+            M=self.cfg.get("M", 32)
+        )
+        for start in range(0, len(self.index), self.chunk_size):
+            chunk = np.asarray(self.index.embeddings[start: start + self.chunk_size], dtype=np.float32)
+            graph.add_items(chunk, np.arange(start, start + len(chunk)), num_threads=self.threads)
+        return graph
+
+    def search(self, queries: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        k_found = min(k, len(self.index))
+        if k_found == 0:
+            return padded(np.full((len(queries), 0), -1, dtype=np.int64), np.full((len(queries), 0), np.inf, dtype=np.float32), k)
+        # hnswlib fails instead of returning less results if ef is below k
+        if k_found > self.ef_search:
+            self.ef_search = k_found
+            self.graph.set_ef(self.ef_search)
+        positions, distances = self.graph.knn_query(np.asarray(queries, dtype=np.float32), k=k_found, num_threads=self.threads)
+        return padded(positions.astype(np.int64), distances.astype(np.float32), k)
@@ -0,0 +1,32 @@
+from typing import List, Sequence, Iterable, Iterator, Callable, Container
+import itertools
+import sqlite3
+
+
+# sqlite limits number of bound parameters in one statement
+MAX_PARAMS = 900
+
+
+def execute_in(conn: sqlite3.Connection, sql: str, values: Sequence, params: Sequence = ()) -> List[tuple]:
+    """
+    Runs sql whose "{}" is replaced by placeholders of IN list for every chunk of values,
+    so bound parameters stay under sqlite limit. params are bound before values of the chunk.
+    Returns rows of all chunks.
+    """
+    rows = []
+    for i in range(0, len(values), MAX_PARAMS):
+        chunk = list(values[i: i + MAX_PARAMS])
+        rows.extend(conn.execute(sql.format(",".join("?" * len(chunk))), [*params, *chunk]))
+    return rows
+
+
+def filter_urls(items: Iterable[dict], dropped: Callable[[List[str]], Container[str]], batch_size: int = 10000) -> Iterator[dict]:
+    """
+    Lazily yields items whose urls are not in dropped(urls of their batch), checking them batch by batch.
+    """
+    items = iter(items)
+    while batch := list(itertools.islice(items, batch_size)):
+        drop = dropped([item["url"] for item in batch])
+        for item in batch:
+            if item["url"] not in drop:
+                yield item
@@ -0,0 +1,92 @@
+from typing import List, Dict, Iterable, Iterator
+import threading
+import sqlite3
+
+import chromadb
+
+from .sqlite_utils import execute_in, filter_urls
+
+
+class UrlIndex:
+    """
+    Persistent url -> id index of the collection, stored in sqlite next to chroma db.
+    Lets embedify check which urls are already embedded by primary key lookups,
+    without loading metadatas of the whole collection into memory.
+    """
+    def __init__(self, path: str):
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS urls (url TEXT PRIMARY KEY, id TEXT NOT NULL) WITHOUT ROWID")
+        # number of collection elements index reflects, differs from number of urls if collection has duplicates
+        self.conn.execute("CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+        self.conn.execute("INSERT OR IGNORE INTO state (key, value) VALUES ('n_elements', 0)")
+        # incremented on every write and never reset, so caches of collection data can tell they are stale
+        self.conn.execute("INSERT OR IGNORE INTO state (key, value) VALUES ('version', 0)")
+        self.conn.commit()
+
+    def __len__(self) -> int:
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM urls").fetchone()[0]
+
+    def __contains__(self, url: str) -> bool:
+        with self.lock:
+            return self.conn.execute("SELECT 1 FROM urls WHERE url = ?", (url,)).fetchone() is not None
+
+    def get_many(self, urls: List[str]) -> Dict[str, str]:
+        """ Returns url -> id for those urls that are in index """
+        with self.lock:
+            return dict(execute_in(self.conn, "SELECT url, id FROM urls WHERE url IN ({})", urls))
+
+    @property
+    def n_elements(self) -> int:
+        with self.lock:
+            return self.conn.execute("SELECT value FROM state WHERE key = 'n_elements'").fetchone()[0]
+
+    @property
+    def version(self) -> int:
+        """ Number of writes to the collection, changes when its elements are added or updated """
+        with self.lock:
+            return self.conn.execute("SELECT value FROM state WHERE key = 'version'").fetchone()[0]
+
+    def add(self, ids: List[str], urls: List[str]):
+        """ Has to be called right after the same elements are added to collection or updated in it """
+        with self.lock:
+            self.conn.executemany("INSERT OR REPLACE INTO urls (url, id) VALUES (?, ?)", zip(urls, ids))
+            self.conn.execute("UPDATE state SET value = value + ? WHERE key = 'n_elements'", (len(ids),))
+            self.conn.execute("UPDATE state SET value = value + 1 WHERE key = 'version'")
+            self.conn.commit()
+
+    def clear(self):
+        with self.lock:
+            self.conn.execute("DELETE FROM urls")
+            self.conn.execute("UPDATE state SET value = 0 WHERE key = 'n_elements'")
+            self.conn.commit()
+
+    def sync(self, collection: chromadb.Collection, logger, page_size: int = 10000):
+        """
+        Rebuilds index from the collection if they are out of sync (e.g. index is new or
+        previous run was interrupted between collection and index writes).
+        Collection metadatas are read page by page.
+        """
+        count = collection.count()
+        if self.n_elements == count:
+            return
+
+        logger.info(f"Url index is out of sync with collection ({self.n_elements} != {count}). Rebuilding ...")
+        self.clear()
+        for offset in range(0, count, page_size):
+            page = collection.get(include=["metadatas"], limit=page_size, offset=offset)
+            self.add(page["ids"], [meta["url"] for meta in page["metadatas"]])
+        logger.info(f"Url index rebuilt, number of urls: {len(self)}")
+
+    def filter_new(self, items: Iterable[dict], batch_size: int = 10000) -> Iterator[dict]:
+        """
+        Lazily yields items whose urls are not in index, checking them batch by batch.
+        """
+        return filter_urls(items, self.get_many, batch_size)
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
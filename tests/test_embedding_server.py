@@ -0,0 +1,181 @@
+import asyncio
+import base64
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+import numpy as np
+from PIL import Image
+from aiohttp.test_utils import TestClient, TestServer
+
+from src.embedding_server import DynamicBatcher, EmbeddingServer, LRUCache
+
+
+class StubEmbedder:
+    """ Embeds image as [width, 0, 0, 0] and text as [len, 0, 0, 0], records sizes of model batches """
+    def __init__(self, supports_text: bool = True):
+        self.supports_text = supports_text
+        self.image_batches = []
+        self.text_batches = []
+
+    def embed(self, imgs, keys=None) -> np.ndarray:
+        self.image_batches.append(len(imgs))
+        return np.array([[img.width, 0, 0, 0] for img in imgs], dtype=np.float32)
+
+    def embed_texts(self, texts) -> np.ndarray:
+        self.text_batches.append(len(texts))
+        return np.array([[len(text), 0, 0, 0] for text in texts], dtype=np.float32)
+
+    def decode_image(self, content: bytes) -> Image.Image:
+        return Image.open(BytesIO(content)).convert("RGB")
+
+    async def fetch_content(self, url: str) -> bytes:
+        raise ConnectionError(f"No network in tests: {url}")
+
+
+class StubCollection:
+    def __init__(self):
+        self.queries = []
+
+    def query(self, query_embeddings, n_results, where=None, include=()):
+        self.queries.append((query_embeddings, n_results, where))
+        ids = [f"id{i}" for i in range(n_results)]
+        return {"ids": [ids], "distances": [[0.0] * n_results], "metadatas": [[{"url": id} for id in ids]]}
+
+
+def encoded_image(width: int) -> str:
+    out = BytesIO()
+    Image.new("RGB", (width, 8), "white").save(out, format="PNG")
+    return base64.b64encode(out.getvalue()).decode()
+
+
+def run_with_client(server: EmbeddingServer, scenario):
+    async def run():
+        async with TestClient(TestServer(server.app())) as client:
+            return await scenario(client)
+    return asyncio.run(run())
+
+
+def make_server(embedder=None, **kwargs) -> EmbeddingServer:
+    cfg = {"max_batch_size": 32, "max_wait": 0.2, **kwargs}
+    return EmbeddingServer(embedder or StubEmbedder(), StubCollection(), logging.getLogger("test"), **cfg)
+
+
+def test_batcher_coalesces_concurrent_requests():
+    calls = []
+
+    def fn(items):
+        calls.append(list(items))
+        return np.array(items) * 2
+
+    async def run():
+        batcher = DynamicBatcher(fn, ThreadPoolExecutor(1), max_batch_size=8, max_wait=0.2)
+        batcher.start()
+        try:
+            return await asyncio.gather(*[batcher(i) for i in range(5)])
+        finally:
+            await batcher.close()
+
+    results = asyncio.run(run())
+    assert [int(result) for result in results] == [0, 2, 4, 6, 8]
+    assert len(calls) == 1 and sorted(calls[0]) == [0, 1, 2, 3, 4]
+
+
+def test_batcher_splits_by_max_batch_size():
+    calls = []
+
+    def fn(items):
+        calls.append(len(items))
+        return np.array(items)
+
+    async def run():
+        batcher = DynamicBatcher(fn, ThreadPoolExecutor(1), max_batch_size=3, max_wait=0.2)
+        batcher.start()
+        try:
+            await asyncio.gather(*[batcher(i) for i in range(7)])
+        finally:
+            await batcher.close()
+
+    asyncio.run(run())
+    assert sum(calls) == 7 and max(calls) <= 3
+
+
+def test_lru_cache_evicts_least_recently_used():
+    cache = LRUCache(2)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    assert cache.get("a") == 1
+    cache.put("c", 3)
+    assert cache.get("b") is None
+    assert cache.get("a") == 1 and cache.get("c") == 3
+    assert (cache.hits, cache.misses) == (3, 1)
+
+
+def test_concurrent_image_requests_share_one_forward():
+    embedder = StubEmbedder()
+    server = make_server(embedder)
+
+    async def scenario(client):
+        responses = await asyncio.gather(*[client.post("/embed", json={"image": encoded_image(10 + i)}) for i in range(6)])
+        return [(response.status, await response.json()) for response in responses]
+
+    results = run_with_client(server, scenario)
+    assert [status for status, _ in results] == [200] * 6
+    assert [body["embedding"][0] for _, body in results] == [10, 11, 12, 13, 14, 15]
+    assert embedder.image_batches == [6]
+
+
+def test_repeated_query_is_cached():
+    embedder = StubEmbedder()
+    server = make_server(embedder, max_wait=0.0)
+
+    async def scenario(client):
+        first = await client.post("/query", json={"text": "red dress", "k": 3})
+        second = await client.post("/query", json={"text": "red dress", "k": 3})
+        return await first.json(), await second.json()
+
+    first, second = run_with_client(server, scenario)
+    assert first == second
+    assert first["ids"] == ["id0", "id1", "id2"]
+    assert embedder.text_batches == [1]
+    assert server.cache.hits == 1
+
+
+def test_bad_requests():
+    server = make_server(StubEmbedder(supports_text=False), max_wait=0.0)
+    bodies = [
+        {"data": b"not json"},
+        {"json": ["list"]},
+        {"json": {}},
+        {"json": {"image": "not base64!"}},
+        {"json": {"url": 5}},
+        {"json": {"text": "text query of image only model"}},
+        {"json": {"image": base64.b64encode(b"not an image").decode()}}
+    ]
+
+    async def scenario(client):
+        statuses = [(await client.post("/embed", **body)).status for body in bodies]
+        for k in (0, "3", 10**6):
+            statuses.append((await client.post("/query", json={"image": encoded_image(8), "k": k})).status)
+        statuses.append((await client.post("/embed", json={"url": "http://example.com/a.jpg"})).status)
+        return statuses
+
+    statuses = run_with_client(server, scenario)
+    assert statuses == [400] * 10 + [502]
+
+
+def test_stats():
+    server = make_server(max_wait=0.0)
+
+    async def scenario(client):
+        for i in range(3):
+            await client.post("/embed", json={"image": encoded_image(8 + i)})
+        await client.post("/embed", json={"image": encoded_image(8)})
+        return await (await client.get("/stats")).json()
+
+    stats = run_with_client(server, scenario)
+    latency = stats["latency"]["POST /embed"]
+    assert latency["count"] == 4
+    assert 0 <= latency["p50_ms"] <= latency["p99_ms"]
+    assert stats["batches"]["count"] == 3
+    assert stats["cache"] == {"size": 3, "hits": 1, "misses": 3}
@@ -0,0 +1,56 @@
+import logging
+import uuid
+
+import chromadb
+import numpy as np
+
+from src.samplers_package import NamedSampler
+from src.sample_prefetcher import SamplePrefetcher
+
+
+def make_sampler(n: int = 50, dim: int = 4) -> NamedSampler:
+    collection = chromadb.EphemeralClient().create_collection(f"test-{uuid.uuid4().hex}")
+    rng = np.random.default_rng(0)
+    collection.add(
+        ids=[f"id{i}" for i in range(n)],
+        embeddings=rng.random((n, dim)).tolist(),
+        metadatas=[{"url": f"http://example.com/{i}.jpg"} for i in range(n)]
+    )
+    return NamedSampler(collection=collection, meta_fields=["url"], name="rand", cfg={}, search_name="exact")
+
+
+def test_samples_with_neighbours_excluded_before_prefetching():
+    sampler = make_sampler()
+    excluded = {f"id{i}" for i in range(45)}
+    sampler.exclude_ids(list(excluded))
+    # one sample per batch, so nearest items are not shared with other samples of the batch
+    prefetcher = SamplePrefetcher(sampler, logging.getLogger("test"), n_nearest=3, prefetch_size=1)
+    try:
+        main_ids = set()
+        for _ in range(5):
+            sample = prefetcher.pop(timeout=5)
+            assert sample is not None
+            assert sample.main_item.id not in excluded
+            # nearest items are searched in the whole collection, so annotated ones are shown too
+            assert len(sample.nearest_items) == 3
+            main_ids.add(sample.main_item.id)
+            prefetcher.exclude_ids([sample.main_item.id])
+        assert main_ids == {f"id{i}" for i in range(45, 50)}
+        assert prefetcher.pop(timeout=5) is None
+    finally:
+        prefetcher.close()
+
+
+def test_exclusion_drops_queued_samples():
+    sampler = make_sampler(n=20)
+    prefetcher = SamplePrefetcher(sampler, logging.getLogger("test"), n_nearest=2, prefetch_size=8)
+    try:
+        sample = prefetcher.pop(timeout=5)
+        excluded = {sample.main_item.id} | {item.id for item in sample.nearest_items}
+        prefetcher.exclude_ids(list(excluded))
+        with prefetcher.cond:
+            queued = list(prefetcher.queue)
+        assert all(not excluded & {item.id for item in [s.main_item] + s.nearest_items} for s in queued)
+        assert prefetcher.pop(timeout=5).main_item.id not in excluded
+    finally:
+        prefetcher.close()